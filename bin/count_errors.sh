@@ -1,77 +1,41 @@
 #!/usr/bin/env bash
 
-echo ""
-
-count=0
-for file in logs/log_domain*Person.log
-do
-    echo -n "$file  "
-    grep ERROR $file 2> /dev/null | wc -l
-    NUM=$(grep ERROR $file 2> /dev/null | wc -l )
-    count=$(( $count + $NUM ))
-done
-person_errors=$count
-echo "Person Errors: $count"
-echo ""
-
-count=0
-for file in logs/log_domain*Visit.log
-do 
-    echo -n "$file  "
-    grep ERROR $file 2> /dev/null | wc -l
-    NUM=$(grep ERROR $file 2> /dev/null | wc -l )
-    count=$(( $count + $NUM ))
-done
-echo "Visit Errors: $count"
-echo ""
+# Counts field extraction problems per domain from the run's field metrics,
+# written by layer_datasets (or data_driven_parse) at the end of the run,
+# see prototype_2/field_metrics.py
 
-count=0
-for file in logs/log_domain*Observation.log
-do 
-    echo -n "$file  "
-    grep ERROR $file 2> /dev/null | wc -l
-    NUM=$(grep ERROR $file 2> /dev/null | wc -l )
-    count=$(( $count + $NUM ))
-done
-echo "Observation Errors: $count"
-echo ""
+METRICS_FILE=${1:-logs/field_metrics.csv}
 
-count=0
-for file in logs/log_domain*Measurement.log
-do 
-    echo -n "$file  "
-    grep ERROR $file 2> /dev/null | wc -l
-    NUM=$(grep ERROR $file 2> /dev/null | wc -l )
-    count=$(( $count + $NUM ))
-done
-echo "Measurement Errors: $count"
-echo ""
+if [[ ! -f $METRICS_FILE ]]
+then
+    echo "no metrics file $METRICS_FILE"
+    exit 0
+fi
 
-count=0
-for file in logs/log_domain*Drug.log
-do 
-    echo -n "$file  "
-    grep ERROR $file 2> /dev/null | wc -l
-    NUM=$(grep ERROR $file 2> /dev/null | wc -l )
-    count=$(( $count + $NUM ))
-done
-echo "Drug Errors: $count"
 echo ""
+awk -F, '
+    NR == 1 { for (i = 1; i <= NF; i++) column[$i] = i; next }
+    {
+        problems = $column["missing_element"] + $column["missing_attribute"] + $column["missing_fk"] \
+                 + $column["derived_failure"] + $column["unmapped_concept"]
+        if (problems > 0) {
+            print "  " $1 "/" $2 "  " problems
+        }
+        domain_problems[$1] += problems
+    }
+    END {
+        for (domain in domain_problems) {
+            print domain " Errors: " domain_problems[domain]
+        }
+    }' $METRICS_FILE
+
+person_errors=$(awk -F, 'NR == 1 { for (i = 1; i <= NF; i++) column[$i] = i; next }
+    $1 == "Person" { n += $column["missing_element"] + $column["missing_attribute"] + $column["missing_fk"] \
+                        + $column["derived_failure"] + $column["unmapped_concept"] }
+    END { print n + 0 }' $METRICS_FILE)
 
-count=0
-for file in logs/log_domain*Condition.log
-do 
-    echo -n "$file  "
-    grep ERROR $file 2> /dev/null | wc -l
-    NUM=$(grep ERROR $file 2> /dev/null | wc -l )
-    count=$(( $count + $NUM ))
-done
-echo "Condition Errors: $count"
 echo ""
-
-
 # failing when there person errors for now
 echo "Person Errors: $person_errors"
 #exit $person_errors
 exit 0
-
@@ -0,0 +1,102 @@
+""" duckdb_sink
+    Loads the parsed DataFrames straight into the OMOP tables of a DuckDB
+    connection, instead of writing CSVs for setup_omop to read back in.
+
+    The sink is a batch writer like those in prototype_2/output_writers.py, a dict
+    of functions:
+    - write(dataframe_dict, document): adds a document's DataFrames, keyed by domain
+    - close(): loads what's left, creates the indices and checks the PKs,
+      returns {domain: rows loaded}
+
+    The tables are created from the OMOP DDL when the sink is opened. Each domain's
+    rows are typed from the DDL, as for Parquet, buffered across documents, and
+    loaded with one INSERT ... SELECT from a registered Arrow table per batch of
+    batch_rows. If a batch fails, on a NOT NULL or PK constraint say, its documents
+    are loaded one at a time so only the failing ones are left out, as when
+    setup_omop loads a CSV per document.
+"""
+
+import logging
+import duckdb
+import pyarrow as pa
+
+import omop.setup_omop as setup_omop
+import prototype_2.omop_schema as omop_schema
+import prototype_2.output_writers as output_writers
+
+logger = logging.getLogger(__name__)
+
+BATCH_ROWS = 100000
+
+
+def _insert_table(conn, table_name, column_names, arrow_table):
+    column_list = ", ".join(column_names)
+    conn.register('omop_batch', arrow_table)
+    try:
+        conn.execute(f"INSERT INTO {table_name} ({column_list}) SELECT {column_list} FROM omop_batch")
+    finally:
+        conn.unregister('omop_batch')
+
+
+def open_duckdb_sink(conn, batch_rows=BATCH_ROWS):
+    """ Returns a sink, see above, that loads into the connection's OMOP tables,
+        after creating them.
+    """
+    setup_omop.create_omop_tables(conn)
+
+    # per domain: table, columns to load, schema, buffered (document, table) and rows
+    domain_states = {}
+
+    def start_domain(domain):
+        table_name = omop_schema.domain_table_names[domain]
+        schema = output_writers.domain_arrow_schema(domain)
+        ddl_columns = omop_schema.get_domain_columns(domain)
+        column_names = [field.name for field in schema if field.name in ddl_columns]
+        return {'table_name': table_name, 'schema': schema, 'column_names': column_names,
+                'documents': [], 'buffered_rows': 0, 'rows': 0, 'failed_rows': 0}
+
+    def flush(domain, state):
+        if state['buffered_rows'] == 0:
+            return
+        documents = state['documents']
+        state['documents'] = []
+        state['buffered_rows'] = 0
+        try:
+            batch_table = pa.concat_tables([document_table for (document, document_table) in documents])
+            _insert_table(conn, state['table_name'], state['column_names'], batch_table)
+            state['rows'] += len(batch_table)
+            return
+        except duckdb.Error as e:
+            logger.warning(f"DUCKDB batch of {len(documents)} documents failed for {domain}, "
+                           f"loading them one at a time: {e}")
+        for (document, document_table) in documents:
+            try:
+                _insert_table(conn, state['table_name'], state['column_names'], document_table)
+                state['rows'] += len(document_table)
+            except duckdb.Error as e:
+                state['failed_rows'] += len(document_table)
+                logger.error(f"DUCKDB failed to load {domain} from {document}: {e}")
+
+    def write(dataframe_dict, document=None):
+        for domain, domain_df in dataframe_dict.items():
+            if domain_df is None or len(domain_df) == 0 or domain not in omop_schema.domain_table_names:
+                continue
+            if domain not in domain_states:
+                domain_states[domain] = start_domain(domain)
+            state = domain_states[domain]
+            state['documents'].append((document, output_writers.dataframe_to_arrow(domain_df, state['schema'], domain)))
+            state['buffered_rows'] += len(domain_df)
+            if state['buffered_rows'] >= batch_rows:
+                flush(domain, state)
+
+    def close():
+        for domain, state in domain_states.items():
+            flush(domain, state)
+            logger.info(f"DUCKDB loaded {state['rows']} {domain} rows into {state['table_name']}, "
+                        f"{state['failed_rows']} failed")
+        setup_omop.create_omop_indices(conn)
+        for domain in domain_states:
+            setup_omop.check_PK(conn, domain)
+        return {domain: state['rows'] for (domain, state) in domain_states.items()}
+
+    return {'write': write, 'close': close}
@@ -1,6 +1,14 @@
 """ setup_omop
-    Initiates an in-memory instance of DuckDB, reads in the OMOP DDL,
-    and reads in any data provided.
+    Initiates an in-memory instance of DuckDB, or opens a database file with
+    --database-file, reads in the OMOP DDL, and reads in any data provided.
+
+    With a database file the load is incremental. A manifest table records each
+    file loaded, its content hash and row count, and each loaded row has the file
+    it came from in an omop_load_file column. A re-run skips files whose hash is
+    unchanged, deletes the rows of files that changed and loads them again, and
+    loads new files. Rows are deleted by file, not by primary key, since hashed
+    IDs can repeat across documents. The DDL and the indices are applied only when the database doesn't
+    have them yet.
 
     For now, it's useful to see issues regarding  PK presence and uniqueness, datatypes..
 
@@ -14,89 +22,94 @@
 
 OMOP_CDM_DIR = "resources/" #  "../CommonDataModel/inst/ddl/5.3/duckdb/"
 OMOP_CSV_DATA_DIR = "output/"
+OMOP_PARQUET_DATA_DIR = "output/parquet/"
 
+import argparse
+import concurrent.futures
+import glob
+import hashlib
 import io
 import os
-import re
 import logging
 import duckdb
+import prototype_2.data_driven_parse as DDP
+import prototype_2.omop_schema as omop_schema
+from prototype_2.logging_config import configure_logging
+from prototype_2.metadata import get_meta_dict
 
-conn = duckdb.connect()
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    format='%(levelname)s: %(message)s',
-    filename=f"logs/load_omop.log",
-    force=True,
-    level=logging.INFO
-    # level=logging.WARNING level=logging.ERROR # level=logging.INFO # level=logging.DEBUG
-)
 
 processing_status = True
 
-sql_import_dict = {
-    'Person': {
-        'sql': """
-                INSERT INTO TABLENAME SELECT
-            person_id, gender_concept_id, year_of_birth, month_of_birth, day_of_birth,
-            birth_datetime, race_concept_id, ethnicity_concept_id,
-            location_id, provider_id, care_site_id, person_source_value,
-            gender_source_value, gender_source_concept_id, race_source_value,
-            race_source_concept_id, ethnicity_source_value, ethnicity_source_concept_id
-                FROM  read_csv('FILENAME', delim=',', header=True)
-               """,
-        'table_name': "person",
-        'pk_query': """
-                SELECT count(*) as row_ct, count(person_id) as p_id,
-                            count(distinct person_id) as d_p_id
-                FROM person
-                """
-    },
-    'Visit': {
-        'sql': """
-                INSERT INTO TABLENAME SELECT
-                    visit_occurrence_id, 
-                    person_id, 
-                    visit_concept_id,
-                    visit_start_date, visit_start_datetime, 
-                    visit_end_date, visit_end_datetime, 
-                    visit_type_concept_id, 
-                    provider_id, care_site_id, 
-                    visit_source_value, visit_source_concept_id, 
-                    admitting_source_concept_id, admitting_source_value, 
-                    discharge_to_source_concept_id, discharge_to_source_value, 
-                    preceding_visit_occurrence_id
-                FROM  read_csv('FILENAME', delim=',', header=True)
-               """,
-        'table_name': "visit_occurrence",
-        'pk_query': """
-                SELECT count(*) as row_ct, count(visit_occurrence_id) as p_id, count(distinct visit_occurrence_id) as d_p_id
-                FROM visit_occurrence
-                """
-    },
-    'Measurement': {
-        'sql': """
-                INSERT INTO TABLENAME SELECT 
-                    measurement_id,  person_id, measurement_concept_id,
-                    measurement_date, measurement_datetime, measurement_time, 
-                    measurement_type_concept_id, operator_concept_id, 
-                    value_as_number, value_as_concept_id,
-                    unit_concept_id, range_low, range_high, 
-                    provider_id, 
-                    visit_occurrence_id, visit_detail_id, 
-                    measurement_source_value, measurement_source_concept_id, 
-                    unit_source_value, value_source_value
-                FROM  read_csv('FILENAME', delim=',', header=True)
-               """,
-        'table_name': "measurement",
-        'pk_query': """
-                SELECT count(*) as row_ct, count(measurement_id) as p_id, count(distinct measurement_id) as d_p_id
-                FROM measurement
-                """
-    }
-}
-
-
-def _apply_local_ddl():
+def connect(database_file=None):
+    """ Returns a DuckDB connection, to the database_file or in memory if None.
+        The functions here all take the connection, so the DDL, the load and the
+        checks can share one, as with omop/duckdb_sink.py.
+    """
+    if database_file is None:
+        return duckdb.connect()
+    return duckdb.connect(database_file)
+
+
+MANIFEST_DDL = """
+    CREATE TABLE IF NOT EXISTS omop_load_manifest (
+        file varchar NOT NULL,
+        domain varchar NOT NULL,
+        content_hash varchar NOT NULL,
+        row_count bigint NOT NULL,
+        loaded_at timestamp NOT NULL
+    );
+"""
+
+# the column of each loaded OMOP table that has the file a row was loaded from
+LOAD_FILE_COLUMN = "omop_load_file"
+
+
+def create_omop_tables(conn):
+    _apply_ddl(conn, "OMOPCDM_duckdb_5.3_ddl_with_constraints.sql")
+
+
+def create_omop_indices(conn):
+    _apply_ddl(conn, "OMOPCDM_duckdb_5.3_indices.sql")
+
+
+def _omop_tables_exist(conn):
+    return conn.execute("SELECT count(*) FROM duckdb_tables() WHERE table_name = 'person'").fetchone()[0] > 0
+
+
+def _omop_indices_exist(conn):
+    return conn.execute("SELECT count(*) FROM duckdb_indexes()").fetchone()[0] > 0
+
+
+def _add_load_file_columns(conn):
+    """ Adds LOAD_FILE_COLUMN to the domains' tables that don't have it yet. """
+    for table_name in omop_schema.domain_table_names.values():
+        has_column = conn.execute("SELECT count(*) FROM duckdb_columns() WHERE table_name = ? AND column_name = ?",
+                                  [table_name, LOAD_FILE_COLUMN]).fetchone()[0] > 0
+        if not has_column:
+            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {LOAD_FILE_COLUMN} varchar")
+
+
+def setup_database(conn):
+    """ Creates the OMOP tables, unless the database has them from an earlier run,
+        and the load manifest.
+    """
+    if _omop_tables_exist(conn):
+        print("OMOP tables exist, skipping the DDL")
+    else:
+        create_omop_tables(conn)
+    _add_load_file_columns(conn)
+    conn.execute(MANIFEST_DDL)
+
+
+def create_omop_indices_once(conn):
+    if _omop_indices_exist(conn):
+        print("OMOP indices exist, skipping them")
+    else:
+        create_omop_indices(conn)
+
+
+def _apply_local_ddl(conn):
     x=conn.execute(person_ddl)
     x=conn.execute(visit_ddl)
     x=conn.execute(measurement_ddl)
@@ -104,7 +117,7 @@ def _apply_local_ddl():
     print(df[['database', 'schema', 'name']])
 
 
-def _apply_ddl(ddl_file):
+def _apply_ddl(conn, ddl_file):
     print(f"Applying DDL file {ddl_file}")
     with io.open(OMOP_CDM_DIR +  ddl_file, "r") as ddl_file:
         ddl_statements = ddl_file.read()
@@ -118,81 +131,201 @@ def _apply_ddl(ddl_file):
     print(df[['database', 'schema', 'name']])
 
 
-def _import_CSVs(domain):
+def _domain_files(domain, data_format):
+    """ The files layer_datasets wrote for the domain: a CSV per document, leaving
+        out empty ones, or the Parquet parts of the domain's table.
+    """
+    if data_format == 'parquet':
+        return sorted(glob.glob(os.path.join(OMOP_PARQUET_DATA_DIR,
+                                             omop_schema.domain_table_names[domain], "part-*.parquet")))
+    files = glob.glob(os.path.join(OMOP_CSV_DATA_DIR, f"*__{domain}.csv"))
+    return sorted(f for f in files if os.stat(f).st_size > 2)
+
+
+def _file_hash(data_file):
+    content_hash = hashlib.sha256()
+    with open(data_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def _read_files_sql(files, data_format):
+    """ A read_csv or read_parquet over all the files, matching columns by name,
+        since a document's CSV may lack a column another has. Each row gets the
+        file it came from in a filename column.
+    """
+    file_list = "[" + ", ".join("'" + f.replace("'", "''") + "'" for f in files) + "]"
+    if data_format == 'parquet':
+        return f"read_parquet({file_list}, union_by_name=true, filename=true)"
+    return f"read_csv({file_list}, delim=',', header=true, union_by_name=true, filename=true)"
+
+
+def _insert_column_names(conn, domain, staged_table):
+    """ The domain's columns in metadata 'order', that are both in its OMOP table and
+        in the files being read.
+    """
+    output_order = DDP.get_domain_plan(domain, get_meta_dict()[domain])['output_order']
+    table_columns = omop_schema.get_domain_columns(domain)
+    file_columns = set(row[0] for row in conn.execute(f"DESCRIBE {staged_table}").fetchall())
+    return [column_name for column_name in output_order
+            if column_name in table_columns and column_name in file_columns]
+
+
+def _insert_files(conn, domain, files, data_format, file_hashes):
+    """ Loads the files into the domain's table in one transaction, each row with
+        its file, and their manifest rows. Returns the number of rows loaded.
+    """
+    table_name = omop_schema.domain_table_names[domain]
+    staged_table = f"omop_staged_{table_name}"
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        conn.execute(f"CREATE OR REPLACE TEMP TABLE {staged_table} AS SELECT * FROM {_read_files_sql(files, data_format)}")
+        column_list = ", ".join(_insert_column_names(conn, domain, staged_table))
+        conn.execute(f"INSERT INTO {table_name} ({column_list}, {LOAD_FILE_COLUMN}) "
+                     f"SELECT {column_list}, filename FROM {staged_table}")
+        file_rows = dict(conn.execute(f"SELECT filename, count(*) FROM {staged_table} GROUP BY filename").fetchall())
+        conn.executemany("INSERT INTO omop_load_manifest VALUES (?, ?, ?, ?, now())",
+                         [(f, domain, file_hashes[f], file_rows.get(f, 0)) for f in files])
+        conn.execute(f"DROP TABLE {staged_table}")
+        conn.execute("COMMIT")
+    except duckdb.Error:
+        conn.execute("ROLLBACK")
+        raise
+    return sum(file_rows.values())
+
+
+def _unload_files(conn, domain, files):
+    """ Deletes the rows loaded from the files, and their manifest rows, so changed
+        files can be loaded again. Rows of other files with the same primary key
+        are kept.
+    """
+    table_name = omop_schema.domain_table_names[domain]
+    file_list = "(SELECT unnest(?::VARCHAR[]))"
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        conn.execute(f"DELETE FROM {table_name} WHERE {LOAD_FILE_COLUMN} IN {file_list}", [files])
+        conn.execute(f"DELETE FROM omop_load_manifest WHERE domain = ? AND file IN {file_list}", [domain, files])
+        conn.execute("COMMIT")
+    except duckdb.Error:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def load_domain(conn, domain, data_format='csv'):
+    """ Loads the domain's files, CSV or Parquet, into its OMOP table with one
+        INSERT ... SELECT over a read of the whole list. If that fails, on a
+        constraint say, the files are loaded one at a time so only the failing
+        ones are left out. Files the manifest has with the same hash are skipped,
+        and the rows of files with a new hash are deleted before loading them
+        again. Returns the number of rows loaded. A file that fails to load sets
+        processing_status to False.
+    """
+    global processing_status
     print(f"Importing domain {domain} data")
-    files = [f for f in os.listdir(OMOP_CSV_DATA_DIR) if os.path.isfile(os.path.join(OMOP_CSV_DATA_DIR, f)) ]
-    files = [f for f in files if  re.match('.*' + f"{domain}" + '.csv',f) ]
-    for csv_filename in files:
+    files = _domain_files(domain, data_format)
+    if len(files) == 0:
+        logger.warning(f"No {data_format} files for {domain}")
+        return 0
+
+    file_hashes = {data_file: _file_hash(data_file) for data_file in files}
+    loaded_hashes = dict(conn.execute("SELECT file, content_hash FROM omop_load_manifest WHERE domain = ?",
+                                      [domain]).fetchall())
+    changed_files = [f for f in files if f in loaded_hashes and loaded_hashes[f] != file_hashes[f]]
+    files = [f for f in files if loaded_hashes.get(f) != file_hashes[f]]
+    logger.info(f"{domain}: {len(file_hashes) - len(files)} files unchanged, "
+                f"{len(changed_files)} changed, {len(files) - len(changed_files)} new")
+    if len(changed_files) > 0:
+        _unload_files(conn, domain, changed_files)
+    if len(files) == 0:
+        return 0
+
+    try:
+        row_count = _insert_files(conn, domain, files, data_format, file_hashes)
+        logger.info(f"Loaded {row_count} {domain} rows from {len(files)} files")
+        return row_count
+    except duckdb.Error as e:
+        logger.warning(f"Failed to load {domain} from all {len(files)} files at once, loading one at a time: {e}")
+
+    row_count = 0
+    for data_file in files:
         try:
-            sql_string = sql_import_dict[domain]['sql']
-            table_name = sql_import_dict[domain]['table_name']
-            sql_string = sql_string.replace('FILENAME', OMOP_CSV_DATA_DIR + csv_filename)
-            sql_string = sql_string.replace('TABLENAME', table_name)
-            # How to check for empty file?
-            if os.stat("output/" + csv_filename).st_size > 2:
-                output_path = f"output/{csv_filename}"
-                # print(f"loading file {csv_filename}  {output_path}  size:{os.stat(output_path).st_size}")
-                try:
-                    x=conn.execute(sql_string)
-                    logger.info(f"Loaded {domain} from {csv_filename}")
-                except Exception as e:
-                    processing_status = False
-                    print(f"Failed to load {domain} from {csv_filename}")
-                    logger.error(f"Failed to load {domain} from {csv_filename}")
-                    logger.error(e)
-                #print(x.df())
-            #else:
-                #print(f"skipping small size file {csv_filename}")
-        except duckdb.BinderException as e:
-            logger.error(f"Failed to read {csv_filename} {type(e)} {e}")
-
-
-def check_PK(domain):
+            row_count += _insert_files(conn, domain, [data_file], data_format, file_hashes)
+            logger.info(f"Loaded {domain} from {data_file}")
+        except duckdb.Error as e:
+            processing_status = False
+            print(f"Failed to load {domain} from {data_file}")
+            logger.error(f"Failed to load {domain} from {data_file}")
+            logger.error(e)
+    return row_count
+
+
+def load_domains(conn, domain_list, data_format='csv'):
+    """ Loads the domains concurrently, each on its own cursor of the connection,
+        since their tables are independent. Returns {domain: rows loaded}.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(domain_list)) as executor:
+        futures = {domain: executor.submit(load_domain, conn.cursor(), domain, data_format)
+                   for domain in domain_list}
+        return {domain: future.result() for (domain, future) in futures.items()}
+
+
+def check_PK(conn, domain):
+    """ Checks the domain's table for null and duplicate primary keys, with one
+        aggregate query. Either sets processing_status to False.
+    """
+    global processing_status
     print(f"Checking PK on domain {domain} ")
-    table_name = sql_import_dict[domain]['table_name']
-    pk_query = sql_import_dict[domain]['pk_query']
-    table_name = sql_import_dict[domain]['table_name']
-    df=conn.sql(f"SELECT * from  {table_name}").df()
-    df=conn.sql(pk_query).df()
-    if df['row_ct'][0] != df['p_id'][0]:
+    table_name = omop_schema.domain_table_names[domain]
+    pk_column = omop_schema.load_primary_keys()[table_name]
+    (row_ct, p_id, d_p_id) = conn.execute(f"""
+                SELECT count(*) as row_ct, count({pk_column}) as p_id,
+                            count(distinct {pk_column}) as d_p_id
+                FROM {table_name}
+                """).fetchone()
+    if row_ct != p_id:
         logger.error("row count not the same as id count, null IDs?")
         processing_status = False
-    if df['p_id'][0] != df['d_p_id'][0]:
+    if p_id != d_p_id:
         logger.error("id count not the same as distinct ID count, non-unique IDs?")
+        processing_status = False
 
 
 
 def main():
-    print("\nDDL")
-    #_apply_ddl("OMOPCDM_duckdb_5.3_ddl.sql")
-    _apply_ddl("OMOPCDM_duckdb_5.3_ddl_with_constraints.sql")
+    parser = argparse.ArgumentParser(
+        prog='OMOP DuckDB load',
+        description="loads the output of layer_datasets into the OMOP tables")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help="load the CSVs in output/, or the Parquet parts in output/parquet/")
+    parser.add_argument('--database-file', default=None,
+                        help="DuckDB file to keep the tables in and load into incrementally, in memory if not given")
+    args = parser.parse_args()
 
-    print("\nPERSON")
-    _import_CSVs('Person')
-    check_PK('Person')
+    configure_logging(logging.INFO, "logs/load_omop.log")
+    conn = connect(args.database_file)
 
-    print("\nVISIT")
-    _import_CSVs('Visit')
-    check_PK('Visit')
-
-    print("\nMEASUREMENT")
-    _import_CSVs('Measurement')
-    check_PK('Measurement')
+    print("\nDDL")
+    #_apply_ddl(conn, "OMOPCDM_duckdb_5.3_ddl.sql")
+    setup_database(conn)
 
-    #print("\nOBSERVATION")
-    #_import_CSVs('Observation')
-    #check_PK('Observation')
+    print("\nLOAD")
+    domain_list = list(omop_schema.domain_table_names)
+    row_counts = load_domains(conn, domain_list, args.format)
+    print(f"Loaded rows: {row_counts}")
+    for domain in domain_list:
+        check_PK(conn, domain)
 
     # not implemented in ALTER TABLE yet in v1.0
     # https://github.com/OHDSI/CommonDataModel/issues/713
-##    _apply_ddl("OMOPCDM_duckdb_5.3_primary_keys.sql")
-##    _apply_ddl("OMOPCDM_duckdb_5.3_constraints.sql")
+##    _apply_ddl(conn, "OMOPCDM_duckdb_5.3_primary_keys.sql")
+##    _apply_ddl(conn, "OMOPCDM_duckdb_5.3_constraints.sql")
 
     print("\nINDICES")
-    _apply_ddl("OMOPCDM_duckdb_5.3_indices.sql")
+    create_omop_indices_once(conn)
 
     print("\nSQL CHECKS")
-    check_PK('Person')
+    check_PK(conn, 'Person')
 
     if False:
         df = conn.sql("SHOW ALL TABLES;").df()
@@ -202,7 +335,7 @@ def main():
         df = conn.sql("SHOW TABLES;").df()
         print('"' + df['name'] + '"')
 
-    exit(processing_status)
+    exit(0 if processing_status else 1)
 
 if __name__ == '__main__':
     main()
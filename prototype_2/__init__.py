@@ -1,16 +1,8 @@
-
-
-import logging
-import sys
-
-
-print("***** MAIN INIT ******")
-
-logging.basicConfig(
-    stream=sys.stdout,
-    format='%(levelname)s: %(message)s',
-    # level=logging.ERROR
-    level=logging.WARNING
-    # level=logging.INFO
-    # level=logging.DEBUG
-)
+""" prototype_2: data-driven parsing of CCDA documents into OMOP
+
+    Importing the package does nothing else. Logging is configured by each entry
+    point, with logging_config.configure_logging(), and heavy dependencies like
+    pandas, numpy and the concept map are loaded where they're first used, so a
+    short run, or one that doesn't need them, doesn't pay for them. Check with
+    python -m prototype_2.import_budget.
+"""
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+""" Benchmark for the CCDA -> OMOP pipeline
+
+    Times data_driven_parse.parse_doc, or layer_datasets.process_file which adds the
+    DataFrames, over the sample documents in resources/, or over a synthetic corpus
+    made from them with generate_corpus(). Nothing is written to output/: the
+    corpus goes to a temporary directory, unless --corpus-dir is given, and
+    process_file doesn't write its CSVs.
+
+    Reports documents/sec, rows/sec per domain, p50/p99 per-document latency and
+    peak RSS, and can save them as JSON with the git commit, to compare against a
+    run from another commit with --compare.
+
+    From the directory above prototype_2:
+    - python -m prototype_2.benchmark -d resources
+    - python -m prototype_2.benchmark -d resources -n 2000 --corpus-dir /tmp/ccda_corpus -o logs/bench.json
+    - python -m prototype_2.benchmark -d resources --mode process_file --compare logs/bench.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from lxml import etree as ET
+
+import prototype_2.data_driven_parse as DDP
+from prototype_2.logging_config import configure_logging
+from prototype_2.metadata import get_meta_dict
+
+logger = logging.getLogger(__name__)
+
+
+def generate_corpus(source_file_list, n_documents, corpus_dir, seed=0):
+    """ Writes n_documents copies of the source files, round robin, to corpus_dir.
+        Each copy gets its own patient id, encounter id and entry ids, and its
+        numeric result values jittered, so hashed IDs and values vary across the
+        corpus the way they would across real patients. Returns the list of paths.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    random_generator = random.Random(seed)
+    source_trees = [(os.path.basename(source_file), ET.parse(source_file)) for source_file in source_file_list]
+
+    corpus_file_list = []
+    for document_number in range(n_documents):
+        (base_name, source_tree) = source_trees[document_number % len(source_trees)]
+        document = ET.fromstring(ET.tostring(source_tree))
+        suffix = f"{document_number:07d}"
+
+        for id_element in document.iterfind('./hl7:recordTarget/hl7:patientRole/hl7:id', DDP.xpath_ns):
+            id_element.set('extension', id_element.get('extension', 'patient') + suffix)
+        for id_element in document.iterfind('./hl7:componentOf/hl7:encompassingEncounter/hl7:id', DDP.xpath_ns):
+            id_element.set('extension', id_element.get('extension', 'encounter') + suffix)
+        for id_element in document.iterfind('.//hl7:entry//hl7:id', DDP.xpath_ns):
+            id_element.set('root', id_element.get('root', 'entry') + '.' + suffix)
+        for value_element in document.iterfind('.//hl7:entry//hl7:value[@value]', DDP.xpath_ns):
+            try:
+                value = float(value_element.get('value'))
+            except ValueError:
+                continue
+            value_element.set('value', f"{value * random_generator.uniform(0.8, 1.2):.2f}")
+
+        corpus_file = os.path.join(corpus_dir, f"synthetic_{suffix}_{base_name}")
+        ET.ElementTree(document).write(corpus_file, xml_declaration=True, encoding='UTF-8')
+        corpus_file_list.append(corpus_file)
+
+    return corpus_file_list
+
+
+def _parse_doc_rows(file_path):
+    omop_dict = DDP.parse_doc(file_path, get_meta_dict())
+    return {domain: len(domain_list) for (domain, domain_list) in omop_dict.items()
+            if domain_list is not None}
+
+
+def _process_file_rows(file_path):
+    import prototype_2.layer_datasets as LD
+    dataframe_dict = LD.process_file(file_path, write_csv=False)
+    return {domain: len(domain_df) for (domain, domain_df) in dataframe_dict.items()
+            if domain_df is not None}
+
+
+benchmark_modes = {
+    'parse_doc': _parse_doc_rows,
+    'process_file': _process_file_rows
+}
+
+
+def _percentile(sorted_values, percent):
+    """ nearest-rank percentile of an already sorted list """
+    if len(sorted_values) == 0:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(file_list, mode='parse_doc', warmup=1):
+    """ Runs the mode's function over each file and returns the results as a dict.
+        The first warmup files are run once beforehand, untimed, so one-time work
+        like compiling the metadata isn't charged to the first document.
+    """
+    run_function = benchmark_modes[mode]
+    for file_path in file_list[:warmup]:
+        run_function(file_path)
+
+    latencies = []
+    domain_rows = {}
+    failed_files = []
+    start_time = time.perf_counter()
+    for file_path in file_list:
+        document_start = time.perf_counter()
+        try:
+            row_counts = run_function(file_path)
+        except Exception as e:
+            logger.error(f"BENCHMARK {file_path} failed: {e}")
+            failed_files.append(file_path)
+            continue
+        latencies.append(time.perf_counter() - document_start)
+        for domain, row_count in row_counts.items():
+            domain_rows[domain] = domain_rows.get(domain, 0) + row_count
+    elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    return {
+        'commit': _git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'mode': mode,
+        'documents': len(latencies),
+        'failed_documents': len(failed_files),
+        'elapsed_sec': elapsed,
+        'docs_per_sec': len(latencies) / elapsed if elapsed > 0 else None,
+        'rows': domain_rows,
+        'rows_per_sec': {domain: rows / elapsed for (domain, rows) in domain_rows.items()} if elapsed > 0 else {},
+        'latency_p50_ms': _percentile(latencies, 50) * 1000 if latencies else None,
+        'latency_p99_ms': _percentile(latencies, 99) * 1000 if latencies else None,
+        # ru_maxrss is KB on Linux, bytes on macOS
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                       (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    }
+
+
+def _format_number(value):
+    """ value to 2 places, or n/a for None, as when no document parsed """
+    if value is None:
+        return f"{'n/a':>10}"
+    return f"{value:10.2f}"
+
+
+def print_results(results, baseline=None):
+    print(f"mode {results['mode']}  commit {results['commit']}")
+    print(f"documents {results['documents']}  failed {results['failed_documents']}"
+          f"  elapsed {results['elapsed_sec']:.2f}s")
+    for key in ['docs_per_sec', 'latency_p50_ms', 'latency_p99_ms', 'peak_rss_mb']:
+        line = f"  {key:16} {_format_number(results.get(key))}"
+        if baseline is not None and key in baseline:
+            line += f"   was {_format_number(baseline[key])}"
+            if results.get(key) is not None and baseline[key]:
+                line += f"  ({results[key] / baseline[key]:.2f}x)"
+        print(line)
+    for domain, rows_per_sec in results['rows_per_sec'].items():
+        print(f"  rows/sec {domain:12} {rows_per_sec:10.1f}  ({results['rows'][domain]} rows)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='CCDA - OMOP benchmark',
+        description="times the parse over sample or synthetic CCDA documents")
+    parser.add_argument('-d', '--directory', default='resources', help="directory of sample files")
+    parser.add_argument('-n', '--documents', type=int,
+                        help="generate a synthetic corpus of this many documents from the samples")
+    parser.add_argument('--corpus-dir',
+                        help="where the synthetic corpus is written and kept, a temporary directory by default")
+    parser.add_argument('--mode', choices=sorted(benchmark_modes), default='parse_doc')
+    parser.add_argument('--warmup', type=int, default=1, help="untimed documents run first")
+    parser.add_argument('-o', '--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON results from an earlier run to compare against")
+    parser.add_argument('--prefetch-concepts', action='store_true',
+                        help="look up each batch of root elements' codes at once, before parsing the rows")
+    args = parser.parse_args()
+
+    os.makedirs("logs", exist_ok=True)
+    configure_logging(logging.WARNING, "logs/benchmark.log")
+    DDP.enable_concept_prefetch(args.prefetch_concepts)
+
+    file_list = sorted(os.path.join(args.directory, f) for f in os.listdir(args.directory)
+                       if f.endswith(".xml"))
+    temporary_dir = None
+    if args.documents is not None:
+        corpus_dir = args.corpus_dir
+        if corpus_dir is None:
+            temporary_dir = tempfile.mkdtemp(prefix="ccda_benchmark_")
+            corpus_dir = temporary_dir
+        file_list = generate_corpus(file_list, args.documents, corpus_dir)
+
+    try:
+        results = run_benchmark(file_list, args.mode, args.warmup)
+    finally:
+        if temporary_dir is not None:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+    results['source_directory'] = args.directory
+    results['synthetic_documents'] = args.documents
+    results['prefetch_concepts'] = args.prefetch_concepts
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,12 +26,17 @@ import argparse
 import datetime
 import logging
 import os
+import re
 import sys
-import hashlib
 import zlib
 import ctypes
 from lxml import etree as ET
 from prototype_2.metadata import get_meta_dict
+import prototype_2.id_hashing as id_hashing
+import prototype_2.field_metrics as field_metrics
+import prototype_2.phase_timing as phase_timing
+from prototype_2.value_transformations import concept_mapping_functions, prefetch_concepts
+from prototype_2.logging_config import configure_logging, log_context, set_log_context
 
 logger = logging.getLogger(__name__)
 
@@ -43,11 +48,127 @@ ns = {
    'sdtc': 'urn:hl7-org:sdtc'
 }
 
+# XPath 1.0 has no default namespace, so compiled paths put the hl7 prefix on
+# element names that don't have one.
+xpath_ns = {prefix: uri for (prefix, uri) in ns.items() if prefix != ''}
+_prefix_for_uri = {uri: prefix for (prefix, uri) in xpath_ns.items()}
+
 #from foundry.transforms import Dataset
 #concept_xwalk = Dataset.get("concept_xwalk")
 #concept_xwalk_files = concept_xwalk.files().download()
 
 
+# Same token split as ElementPath's tokenizer: operators and quoted strings, or names.
+_path_token_re = re.compile(
+    r"('[^']*'|\"[^\"]*\"|::|//?|\.\.|\(\)|[/.*:\[\]\(\)@=])"
+    r"|((?:\{[^}]+\})?[^/\[\]\(\)@=\s]+)"
+    r"|\s+")
+
+
+def _qualify_name(name):
+    """ Turns an ElementPath name, possibly in {uri}local form, into a prefixed XPath name. """
+    if name.startswith('{'):
+        (uri, local_name) = name[1:].split('}', 1)
+        if uri not in _prefix_for_uri:
+            raise ValueError(f"no prefix in ns for namespace {uri}")
+        return _prefix_for_uri[uri] + ':' + local_name
+    return name
+
+
+def elementpath_to_xpath(path):
+    """ Translates the ElementPath subset used in the metadata into XPath 1.0 that
+        evaluates the same way with xpath_ns: unprefixed element names go in the
+        hl7 (default) namespace, and {uri} names use the prefix for that uri.
+        Raises ValueError for anything it doesn't know how to translate.
+    """
+    xpath_parts = []
+    previous_token = None
+    tokens = list(_path_token_re.finditer(path))
+    if ''.join(token.group(0) for token in tokens) != path:
+        raise ValueError(f"could not tokenize path {path}")
+
+    for index, token in enumerate(tokens):
+        (operator, name) = token.groups()
+        if name is None:
+            xpath_parts.append(token.group(0))
+            if operator is not None:
+                previous_token = operator
+            continue
+
+        next_token = tokens[index + 1].group(1) if index + 1 < len(tokens) else None
+        if previous_token == '@':
+            xpath_parts.append(_qualify_name(name))
+        elif name[0].isdigit() or next_token in ('()', '('):
+            xpath_parts.append(name)
+        elif name.startswith('{'):
+            xpath_parts.append(_qualify_name(name))
+        elif ':' in name:
+            xpath_parts.append(name)
+        else:
+            xpath_parts.append('hl7:' + name)
+        previous_token = name
+
+    return ''.join(xpath_parts)
+
+
+_compiled_paths = {}
+
+
+def compile_path(path):
+    """ Returns a callable that takes an element (or ElementTree) and returns the list
+        of elements the ElementPath path selects from it. Paths are compiled into
+        etree.XPath objects once per process and shared. A path that can't be
+        translated falls back to findall() with the path string.
+
+        XPath selects each element once, in document order. For paths that step
+        up with '..', findall() would select an element once for each way the path
+        reaches it, as when a section has the same templateId twice, and give a
+        row for each, with the same hashed IDs.
+    """
+    compiled_path = _compiled_paths.get(path)
+    if compiled_path is not None:
+        return compiled_path
+
+    try:
+        xpath = ET.XPath(elementpath_to_xpath(path), namespaces=xpath_ns)
+
+        def compiled_path(element):
+            if isinstance(element, ET._ElementTree):
+                element = element.getroot()
+            return xpath(element)
+    except (ValueError, ET.XPathSyntaxError) as e:
+        logger.warning(f"PATH {path} not compiled to XPath, using findall(): {e}")
+
+        def compiled_path(element):
+            return element.findall(path, ns)
+
+    _compiled_paths[path] = compiled_path
+    return compiled_path
+
+
+def find_first(path, element):
+    """ find() on a compiled path: the first element selected, or None """
+    found_elements = compile_path(path)(element)
+    if len(found_elements) > 0:
+        return found_elements[0]
+    return None
+
+
+def find_first_cached(path, element, element_cache):
+    """ find_first() that keeps what it found, or None, in element_cache, a dict
+        keyed by path for this one element. Fields that read different attributes
+        of the same element, like code and codeSystem, then find it once per root.
+    """
+    if element_cache is None:
+        return find_first(path, element)
+    try:
+        return element_cache[path]
+    except KeyError:
+        found_element = find_first(path, element)
+        element_cache[path] = found_element
+        return found_element
+
+
 
 def cast_to_date(string_value):
     # TODO does CCDA always do dates as YYYYMMDD ?
@@ -79,104 +200,111 @@ def parse_field_from_dict(field_details_dict, domain_root_element, domain, field
         the domain_root_element.
         Domain and field_tag are here for error messages.
     """
+    return _parse_field(field_details_dict, domain_root_element, domain, field_tag, root_path)[0]
+
+
+def _parse_field(field_details_dict, domain_root_element, domain, field_tag, root_path, element_cache=None):
+    """ parse_field_from_dict() that returns (value, outcome), the outcome for
+        field_metrics: found, missing_element or missing_attribute.
+        element_cache, if given, is the root element's, see find_first_cached().
+    """
 
     if 'element' not in field_details_dict:
-        logger.error(("FIELD could find key 'element' in the field_details_dict:"
-                     f" {field_details_dict} root:{root_path}"))
-        return None
+        logger.error("FIELD could find key 'element' in the field_details_dict: %s root:%s",
+                     field_details_dict, root_path)
+        return (None, 'missing_element')
 
-    logger.info(f"    FIELD {field_details_dict['element']} for {domain}/{field_tag}")
-    field_element = domain_root_element.find(field_details_dict['element'], ns)
+    logger.info("    FIELD %s for %s/%s", field_details_dict['element'], domain, field_tag)
+    field_element = find_first_cached(field_details_dict['element'], domain_root_element, element_cache)
     if field_element is None:
-        logger.error((f"FIELD could not find field element {field_details_dict['element']}"
-                      f" for {domain}/{field_tag} root:{root_path}"))
-        return None
+        logger.error("FIELD could not find field element %s for %s/%s root:%s",
+                     field_details_dict['element'], domain, field_tag, root_path)
+        return (None, 'missing_element')
 
     if 'attribute' not in field_details_dict:
-        logger.error((f"FIELD could not find key 'attribute' in the field_details_dict:"
-                     f" {field_details_dict} root:{root_path}"))
-        return None
+        logger.error("FIELD could not find key 'attribute' in the field_details_dict: %s root:%s",
+                     field_details_dict, root_path)
+        return (None, 'missing_attribute')
 
-    logger.info((f"       ATTRIBUTE   {field_details_dict['attribute']} "
-                 f"for {domain}/{field_tag} {field_details_dict['element']} "))
+    logger.info("       ATTRIBUTE   %s for %s/%s %s ",
+                field_details_dict['attribute'], domain, field_tag, field_details_dict['element'])
     attribute_value = field_element.get(field_details_dict['attribute'])
     if field_details_dict['attribute'] == "#text":
         attribute_value = field_element.text
     if attribute_value is None:
-        logger.warning((f"no value for field element {field_details_dict['element']} "
-                        f"for {domain}/{field_tag} root:{root_path}"))
+        logger.warning("no value for field element %s for %s/%s root:%s",
+                       field_details_dict['element'], domain, field_tag, root_path)
+        return (None, 'missing_attribute')
 
     # Do data-type conversions
     if 'data_type' in field_details_dict:
-        if attribute_value is not None:
-            if field_details_dict['data_type'] == 'DATE':
-                attribute_value = cast_to_date(attribute_value)
-            if field_details_dict['data_type'] == 'DATETIME':
-                attribute_value = cast_to_datetime(attribute_value)
-            if field_details_dict['data_type'] == 'INTEGER':
-                    attribute_value = int(attribute_value)
-            if field_details_dict['data_type'] == '32BINTEGER':
-                    attribute_value = ctypes.c_int32(int(attribute_value)).value
-            if field_details_dict['data_type'] == 'INTEGERHASH':
-                # for DuckDB (RDB int type), we need a 32-bit  signed integer from almost anything. This may not be as unique as we need TODO FIX
-                # attribute_value = ctypes.c_int32(hash(attribute_value)).value # NOT STABLE!
-                hash_value = hashlib.sha256(attribute_value.encode('utf-8')).hexdigest()
-                #attribute_value = int(hash_value, 16) % 10**8 # 8 digiti decimal
-                attribute_value = int(hash_value, 16) % 2**31 # signed 4 byte int
-            if field_details_dict['data_type'] == 'FLOAT':
-                attribute_value = float(attribute_value)
-            return attribute_value
-        else:
-            return None
-    else:
-        return attribute_value
-
-
-def do_none_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set):
-    for (field_tag, field_details_dict) in domain_meta_dict.items():
-        logger.info((f"     NONE FIELD domain:'{domain}' field_tag:'{field_tag}'"
-                     f" {field_details_dict}"))
-        config_type_tag = field_details_dict['config_type']
-        if config_type_tag is None:
-            output_dict[field_tag] = (None, '(None type)')
-
-
-def do_constant_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set):
-    for (field_tag, field_details_dict) in domain_meta_dict.items():
-        logger.info((f"     CONSTANT FIELD domain:'{domain}' field_tag:'{field_tag}'"
-                     f" {field_details_dict}"))
-        config_type_tag = field_details_dict['config_type']
-        if config_type_tag == 'CONSTANT':
-            constant_value = field_details_dict['constant_value']
-            output_dict[field_tag] = (constant_value, '(None type)')
-
-
-def do_basic_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set, pk_dict):
-    for (field_tag, field_details_dict) in domain_meta_dict.items():
-        logger.info((f"     FIELD domain:'{domain}' field_tag:'{field_tag}'"
-                     f" {field_details_dict}"))
+        if field_details_dict['data_type'] == 'DATE':
+            attribute_value = cast_to_date(attribute_value)
+        if field_details_dict['data_type'] == 'DATETIME':
+            attribute_value = cast_to_datetime(attribute_value)
+        if field_details_dict['data_type'] == 'INTEGER':
+                attribute_value = int(attribute_value)
+        if field_details_dict['data_type'] == '32BINTEGER':
+                attribute_value = ctypes.c_int32(int(attribute_value)).value
+        if field_details_dict['data_type'] in ('INTEGERHASH', 'BIGINTHASH'):
+            # for DuckDB (RDB int type), we need an integer from almost anything, see id_hashing
+            # attribute_value = ctypes.c_int32(hash(attribute_value)).value # NOT STABLE!
+            attribute_value = id_hashing.hash_id(attribute_value, field_details_dict['data_type'])
+        if field_details_dict['data_type'] == 'FLOAT':
+            attribute_value = float(attribute_value)
+    return (attribute_value, 'found')
+
+
+def do_none_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set):
+    for field_tag in domain_plan['none_fields']:
+        output_dict[field_tag] = (None, '(None type)')
+
+
+def do_constant_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set):
+    for (field_tag, field_details_dict) in domain_plan['constant_fields']:
+        logger.info("     CONSTANT FIELD domain:'%s' field_tag:'%s' %s",
+                    domain, field_tag, field_details_dict)
+        constant_value = field_details_dict['constant_value']
+        output_dict[field_tag] = (constant_value, '(None type)')
+        field_metrics.count(domain, field_tag, 'found')
+
+
+def _do_field(output_dict, root_element, root_path, domain, field_tag, field_details_dict, element_cache=None):
+    (attribute_value, outcome) = _parse_field(field_details_dict, root_element,
+                                              domain, field_tag, root_path, element_cache)
+    field_metrics.count(domain, field_tag, outcome)
+    output_dict[field_tag] = (attribute_value, root_path + "/" +
+                              field_details_dict['element'] + "/@" +
+                              field_details_dict['attribute'])
+    logger.info("     FIELD for %s/%s \"%s\"", domain, field_tag, attribute_value)
+
+
+def do_basic_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set, pk_dict,
+                    element_cache=None):
+    for (field_tag, field_details_dict) in domain_plan['basic_fields']:
+        logger.info("     FIELD domain:'%s' field_tag:'%s' %s",
+                    domain, field_tag, field_details_dict)
         type_tag = field_details_dict['config_type']
         if type_tag == 'FIELD':
-            attribute_value = parse_field_from_dict(field_details_dict, root_element,
-                                                    domain, field_tag, root_path)
-            output_dict[field_tag] = (attribute_value, root_path + "/" +
-                                      field_details_dict['element'] + "/@" +
-                                      field_details_dict['attribute'])
-            logger.info(f"     FIELD for {domain}/{field_tag} \"{attribute_value}\"")
+            _do_field(output_dict, root_element, root_path, domain, field_tag, field_details_dict,
+                      element_cache)
         elif type_tag == 'PK':
-            logger.info(f"     PK for {domain}/{field_tag}")
-            attribute_value = parse_field_from_dict(field_details_dict, root_element,
-                                                    domain, field_tag, root_path)
+            logger.info("     PK for %s/%s", domain, field_tag)
+            (attribute_value, outcome) = _parse_field(field_details_dict, root_element,
+                                                      domain, field_tag, root_path, element_cache)
+            field_metrics.count(domain, field_tag, outcome)
             output_dict[field_tag] = (attribute_value, root_path + "/" +
                                       field_details_dict['element'] + "/@" +
                                       field_details_dict['attribute'])
             pk_dict[field_tag] = attribute_value
         elif type_tag == 'FK':
-            logger.info(f"     FK for {domain}/{field_tag}")
+            logger.info("     FK for %s/%s", domain, field_tag)
             if field_tag in pk_dict:
                 output_dict[field_tag] = (pk_dict[field_tag], 'FK')
+                field_metrics.count(domain, field_tag, 'found')
             else:
-                logger.error(f"FK could not find {field_tag}  in pk_dict for {domain}/{field_tag}")
+                field_metrics.count(domain, field_tag, 'missing_fk')
+                logger.error("FK could not find %s  in pk_dict for %s/%s", field_tag, domain, field_tag)
                 path = root_path + "/"
                 if 'element' in field_details_dict:
                     path = path + field_details_dict['element'] + "/@"
@@ -190,127 +318,185 @@ def do_basic_fields(output_dict, root_element, root_path, domain,  domain_meta_d
                 error_fields_set.add(field_tag)
 
 
-def do_derived_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set):
-    # Do derived values now that their inputs should be available in the output_dict
-    # Except for a special argument named 'default', when the value is what is other wise the field to look up in the output dict.
-    for (field_tag, field_details_dict) in domain_meta_dict.items():
-        if field_details_dict['config_type'] == 'DERIVED':
-            logger.info(f"     DERIVING {field_tag}, {field_details_dict}")
-            # NB Using an explicit dict here instead of kwargs because this code here
-            # doesn't know what the keywords are at 'compile' time.
-            args_dict = {}
-            for arg_name, field_name in field_details_dict['argument_names'].items():
-                if arg_name == 'default':
-                        args_dict[arg_name] = field_name
-                else:
-                    logger.info(f"     -- {field_tag}, arg_name:{arg_name} field_name:{field_name}")
-                    if field_name not in output_dict:
-                        error_fields_set.add(field_tag)
-                        logger.error((f"DERIVED domain:{domain} field:{field_tag} could not "
-                                      f"find {field_name} in {output_dict}"))
-                    try:
-                        args_dict[arg_name] = output_dict[field_name][0]
-                    except Exception:
-                        error_fields_set.add(field_tag)
-                        logger.error((f"DERIVED {field_tag} arg_name: {arg_name} field_name:{field_name}"
-                                      f" args_dict:{args_dict} output_dict:{output_dict}"))
-
-            try:
-                function_value = field_details_dict['FUNCTION'](args_dict)
-                output_dict[field_tag] = (function_value, 'DERIVED')
-                logger.info((f"     DERIVED {function_value} for "
-                                f"{field_tag}, {field_details_dict} {output_dict[field_tag]}"))
-            except KeyError as e:
-                error_fields_set.add(field_tag)
-                logger.error(f"DERIVED exception: {e}")
-                logger.error(f"DERIVED KeyError {field_tag} function can't find key it expects in {args_dict}")
-                output_dict[field_tag] = (None, field_details_dict['config_type'])
-            except TypeError as e:
-                error_fields_set.add(field_tag)
-                logger.error(f"DERIVED exception: {e}")
-                logger.error((f"DERIVED TypeError {field_tag} possibly calling something that isn't a function"
-                              " or that function was passed a null value." 
-                              f" {field_details_dict['FUNCTION']}. You may have quotes "
-                              "around it in  a python mapping structure if this is a "
-                              f"string: {type(field_details_dict['FUNCTION'])}"))
-                output_dict[field_tag] = (None, field_details_dict['config_type'])
+def _count_function_outcome(domain, field_tag, domain_plan, function_value, failed):
+    """ Counts the outcome of a DERIVED or DOMAIN field's function for field_metrics. """
+    if failed:
+        field_metrics.count(domain, field_tag, 'derived_failure')
+    elif function_value is not None:
+        field_metrics.count(domain, field_tag, 'found')
+    elif field_tag in domain_plan['concept_fields']:
+        field_metrics.count(domain, field_tag, 'unmapped_concept')
+    else:
+        field_metrics.count(domain, field_tag, 'no_value')
 
 
-def do_domain_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set):
+def do_derived_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set):
+    # Do derived values now that their inputs should be available in the output_dict
+    # Except for a special argument named 'default', when the value is what is other wise the field to look up in the output dict.
+    # The plan lists DERIVED fields so that any that take another DERIVED field as input come after it.
+    for (field_tag, field_details_dict) in domain_plan['derived_fields']:
+        logger.info("     DERIVING %s, %s", field_tag, field_details_dict)
+        # NB Using an explicit dict here instead of kwargs because this code here
+        # doesn't know what the keywords are at 'compile' time.
+        args_dict = {}
+        failed = False
+        for arg_name, field_name in field_details_dict['argument_names'].items():
+            if arg_name == 'default':
+                    args_dict[arg_name] = field_name
+            else:
+                logger.info("     -- %s, arg_name:%s field_name:%s", field_tag, arg_name, field_name)
+                if field_name not in output_dict:
+                    failed = True
+                    error_fields_set.add(field_tag)
+                    logger.error("DERIVED domain:%s field:%s could not find %s in %s",
+                                 domain, field_tag, field_name, output_dict)
+                try:
+                    args_dict[arg_name] = output_dict[field_name][0]
+                except Exception:
+                    failed = True
+                    error_fields_set.add(field_tag)
+                    logger.error("DERIVED %s arg_name: %s field_name:%s args_dict:%s output_dict:%s",
+                                 field_tag, arg_name, field_name, args_dict, output_dict)
+
+        try:
+            function_value = field_details_dict['FUNCTION'](args_dict)
+            output_dict[field_tag] = (function_value, 'DERIVED')
+            _count_function_outcome(domain, field_tag, domain_plan, function_value, failed)
+            logger.info("     DERIVED %s for %s, %s %s",
+                        function_value, field_tag, field_details_dict, output_dict[field_tag])
+        except KeyError as e:
+            field_metrics.count(domain, field_tag, 'derived_failure')
+            error_fields_set.add(field_tag)
+            logger.error("DERIVED exception: %s", e)
+            logger.error("DERIVED KeyError %s function can't find key it expects in %s", field_tag, args_dict)
+            output_dict[field_tag] = (None, field_details_dict['config_type'])
+        except TypeError as e:
+            field_metrics.count(domain, field_tag, 'derived_failure')
+            error_fields_set.add(field_tag)
+            logger.error("DERIVED exception: %s", e)
+            logger.error(("DERIVED TypeError %s possibly calling something that isn't a function"
+                          " or that function was passed a null value."
+                          " %s. You may have quotes "
+                          "around it in  a python mapping structure if this is a "
+                          "string: %s"),
+                         field_tag, field_details_dict['FUNCTION'], type(field_details_dict['FUNCTION']))
+            output_dict[field_tag] = (None, field_details_dict['config_type'])
+
+
+def do_domain_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set,
+                     record_metrics=True):
     # nearly the same as derived above, but returns the domain for later filtering
+    # record_metrics is False when routing ahead of the parse, so fields aren't counted twice
     domain_id = None
-    for (field_tag, field_details_dict) in domain_meta_dict.items():
-        if field_details_dict['config_type'] == 'DOMAIN':
-            logger.info(f"     Deriving DOMAIN {field_tag}, {field_details_dict}")
-
-            # Collect args for the function
-            args_dict = {}
-            for arg_name, field_name in field_details_dict['argument_names'].items():
-                if arg_name == 'default':
-                        args_dict[arg_name] = field_name
-                else:
-                    logger.info(f"     -- {field_tag}, arg_name:{arg_name} field_name:{field_name}")
-                    if field_name not in output_dict:
-                        error_fields_set.add(field_tag)
-                        logger.error((f"DERIVED domain:{domain} field:{field_tag} could not "
-                                      f"find {field_name} in {output_dict}"))
-                    try:
-                        args_dict[arg_name] = output_dict[field_name][0]
-                    except Exception:
-                        error_fields_set.add(field_tag)
-                        logger.error((f"DERIVED {field_tag} arg_name: {arg_name} field_name:{field_name}"
-                                      f" args_dict:{args_dict} output_dict:{output_dict}"))
-            # Derive the value
-            try:
-                function_value = field_details_dict['FUNCTION'](args_dict)
-                domain_id = function_value
-                output_dict[field_tag] = (function_value, 'DOMAIN') ##########
-                logger.info((f"     DOMAIN captured as {function_value} for "
-                                 f"{field_tag}, {field_details_dict}"))
-            except KeyError as e:
-                error_fields_set.add(field_tag)
-                logger.error(f"DERIVED exception: {e}")
-                logger.error(f"DERIVED {field_tag} can't find argument in {args_dict}")
-            except TypeError as e:
-                error_fields_set.add(field_tag)
-                logger.error(f"DERIVED exception: {e}")
-                logger.error((f"DERIVED {field_tag} possibly calling something that isn't a function"
-                              f" {field_details_dict['FUNCTION']}. You may have quotes "
-                              "around it in  a python mapping structure if this is a "
-                              f"string: {type(field_details_dict['FUNCTION'])}"))
-                output_dict[field_tag] = (None, field_details_dict['config_type'])
-
-            #print(f"     DOMAIN-2  {field_tag} {domain} {domain_id} {len(domain_meta_dict.items())} ")
+    for (field_tag, field_details_dict) in domain_plan['domain_fields']:
+        logger.info("     Deriving DOMAIN %s, %s", field_tag, field_details_dict)
+
+        # Collect args for the function
+        args_dict = {}
+        failed = False
+        for arg_name, field_name in field_details_dict['argument_names'].items():
+            if arg_name == 'default':
+                    args_dict[arg_name] = field_name
+            else:
+                logger.info("     -- %s, arg_name:%s field_name:%s", field_tag, arg_name, field_name)
+                if field_name not in output_dict:
+                    failed = True
+                    error_fields_set.add(field_tag)
+                    logger.error("DERIVED domain:%s field:%s could not find %s in %s",
+                                 domain, field_tag, field_name, output_dict)
+                try:
+                    args_dict[arg_name] = output_dict[field_name][0]
+                except Exception:
+                    failed = True
+                    error_fields_set.add(field_tag)
+                    logger.error("DERIVED %s arg_name: %s field_name:%s args_dict:%s output_dict:%s",
+                                 field_tag, arg_name, field_name, args_dict, output_dict)
+        # Derive the value
+        try:
+            function_value = field_details_dict['FUNCTION'](args_dict)
+            domain_id = function_value
+            output_dict[field_tag] = (function_value, 'DOMAIN') ##########
+            if record_metrics:
+                _count_function_outcome(domain, field_tag, domain_plan, function_value, failed)
+            logger.info("     DOMAIN captured as %s for %s, %s",
+                        function_value, field_tag, field_details_dict)
+        except KeyError as e:
+            if record_metrics:
+                field_metrics.count(domain, field_tag, 'derived_failure')
+            error_fields_set.add(field_tag)
+            logger.error("DERIVED exception: %s", e)
+            logger.error("DERIVED %s can't find argument in %s", field_tag, args_dict)
+        except TypeError as e:
+            if record_metrics:
+                field_metrics.count(domain, field_tag, 'derived_failure')
+            error_fields_set.add(field_tag)
+            logger.error("DERIVED exception: %s", e)
+            logger.error(("DERIVED %s possibly calling something that isn't a function"
+                          " %s. You may have quotes "
+                          "around it in  a python mapping structure if this is a "
+                          "string: %s"),
+                         field_tag, field_details_dict['FUNCTION'], type(field_details_dict['FUNCTION']))
+            output_dict[field_tag] = (None, field_details_dict['config_type'])
+
     return domain_id
 
 
-def do_hash_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set):
+def do_hash_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set):
     """ These are basically derived, but the argument is a lsit of field names, instead of
         a fixed number of individually named fields.
         Dubiously useful in an environment where IDs are  32 bit integers.
-        See the code above for converting according to the data_type attribute
-        where a different kind of hash is beat into an integer.
+        The optional data_type, INTEGERHASH (default) or BIGINTHASH, chooses the
+        hash from id_hashing, same as for FIELDs.
     """
-    for (field_tag, field_details_dict) in domain_meta_dict.items():
-        if field_details_dict['config_type'] == 'HASH':
-            hash_input =  "-".join(field_details_dict['fields'])
-            hash_value = hashlib.sha256(hash_input.encode('utf-8')).hexdigest()
-            #hash_value = int(hash_value, 16) % 10**9 # ( digit decimal
-            hash_value = int(hash_value, 16) % 2**31 # ( signed 4 byte int )
-            output_dict[field_tag] = (hash_value, 'HASH')
-            logger.info((f"     HASH {hash_value} for "
-                         f"{field_tag}, {field_details_dict} {output_dict[field_tag]}"))
+    for (field_tag, field_details_dict) in domain_plan['hash_fields']:
+        _do_hash_field(output_dict, domain, field_tag, field_details_dict)
+
+
+def _hash_input(output_dict, field_names):
+    """ The values of the fields, joined with '-', a missing or None value as ''. """
+    hash_values = []
+    for field_name in field_names:
+        value = output_dict.get(field_name, (None,))[0]
+        hash_values.append('' if value is None else str(value))
+    return "-".join(hash_values)
 
 
-def do_priority_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set, pk_dict):
+def _do_hash_field(output_dict, domain, field_tag, field_details_dict):
+    hash_input = _hash_input(output_dict, field_details_dict['fields'])
+    hash_value = id_hashing.hash_id(hash_input, field_details_dict.get('data_type', 'INTEGERHASH'))
+    output_dict[field_tag] = (hash_value, 'HASH')
+    field_metrics.count(domain, field_tag, 'found')
+    logger.info("     HASH %s for %s, %s %s",
+                hash_value, field_tag, field_details_dict, output_dict[field_tag])
+
+
+def _do_deferred_field(output_dict, root_element, root_path, domain, domain_plan, field_tag,
+                       element_cache=None):
+    """ Parses a field the plan deferred to the priority phase, after the deferred
+        fields it takes as input, see _defer_priority_fields().
+    """
+    for input_tag in domain_plan['deferred_inputs'].get(field_tag, []):
+        if input_tag not in output_dict:
+            _do_deferred_field(output_dict, root_element, root_path, domain, domain_plan, input_tag,
+                               element_cache)
+    field_details_dict = domain_plan['deferred_fields'][field_tag]
+    if field_details_dict['config_type'] == 'HASH':
+        _do_hash_field(output_dict, domain, field_tag, field_details_dict)
+    else:
+        _do_field(output_dict, root_element, root_path, domain, field_tag, field_details_dict,
+                  element_cache)
+
+
+def do_priority_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set, pk_dict,
+                       element_cache=None):
     """
         Returns the list of  priority_names so the chosen one (first non-null) can be 
         added to output fields Also, adds this field to the PK list?
 
-        Within the domain_meta_dict, find all fields tagged with priority and group
-        them by their priority names in a dictionary keyed by that name
+        The priority groups come from the plan, already sorted, keyed by the name
+        of the field they create.
         Ex. { 'person_id': [ ('person_id_ssn', 1), ('person_id_unknown', 2) ]
-        Sort them, choose the first one that is not None.
+        Choose the first one that is not None.
 
         NB now there is a separate config_type PRIORITY to compliment the priority attribute.
         So you might have person_id_npi, person_id_ssn and person_id_hash tagged with priority
@@ -321,30 +507,28 @@ def do_priority_fields(output_dict, root_element, root_path, domain,  domain_met
         sorting/ordering.
     """
 
-    # Create Ref Data
-    # for each new field, create a list of source fields and their priority:
-    # Ex. [('person_id_other', 2), ('person_id_ssn', 1)]
-    priority_fields = {}
-    for field_key, config_parts in domain_meta_dict.items():
-        if  'priority' in config_parts:
-            new_field_name = config_parts['priority'][0]
-            priority_number = config_parts['priority'][1]
-            if new_field_name in priority_fields:
-                priority_fields[new_field_name].append( (field_key, config_parts['priority'][1]))
-            else:
-                priority_fields[new_field_name] = [ (field_key, config_parts['priority'][1]) ]
-
     # Choose Fields
     # first field in each set with a non-null value in the output_dict adds that value to the dict with it's priority_name
-    for priority_name, priority_contents in priority_fields.items():
-        sorted_contents = sorted(priority_contents, key=lambda x: x[1])
+    # Deferred candidates are parsed here, in priority order, only until one has a value.
+    priority_fields = domain_plan['priority_fields']
+    deferred_fields = domain_plan['deferred_fields']
+    for priority_name, sorted_contents in priority_fields.items():
         # Ex. [('person_id_ssn', 1), ('person_id_other, 2)]
-
         for value_field_pair in sorted_contents:
+            if value_field_pair[0] in deferred_fields and value_field_pair[0] not in output_dict:
+                _do_deferred_field(output_dict, root_element, root_path, domain, domain_plan,
+                                   value_field_pair[0], element_cache)
             if value_field_pair[0] in output_dict and output_dict[value_field_pair[0]][0] is not None:
                 output_dict[priority_name] = output_dict[value_field_pair[0]]
                 pk_dict[priority_name] = output_dict[value_field_pair[0]][0]
+                field_metrics.count(domain, priority_name, 'found')
                 break
+        else:
+            field_metrics.count(domain, priority_name, 'no_value')
+
+    for field_tag in deferred_fields:
+        if field_tag not in output_dict:
+            field_metrics.count(domain, field_tag, 'skipped')
 
     return priority_fields
 
@@ -365,55 +549,582 @@ def get_filter_fn(dict):
         return 'order' in dict[key] and dict[key]['order'] is not None
     return has_order_attribute
 
-def sort_output_dict(output_dict, domain_meta_dict, domain):
+def sort_output_dict(output_dict, domain_plan, domain):
     """ Sorts the ouput_dict by the value of the 'order' fields in the associated
-        domain_meta_dict. Fields without a value, or without an entry used to 
-        come last, now are omitted.
+        domain_meta_dict, as worked out ahead of time in the plan's output_order.
+        Fields without a value, or without an entry used to  come last, now are omitted.
     """
     ordered_output_dict = {}
 
-    sort_function = get_extract_order_fn(domain_meta_dict) # curry in the domain arg.
-    ordered_keys = sorted(domain_meta_dict.keys(), key=sort_function)
-
-    filter_function = get_filter_fn(domain_meta_dict)
-    filtered_ordered_keys = filter(filter_function, ordered_keys)
-
-    for key in filtered_ordered_keys:
+    for key in domain_plan['output_order']:
         if key in output_dict:
             ordered_output_dict[key] = output_dict[key]
 
     return ordered_output_dict
 
 
-def parse_domain_for_single_root(root_element, root_path, domain, domain_meta_dict, error_fields_set, pk_dict):
+def _order_derived_fields(domain, derived_fields):
+    """ Orders DERIVED fields so a field that takes another DERIVED field as an
+        argument comes after it. Otherwise metadata order is kept.
+    """
+    derived_dict = dict(derived_fields)
+    ordered = []
+    visiting = set()
+    visited = set()
+
+    def visit(field_tag):
+        if field_tag in visited:
+            return
+        if field_tag in visiting:
+            logger.error(f"DERIVED domain:{domain} field:{field_tag} is part of a dependency cycle")
+            return
+        visiting.add(field_tag)
+        for arg_name, field_name in derived_dict[field_tag]['argument_names'].items():
+            if arg_name != 'default' and field_name in derived_dict:
+                visit(field_name)
+        visiting.discard(field_tag)
+        visited.add(field_tag)
+        ordered.append((field_tag, derived_dict[field_tag]))
+
+    for (field_tag, field_details_dict) in derived_fields:
+        visit(field_tag)
+    return ordered
+
+
+def _order_priority_groups(domain, domain_meta_dict, priority_fields):
+    """ Orders the priority groups so a group with a candidate that takes another
+        group's field as input, like a HASH over person_id, comes after that group.
+        Otherwise metadata order is kept.
+    """
+    ordered = {}
+    visiting = set()
+
+    def visit(priority_name):
+        if priority_name in ordered:
+            return
+        if priority_name in visiting:
+            logger.error(f"PRIORITY domain:{domain} field:{priority_name} is part of a dependency cycle")
+            return
+        visiting.add(priority_name)
+        for (field_tag, priority_number) in priority_fields[priority_name]:
+            for input_tag in _field_inputs(domain_meta_dict[field_tag]):
+                if input_tag in priority_fields and input_tag != priority_name:
+                    visit(input_tag)
+        visiting.discard(priority_name)
+        ordered[priority_name] = priority_fields[priority_name]
+
+    for priority_name in priority_fields:
+        visit(priority_name)
+    return ordered
+
+
+def _check_hash_inputs(domain, domain_meta_dict, plan):
+    """ Warns about HASH inputs that are always empty when the hash is taken: fields
+        missing from the metadata, and priority fields read in the hash phase,
+        before the priority phase chooses them.
+    """
+    for (field_tag, field_details_dict) in domain_meta_dict.items():
+        if field_details_dict['config_type'] != 'HASH' or field_tag in plan['dead_fields']:
+            continue
+        missing = [input_tag for input_tag in field_details_dict['fields'] if input_tag not in domain_meta_dict]
+        if len(missing) > 0:
+            logger.warning(f"HASH domain:{domain} field:{field_tag} inputs {missing} aren't in the metadata, hashed as empty")
+        if field_tag not in plan['deferred_fields']:
+            too_early = [input_tag for input_tag in field_details_dict['fields'] if input_tag in plan['priority_fields']]
+            if len(too_early) > 0:
+                logger.warning(f"HASH domain:{domain} field:{field_tag} inputs {too_early} are chosen "
+                               f"in the priority phase, after the hash, hashed as empty")
+
+
+def compile_domain_plan(domain, domain_meta_dict):
+    """ Works out, once per domain, what parse_domain_for_single_root would otherwise
+        re-derive from the domain_meta_dict for every root element:
+        - the fields for each do_*_fields phase, in metadata order
+        - DERIVED fields in dependency order
+        - priority groups, keyed by the field they create, sorted by priority number
+        - the output column order from the 'order' attributes
+        - the root and field element paths, compiled with compile_path()
+        - the FIELD inputs of the DOMAIN field, and a signature of how the domain_id
+          is worked out from the XML, used to group domains in get_domain_groups()
+        - the DERIVED and DOMAIN fields whose function maps codes to concepts, so
+          field_metrics can count a None from them as an unmapped concept
+        - the fields that can't reach the output, left out of every phase, see
+          _live_fields()
+        - the priority candidates, and their inputs, left to the priority phase,
+          see _defer_priority_fields()
+        Returns the plan as a dict.
+    """
+    plan = {
+        'domain': domain,
+        'meta_dict': domain_meta_dict,
+        'none_fields': [],
+        'constant_fields': [],
+        'basic_fields': [],
+        'derived_fields': [],
+        'domain_fields': [],
+        'hash_fields': [],
+        'priority_fields': {},
+        'output_order': [],
+        'concept_fields': set(),
+        'root_path': compile_path(domain_meta_dict['root']['element'])
+    }
+
+    for (field_tag, field_details_dict) in domain_meta_dict.items():
+        config_type_tag = field_details_dict['config_type']
+        if config_type_tag is None:
+            plan['none_fields'].append(field_tag)
+        elif config_type_tag == 'CONSTANT':
+            plan['constant_fields'].append((field_tag, field_details_dict))
+        elif config_type_tag in ('FIELD', 'PK', 'FK'):
+            plan['basic_fields'].append((field_tag, field_details_dict))
+            if config_type_tag != 'FK' and 'element' in field_details_dict:
+                compile_path(field_details_dict['element'])
+        elif config_type_tag == 'DERIVED':
+            plan['derived_fields'].append((field_tag, field_details_dict))
+        elif config_type_tag == 'DOMAIN':
+            plan['domain_fields'].append((field_tag, field_details_dict))
+        elif config_type_tag == 'HASH':
+            plan['hash_fields'].append((field_tag, field_details_dict))
+
+        if config_type_tag in ('DERIVED', 'DOMAIN') and \
+           field_details_dict.get('FUNCTION') in concept_mapping_functions:
+            plan['concept_fields'].add(field_tag)
+
+        # Ex. [('person_id_other', 2), ('person_id_ssn', 1)]
+        if 'priority' in field_details_dict:
+            new_field_name = field_details_dict['priority'][0]
+            priority_number = field_details_dict['priority'][1]
+            if new_field_name in plan['priority_fields']:
+                plan['priority_fields'][new_field_name].append((field_tag, priority_number))
+            else:
+                plan['priority_fields'][new_field_name] = [(field_tag, priority_number)]
+
+    plan['derived_fields'] = _order_derived_fields(domain, plan['derived_fields'])
+
+    filter_function = get_filter_fn(domain_meta_dict)
+    ordered_keys = filter(filter_function, domain_meta_dict.keys())
+    sort_function = get_extract_order_fn(domain_meta_dict) # curry in the domain arg.
+    plan['output_order'] = sorted(ordered_keys, key=sort_function)
+
+    live_fields = _live_fields(domain_meta_dict, plan['output_order'])
+    plan['dead_fields'] = [field_tag for (field_tag, field_details_dict) in domain_meta_dict.items()
+                           if field_tag not in live_fields and field_details_dict['config_type'] != 'ROOT']
+    if len(plan['dead_fields']) > 0:
+        logger.info(f"DEAD fields in {domain}, not parsed: {plan['dead_fields']}")
+    for phase in ('constant_fields', 'basic_fields', 'derived_fields', 'domain_fields', 'hash_fields'):
+        plan[phase] = [(field_tag, field_details_dict) for (field_tag, field_details_dict) in plan[phase]
+                       if field_tag in live_fields]
+    plan['none_fields'] = [field_tag for field_tag in plan['none_fields'] if field_tag in live_fields]
+
+    _defer_priority_fields({field_tag: field_details_dict for (field_tag, field_details_dict)
+                            in domain_meta_dict.items() if field_tag in live_fields}, plan)
+
+    for priority_name, priority_contents in plan['priority_fields'].items():
+        plan['priority_fields'][priority_name] = sorted(priority_contents, key=lambda x: x[1])
+    plan['priority_fields'] = _order_priority_groups(domain, domain_meta_dict, plan['priority_fields'])
+    _check_hash_inputs(domain, domain_meta_dict, plan)
+
+    (plan['routing_fields'], plan['routing_signature']) = \
+        _compile_routing(domain_meta_dict, plan['domain_fields'])
+    # routing fields are parsed first, by do_routing_fields(), rather than with the basic fields
+    routing_field_tags = set(field_tag for (field_tag, field_details_dict) in plan['routing_fields'])
+    plan['basic_fields'] = [(field_tag, field_details_dict) for (field_tag, field_details_dict) in plan['basic_fields']
+                            if field_tag not in routing_field_tags]
+
+    plan['concept_inputs'] = _compile_concept_inputs(domain_meta_dict, plan['concept_fields'] & live_fields)
+
+    return plan
+
+
+def _field_inputs(field_details_dict):
+    """ The names of the fields a DERIVED, DOMAIN or HASH field takes as input. """
+    if field_details_dict['config_type'] == 'HASH':
+        return list(field_details_dict['fields'])
+    if field_details_dict['config_type'] in ('DERIVED', 'DOMAIN'):
+        return [field_name for (arg_name, field_name) in field_details_dict['argument_names'].items()
+                if arg_name != 'default']
+    return []
+
+
+def _live_fields(domain_meta_dict, output_order):
+    """ Returns the set of fields that can affect the domain's output: the output
+        columns, PKs, for the FKs of later domains, and DOMAIN fields, for routing,
+        and, working back from those, the candidates of live priority groups and
+        the inputs of live DERIVED, DOMAIN and HASH fields.
+    """
+    priority_candidates = {}
+    for (field_tag, field_details_dict) in domain_meta_dict.items():
+        if 'priority' in field_details_dict:
+            priority_candidates.setdefault(field_details_dict['priority'][0], []).append(field_tag)
+
+    to_visit = list(output_order)
+    to_visit += [field_tag for (field_tag, field_details_dict) in domain_meta_dict.items()
+                 if field_details_dict['config_type'] in ('PK', 'DOMAIN')]
+    live = set()
+    while len(to_visit) > 0:
+        field_tag = to_visit.pop()
+        if field_tag in live:
+            continue
+        live.add(field_tag)
+        to_visit += priority_candidates.get(field_tag, [])
+        if field_tag in domain_meta_dict:
+            to_visit += _field_inputs(domain_meta_dict[field_tag])
+    return live
+
+
+def dead_fields(metadata):
+    """ Returns {domain: [fields]} of the fields in each domain's metadata that can't
+        reach the output, so aren't parsed, for cleaning up the mappings.
+    """
+    return {domain: get_domain_plan(domain, domain_meta_dict)['dead_fields']
+            for (domain, domain_meta_dict) in metadata.items()
+            if _domain_has_root(domain, domain_meta_dict)}
+
+
+def _defer_priority_fields(domain_meta_dict, plan):
+    """ Moves FIELD and HASH priority candidates out of the basic and hash phases,
+        so do_priority_fields() parses them in priority order, stopping at the first
+        with a value. Fields that aren't output and are only inputs to deferred
+        candidates, like the name and address behind person_id_hash, are deferred
+        with them. A field stays in its phase if it has an 'order', or if a field
+        that isn't deferred takes it as input.
+        Adds 'deferred_fields', {field: field_details_dict}, and 'deferred_inputs',
+        {field: [deferred fields it takes as input]}, to the plan.
+    """
+    referrers = {}
+    for (field_tag, field_details_dict) in domain_meta_dict.items():
+        for input_tag in _field_inputs(field_details_dict):
+            referrers.setdefault(input_tag, set()).add(field_tag)
+
+    deferred = set()
+    for (field_tag, field_details_dict) in domain_meta_dict.items():
+        config_type_tag = field_details_dict['config_type']
+        if 'order' in field_details_dict:
+            continue
+        if config_type_tag in ('FIELD', 'HASH') and 'priority' in field_details_dict:
+            deferred.add(field_tag)
+        elif config_type_tag == 'FIELD' and field_tag in referrers:
+            deferred.add(field_tag)
+
+    changed = True
+    while changed:
+        changed = False
+        for field_tag in list(deferred):
+            if not referrers.get(field_tag, set()) <= deferred:
+                deferred.discard(field_tag)
+                changed = True
+
+    plan['basic_fields'] = [(field_tag, field_details_dict) for (field_tag, field_details_dict)
+                            in plan['basic_fields'] if field_tag not in deferred]
+    plan['hash_fields'] = [(field_tag, field_details_dict) for (field_tag, field_details_dict)
+                           in plan['hash_fields'] if field_tag not in deferred]
+    plan['deferred_fields'] = {field_tag: domain_meta_dict[field_tag]
+                               for field_tag in domain_meta_dict if field_tag in deferred}
+    plan['deferred_inputs'] = {field_tag: [input_tag for input_tag in _field_inputs(domain_meta_dict[field_tag])
+                                           if input_tag in deferred]
+                               for field_tag in deferred}
+
+
+def _compile_routing(domain_meta_dict, domain_fields):
+    """ For a domain with a single DOMAIN field whose arguments are all FIELDs, returns
+        those FIELDs and a signature made of the function and the element, attribute
+        and data_type behind each argument. Domains with equal signatures route a
+        root element the same way. Returns ([], None) for any other domain.
+    """
+    if len(domain_fields) != 1:
+        return ([], None)
+
+    (field_tag, field_details_dict) = domain_fields[0]
+    routing_fields = []
+    signature_args = []
+    for arg_name, field_name in sorted(field_details_dict['argument_names'].items()):
+        if arg_name == 'default':
+            signature_args.append((arg_name, repr(field_name)))
+            continue
+        input_details_dict = domain_meta_dict.get(field_name)
+        if input_details_dict is None or input_details_dict['config_type'] != 'FIELD' \
+           or 'element' not in input_details_dict or 'attribute' not in input_details_dict:
+            return ([], None)
+        routing_fields.append((field_name, input_details_dict))
+        signature_args.append((arg_name, input_details_dict['element'],
+                               input_details_dict['attribute'],
+                               input_details_dict.get('data_type')))
+
+    return (routing_fields, (field_details_dict['FUNCTION'], tuple(signature_args)))
+
+
+def _compile_concept_inputs(domain_meta_dict, concept_fields):
+    """ Returns the distinct (vocabulary_oid FIELD, concept_code FIELD) pairs, as
+        (field_tag, field_details_dict), that the concept_fields map, for
+        _prefetch_root_concepts(). Fields whose codes come from anything other than
+        an attribute taken as is are left to be looked up row by row.
+    """
+    concept_inputs = []
+    for field_tag in sorted(concept_fields):
+        argument_names = domain_meta_dict[field_tag]['argument_names']
+        input_fields = []
+        for arg_name in ('vocabulary_oid', 'concept_code'):
+            input_details_dict = domain_meta_dict.get(argument_names.get(arg_name))
+            if input_details_dict is None or input_details_dict['config_type'] != 'FIELD' \
+               or 'element' not in input_details_dict or 'attribute' not in input_details_dict \
+               or 'data_type' in input_details_dict:
+                break
+            input_fields.append((argument_names[arg_name], input_details_dict))
+        if len(input_fields) == 2 and tuple(input_fields) not in concept_inputs:
+            concept_inputs.append(tuple(input_fields))
+    return concept_inputs
+
+
+_domain_plan_cache = {}
+
+_concept_prefetch = False
+
+
+def enable_concept_prefetch(enabled=True):
+    """ With prefetch on, the codes of a batch of root elements are looked up in the
+        concept map all at once, before the rows are parsed, see _prefetch_root_concepts().
+    """
+    global _concept_prefetch
+    _concept_prefetch = enabled
+
+
+def get_domain_plan(domain, domain_meta_dict):
+    """ Returns the compiled plan for the domain, compiling it on first use.
+        The plan is recompiled if a different domain_meta_dict is passed in.
+    """
+    domain_plan = _domain_plan_cache.get(domain)
+    if domain_plan is None or domain_plan['meta_dict'] is not domain_meta_dict:
+        domain_plan = compile_domain_plan(domain, domain_meta_dict)
+        _domain_plan_cache[domain] = domain_plan
+    return domain_plan
+
+
+def parse_routing_values(root_element, root_path, domain, domain_plan, element_cache=None):
+    """ Returns [(value, outcome)] for the domain's routing_fields. The values are the
+        same for each domain with the same routing signature, in the same order.
+    """
+    return [_parse_field(field_details_dict, root_element, domain, field_tag, root_path, element_cache)
+            for (field_tag, field_details_dict) in domain_plan['routing_fields']]
+
+
+def do_routing_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set,
+                      record_metrics=True, element_cache=None, routing_values=None):
+    """ Parses just the FIELD inputs of the domain's DOMAIN field into the output_dict,
+        and returns the domain_id it routes the root element to.
+        routing_values, from parse_routing_values(), may be passed in when the inputs
+        were already parsed for a domain with the same routing signature.
+        With record_metrics False the fields aren't counted in field_metrics, for when
+        they will be counted again.
+    """
+    if routing_values is None:
+        routing_values = parse_routing_values(root_element, root_path, domain, domain_plan, element_cache)
+    for ((field_tag, field_details_dict), (attribute_value, outcome)) in \
+            zip(domain_plan['routing_fields'], routing_values):
+        if record_metrics:
+            field_metrics.count(domain, field_tag, outcome)
+        output_dict[field_tag] = (attribute_value, root_path + "/" +
+                                  field_details_dict['element'] + "/@" +
+                                  field_details_dict['attribute'])
+    return do_domain_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set,
+                            record_metrics)
+
+
+def parse_domain_for_single_root(root_element, root_path, domain, domain_plan, error_fields_set, pk_dict,
+                                 element_cache=None, routing_values=None):
     """  Parses for each field in the metadata for a domain out of the root_element passed in.
          You may have more than one such root element, each making for a row in the output.
+         The domain_plan is the compiled form of the domain's metadata, from get_domain_plan().
 
         If the configuration includes a field of config_type DOMAIN, the value it generates
         will be compared to the domain passed in. If they are different, null is returned.
-        This is how  OMOP "domain routing" is implemented here.
+        This is how  OMOP "domain routing" is implemented here. When the domain has a
+        routing signature, the DOMAIN field and its inputs are parsed first and a root
+        element routed away is left there, without parsing its other fields.
+
+        Elements under the root are found once per path, in element_cache, which may
+        come from the caller when it has already looked at the root element. Likewise
+        routing_values, when the caller has already routed it.
     """
+    if element_cache is None:
+        element_cache = {}
     output_dict = {}
     domain_id = None
-    logger.info((f"  ROOT for domain:{domain}, we have tag:{root_element.tag}"
-                 f" attributes:{root_element.attrib}"))
-
-    do_none_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set)
-    do_constant_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set)
-    do_basic_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set, pk_dict)
-    do_derived_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set)
-    domain_id = do_domain_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set)
-    do_hash_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set)
-    priority_field_names = do_priority_fields(output_dict, root_element, root_path, domain,  domain_meta_dict, error_fields_set, pk_dict)
-
-    output_dict = sort_output_dict(output_dict, domain_meta_dict, domain)
+    logger.info("  ROOT for domain:%s, we have tag:%s attributes:%s",
+                domain, root_element.tag, root_element.attrib)
+
+    lap = phase_timing.start_laps(domain) if phase_timing.enabled else None
+    routed_early = domain_plan['routing_signature'] is not None
+    if routed_early:
+        domain_id = do_routing_fields(output_dict, root_element, root_path, domain, domain_plan, error_fields_set,
+                                      element_cache=element_cache, routing_values=routing_values)
+        if lap: lap('routing')
+        if domain_id is not None and domain_id != domain:
+            field_metrics.count(domain, field_metrics.ROW, 'routed_away')
+            return (None, None)
+
+    do_none_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set)
+    do_constant_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set)
+    if lap: lap('constant_fields')
+    do_basic_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set, pk_dict,
+                    element_cache)
+    if lap: lap('basic_fields')
+    do_derived_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set)
+    if lap: lap('derived_fields')
+    if not routed_early:
+        domain_id = do_domain_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set)
+        if lap: lap('domain_fields')
+    do_hash_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set)
+    if lap: lap('hash_fields')
+    priority_field_names = do_priority_fields(output_dict, root_element, root_path, domain,  domain_plan, error_fields_set, pk_dict,
+                                              element_cache)
+    if lap: lap('priority_fields')
+
+    output_dict = sort_output_dict(output_dict, domain_plan, domain)
+    if lap: lap('sort_output')
 
     if (domain == domain_id or domain_id is None):
+        field_metrics.count(domain, field_metrics.ROW, 'rows')
         return (output_dict, error_fields_set)
     else:
+        field_metrics.count(domain, field_metrics.ROW, 'routed_away')
         return (None, None)
 
 
+def _domain_has_root(domain, domain_meta_dict):
+    if 'root' not in domain_meta_dict:
+        logger.error(f"DOMAIN {domain} lacks a root element.")
+        return False
+
+    if 'element' not in domain_meta_dict['root']:
+        logger.error(f"DOMAIN {domain} root lacks an 'element' key.")
+        return False
+
+    return True
+
+
+def _peek_field(field_details_dict, root_element, element_cache):
+    """ The raw value of a FIELD, or None, without logging or counting it. """
+    field_element = find_first_cached(field_details_dict['element'], root_element, element_cache)
+    if field_element is None:
+        return None
+    if field_details_dict['attribute'] == "#text":
+        return field_element.text
+    return field_element.get(field_details_dict['attribute'])
+
+
+def _prefetch_root_concepts(root_element_list, domain_plans, element_caches):
+    """ Collects the (vocabulary_oid, concept_code) pairs under each root element for
+        the concept_inputs of the domain_plans and looks up the distinct ones in one
+        go, so the rows' concept mapping finds them in the memo. The elements found
+        are kept in each root's cache in element_caches, for the parse.
+    """
+    code_pairs = set()
+    for (root_element, element_cache) in zip(root_element_list, element_caches):
+        for domain_plan in domain_plans:
+            for ((oid_tag, oid_details_dict), (code_tag, code_details_dict)) in domain_plan['concept_inputs']:
+                vocabulary_oid = _peek_field(oid_details_dict, root_element, element_cache)
+                concept_code = _peek_field(code_details_dict, root_element, element_cache)
+                if vocabulary_oid is not None and concept_code is not None:
+                    code_pairs.add((vocabulary_oid, concept_code))
+    prefetch_concepts(code_pairs)
+
+
+def _parse_domain_root(root_element, domain, domain_plan, error_fields_set, pk_dict, output_list,
+                       element_cache=None, routing_values=None):
+    """ Parses the root element for the domain, adding its row to output_list unless
+        it's routed away.
+    """
+    root_path = domain_plan['meta_dict']['root']['element']
+    (output_dict, element_error_set) = parse_domain_for_single_root(root_element, root_path, domain, domain_plan, error_fields_set, pk_dict,
+                                                                    element_cache, routing_values)
+    if output_dict is not None:
+        output_list.append(output_dict)
+    if element_error_set is not None:
+        error_fields_set.union(element_error_set)
+
+
+def _parse_domain_roots(root_element_list, domain, domain_plan, error_fields_set, pk_dict, output_list,
+                        element_caches=None):
+    """ Parses each root element for the domain, adding the rows that aren't routed
+        away to output_list. element_caches, if given, has an element_cache for each
+        root element.
+    """
+    set_log_context(domain=domain)
+    if element_caches is None:
+        element_caches = [None] * len(root_element_list)
+    for (root_element, element_cache) in zip(root_element_list, element_caches):
+        _parse_domain_root(root_element, domain, domain_plan, error_fields_set, pk_dict, output_list,
+                           element_cache)
+
+
+def _parse_domain_group_roots(root_element_list, domain_group, domain_plans, error_fields_sets, pk_dict, output_lists):
+    """ Parses root elements shared by a group of domains from get_domain_groups().
+        Each root element is routed once, with the first domain's DOMAIN field, and
+        then parsed only for the domain it routes to, or for all of them when the
+        domain_id is None, as when the code isn't mapped. The routing fields parsed
+        for the first domain are passed on rather than parsed again.
+        With enable_concept_prefetch(), the codes under the root elements are
+        looked up first, all at once.
+    """
+    element_caches = [{} for root_element in root_element_list]
+    if _concept_prefetch:
+        lap = phase_timing.start_laps(domain_group[0]) if phase_timing.enabled else None
+        _prefetch_root_concepts(root_element_list, [domain_plans[domain] for domain in domain_group],
+                                element_caches)
+        if lap: lap('prefetch_concepts')
+
+    if len(domain_group) == 1:
+        domain = domain_group[0]
+        _parse_domain_roots(root_element_list, domain, domain_plans[domain],
+                            error_fields_sets[domain], pk_dict, output_lists[domain], element_caches)
+        return
+
+    routing_domain = domain_group[0]
+    routing_plan = domain_plans[routing_domain]
+    root_path = routing_plan['meta_dict']['root']['element']
+    for (root_element, element_cache) in zip(root_element_list, element_caches):
+        set_log_context(domain=routing_domain)
+        lap = phase_timing.start_laps(routing_domain) if phase_timing.enabled else None
+        routing_values = parse_routing_values(root_element, root_path, routing_domain, routing_plan,
+                                              element_cache)
+        domain_id = do_routing_fields({}, root_element, root_path, routing_domain,
+                                      routing_plan, error_fields_sets[routing_domain],
+                                      record_metrics=False, routing_values=routing_values)
+        if lap: lap('routing')
+        for domain in domain_group:
+            if domain_id is None or domain_id == domain:
+                set_log_context(domain=domain)
+                _parse_domain_root(root_element, domain, domain_plans[domain],
+                                   error_fields_sets[domain], pk_dict, output_lists[domain],
+                                   element_cache, routing_values)
+            else:
+                field_metrics.count(domain, field_metrics.ROW, 'routed_away')
+
+
+def get_domain_groups(metadata):
+    """ Returns the domains of the metadata as a list of lists. Domains next to each
+        other in the metadata that have the same root path and route rows the same
+        way, like Measurement and Observation over the results section, are grouped
+        so their root elements are found and routed once. Other domains are alone in
+        their list. Only neighbors are grouped so PKs and FKs keep the metadata order.
+    """
+    domain_groups = []
+    previous_key = None
+    for domain, domain_meta_dict in metadata.items():
+        group_key = None
+        if 'root' in domain_meta_dict and 'element' in domain_meta_dict['root']:
+            routing_signature = get_domain_plan(domain, domain_meta_dict)['routing_signature']
+            if routing_signature is not None:
+                group_key = (domain_meta_dict['root']['element'], routing_signature)
+
+        if group_key is not None and group_key == previous_key:
+            domain_groups[-1].append(domain)
+        else:
+            domain_groups.append([domain])
+        previous_key = group_key
+    return domain_groups
+
+
 def parse_domain_from_dict(tree, domain, domain_meta_dict, filename, pk_dict):
     """ The main logic is here.
         Given a tree from ElementTree representing a CCDA document
@@ -426,60 +1137,160 @@ def parse_domain_from_dict(tree, domain, domain_meta_dict, filename, pk_dict):
         It's a list of because you might have more than one instance of the root path, like when you
         get many observations.
     """
+    return parse_domain_group_from_dict(tree, [domain], {domain: domain_meta_dict},
+                                        filename, pk_dict)[domain]
 
-    # log to a file per file/domain
-    base_name = os.path.basename(filename)
-    logging.basicConfig(
-        format='%(levelname)s: %(message)s',
-        filename=f"logs/log_domain_{base_name}_{domain}.log",
-        force=True, level=logging.WARNING)
 
-    # Find root
-    if 'root' not in domain_meta_dict:
-        logger.error(f"DOMAIN {domain} lacks a root element.")
-        return None
+def parse_domain_group_from_dict(tree, domain_group, metadata, filename, pk_dict):
+    """ parse_domain_from_dict() for a group of domains from get_domain_groups(),
+        sharing one evaluation of the root path. Returns a dict of output_lists
+        keyed by domain.
+    """
 
-    if 'element' not in domain_meta_dict['root']:
-        logger.error(f"DOMAIN {domain} root lacks an 'element' key.")
-        return None
+    # Find root
+    domain = domain_group[0]
+    set_log_context(domain=domain)
+    domain_meta_dict = metadata[domain]
+    if not _domain_has_root(domain, domain_meta_dict):
+        return {domain: None}
 
     root_path = domain_meta_dict['root']['element']
-    logger.info((f"DOMAIN >>  domain:{domain} root:{domain_meta_dict['root']['element']}"
+    domain_plans = {domain: get_domain_plan(domain, metadata[domain]) for domain in domain_group}
+    logger.info((f"DOMAIN >>  domain:{domain_group} root:{domain_meta_dict['root']['element']}"
                  f"   ROOT path:{root_path}"))
-    root_element_list = tree.findall(domain_meta_dict['root']['element'], ns)
+    lap = phase_timing.start_laps(domain) if phase_timing.enabled else None
+    root_element_list = domain_plans[domain]['root_path'](tree)
+    if lap: lap('find_roots')
     if root_element_list is None or len(root_element_list) == 0:
-        logger.error((f"DOMAIN couldn't find root element for {domain}"
+        logger.error((f"DOMAIN couldn't find root element for {domain_group}"
                       f" with {domain_meta_dict['root']['element']}"))
-        return None
+        return {domain: None for domain in domain_group}
 
-    output_list = []
-    error_fields_set = set()
-    logger.info(f"NUM ROOTS {domain} {len(root_element_list)}")
-    for root_element in root_element_list:
-        (output_dict, element_error_set) = parse_domain_for_single_root(root_element, root_path, domain, domain_meta_dict, error_fields_set, pk_dict)
-        if output_dict is not None:
-            output_list.append(output_dict)
-        if element_error_set is not None:
-            error_fields_set.union(element_error_set)
+    output_lists = {domain: [] for domain in domain_group}
+    error_fields_sets = {domain: set() for domain in domain_group}
+    logger.info(f"NUM ROOTS {domain_group} {len(root_element_list)}")
+    _parse_domain_group_roots(root_element_list, domain_group, domain_plans,
+                              error_fields_sets, pk_dict, output_lists)
 
     # report fields with errors
-    if len(error_fields_set) > 0:
-        logger.error(f"DOMAIN Fields with errors in domain {domain} {error_fields_set}")
+    for domain in domain_group:
+        if len(error_fields_sets[domain]) > 0:
+            logger.error(f"DOMAIN Fields with errors in domain {domain} {error_fields_sets[domain]}")
 
-    return output_list
+    return output_lists
 
 
-def parse_doc(file_path, metadata):
+def parse_doc(file_path, metadata, streaming=False):
     """ Parses many domains from a single file, collects them
         into a dict to return.
+        With streaming, the file is read with parse_doc_streaming() instead of
+        being loaded whole.
     """
-    omop_dict = {}
-    pk_dict = {}
-    tree = ET.parse(file_path)
     base_name = os.path.basename(file_path)
+    with log_context(document=base_name, domain='-'):
+        lap = phase_timing.start_laps(phase_timing.DOCUMENT, base_name) if phase_timing.enabled else None
+        if streaming:
+            omop_dict = parse_doc_streaming(file_path, metadata)
+            if lap: lap('parse_streaming')
+            return omop_dict
+
+        omop_dict = {}
+        pk_dict = {}
+        tree = ET.parse(file_path)
+        if lap: lap('parse_xml')
+        for domain_group in get_domain_groups(metadata):
+            domain_data_dicts = parse_domain_group_from_dict(tree, domain_group, metadata, base_name, pk_dict)
+            omop_dict.update(domain_data_dicts)
+        if lap: lap('map_domains')
+        return omop_dict
+
+
+# Subtrees that streaming mode parses, maps and then releases as units.
+# The header parts come before the body in a CCDA, so PKs from Person and
+# Visit are in the pk_dict before the section entries that refer to them.
+STREAM_CHUNK_TAGS = [
+    '{urn:hl7-org:v3}recordTarget',
+    '{urn:hl7-org:v3}componentOf',
+    '{urn:hl7-org:v3}entry',
+    '{urn:hl7-org:v3}section'
+]
+
+
+def _is_within(element, chunk_element):
+    if element is chunk_element:
+        return True
+    for ancestor in element.iterancestors():
+        if ancestor is chunk_element:
+            return True
+    return False
+
+
+def parse_doc_streaming(file_path, metadata):
+    """ Same result as parse_doc(), but reads the file with iterparse so it never
+        holds the whole document.
+
+        As each STREAM_CHUNK_TAGS element (recordTarget, componentOf, a section
+        entry, and then what's left of its section) is completed, every domain's
+        root path is evaluated against the partial tree. Roots that fall within
+        that element are parsed into rows, and the element is then cleared and
+        removed from the tree. Whatever remains once the whole file has been read
+        gets one last pass. Peak memory is bounded by the largest chunk, plus the
+        header, rather than by the file.
+
+        Rows come out in document order, and a domain's rows come out in the same
+        order as from parse_doc().
+    """
+    set_log_context(document=os.path.basename(file_path), domain='-')
+    domain_plans = {}
     for domain, domain_meta_dict in metadata.items():
-        domain_data_dict = parse_domain_from_dict(tree, domain, domain_meta_dict, base_name, pk_dict)
-        omop_dict[domain] = domain_data_dict
+        if _domain_has_root(domain, domain_meta_dict):
+            domain_plans[domain] = get_domain_plan(domain, domain_meta_dict)
+
+    output_lists = {domain: [] for domain in domain_plans}
+    error_fields_sets = {domain: set() for domain in domain_plans}
+    roots_found = set()
+    pk_dict = {}
+
+    domain_groups = [domain_group for domain_group in get_domain_groups(metadata)
+                     if domain_group[0] in domain_plans]
+
+    def parse_chunk(document_root, chunk_element):
+        for domain_group in domain_groups:
+            domain_plan = domain_plans[domain_group[0]]
+            root_element_list = [root_element for root_element in domain_plan['root_path'](document_root)
+                                 if chunk_element is None or _is_within(root_element, chunk_element)]
+            if len(root_element_list) > 0:
+                roots_found.update(domain_group)
+                _parse_domain_group_roots(root_element_list, domain_group, domain_plans,
+                                          error_fields_sets, pk_dict, output_lists)
+
+    document_root = None
+    for (event, element) in ET.iterparse(file_path, events=('end',), tag=STREAM_CHUNK_TAGS):
+        parent = element.getparent()
+        if element.tag == '{urn:hl7-org:v3}entry' and \
+           (parent is None or parent.tag != '{urn:hl7-org:v3}section'):
+            continue
+        document_root = element.getroottree().getroot()
+        parse_chunk(document_root, element)
+        element.clear()
+        if parent is not None:
+            parent.remove(element)
+
+    if document_root is not None:
+        parse_chunk(document_root, None)
+
+    omop_dict = {}
+    for domain in metadata:
+        if domain not in domain_plans:
+            omop_dict[domain] = None
+        elif domain not in roots_found:
+            logger.error((f"DOMAIN couldn't find root element for {domain}"
+                          f" with {metadata[domain]['root']['element']}"))
+            omop_dict[domain] = None
+        else:
+            if len(error_fields_sets[domain]) > 0:
+                logger.error(f"DOMAIN Fields with errors in domain {domain} {error_fields_sets[domain]}")
+            omop_dict[domain] = output_lists[domain]
     return omop_dict
 
 
@@ -506,23 +1317,12 @@ def print_omop_structure(omop, meta_data):
                     print(f"\n\nDOMAIN: {domain} {n}\n\n")
 
 
-def process_file(filepath):
+def process_file(filepath, streaming=False):
     print(f"PROCESSING {filepath} ")
     logger.info(f"PROCESSING {filepath} ")
-    base_name = os.path.basename(filepath)
-
-    logging.basicConfig(
-        format='%(levelname)s: %(message)s',
-        filename=f"logs/log_file_{base_name}.log",
-        force=True,
-        # level=logging.ERROR
-        level=logging.WARNING
-        # level=logging.INFO
-        # level=logging.DEBUG
-    )
 
     meta_data = get_meta_dict()
-    omop_data = parse_doc(filepath, meta_data)
+    omop_data = parse_doc(filepath, meta_data, streaming)
     if omop_data is not None or len(omop_data) < 1:
         print_omop_structure(omop_data, meta_data)
     else:
@@ -537,17 +1337,43 @@ def main() :
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-d', '--directory', help="directory of files to parse")
     group.add_argument('-f', '--filename', help="filename to parse")
+    parser.add_argument('-s', '--streaming', action='store_true',
+                        help="read files incrementally with iterparse, for very large documents")
+    parser.add_argument('--log-level', default='WARNING',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-file', default="logs/data_driven_parse.log",
+                        help="one log for the run, '-' for stdout")
+    parser.add_argument('--metrics-file', default="logs/data_driven_parse_metrics.csv",
+                        help="per domain and field extraction counts, CSV or .json")
+    parser.add_argument('--timing', action='store_true',
+                        help="time each phase per domain and document, print and write to logs/phase_timing.json")
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'],
+                        help="profile the run, writes logs/profile.pstats or logs/profile_tracemalloc.txt")
+    parser.add_argument('--dead-fields', action='store_true',
+                        help="print the metadata fields that can't reach the output, and so aren't parsed")
     args = parser.parse_args()
 
-    if args.filename is not None:
-        process_file(args.filename)
-    elif args.directory is not None:
-        only_files = [f for f in os.listdir(args.directory) if os.path.isfile(os.path.join(args.directory, f))]
-        for file in (only_files):
-            if file.endswith(".xml"):
-            	process_file(os.path.join(args.directory, file))
-    else:
-        logger.error("Did args parse let us  down? Have neither a file, nor a directory.")
+    configure_logging(args.log_level, None if args.log_file == '-' else args.log_file)
+    phase_timing.enable_timing(args.timing)
+    if args.dead_fields:
+        for domain, domain_dead_fields in dead_fields(get_meta_dict()).items():
+            print(f"Dead fields {domain}: {domain_dead_fields}")
+
+    profile_path = "logs/profile.pstats" if args.profile == 'cprofile' else "logs/profile_tracemalloc.txt"
+    with phase_timing.profiling(args.profile, profile_path):
+        if args.filename is not None:
+            process_file(args.filename, args.streaming)
+        elif args.directory is not None:
+            only_files = [f for f in os.listdir(args.directory) if os.path.isfile(os.path.join(args.directory, f))]
+            for file in (only_files):
+                if file.endswith(".xml"):
+                    process_file(os.path.join(args.directory, file), args.streaming)
+        else:
+            logger.error("Did args parse let us  down? Have neither a file, nor a directory.")
+    field_metrics.write_summary(args.metrics_file)
+    if args.timing:
+        phase_timing.print_times()
+        phase_timing.write_times("logs/phase_timing.json")
 
 
     if False:  # for getting them on the Foundry
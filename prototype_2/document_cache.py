@@ -0,0 +1,150 @@
+""" Cache of parsed documents, keyed by their content
+
+    Feeds resend the same documents, so layer_datasets.process_file() can keep the
+    DataFrames it made from each document and, when the same bytes come again,
+    use them instead of parsing. The key is a SHA-256 of the file's bytes and of
+    a fingerprint of what the output depends on: the metadata, the parse,
+    transformation, DataFrame and field count code, the concept map and the ID
+    hash functions. Changing any of them changes every key, so stale entries are
+    never read, and are evicted in time.
+
+    Entries are pickles of {'dataframes': {domain: DataFrame}, 'field_counts': ...}
+    in a directory, one file per key, written to a temporary file and renamed so
+    worker processes can share the directory. The field counts are those of the
+    parse, so field_metrics comes out the same for a cached document. IDs aren't
+    recorded for --check-id-collisions on a hit.
+
+    Pickle rather than Parquet or a DuckDB table: the DataFrames hold the parsed
+    values as Python objects, strings and ints mixed in a column, like '05' for a
+    month, which a typed store would convert, so the CSVs written from a hit
+    wouldn't match those from a parse. A file per entry also needs no lock
+    between worker processes, where a DuckDB file takes one writer at a time.
+
+    The cache is off until enable_cache() is called with a directory. evict() keeps
+    the directory under a size, removing the least recently used entries first,
+    and is run once per batch by the caller rather than on each write.
+"""
+
+import functools
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+import prototype_2.data_driven_parse as DDP
+import prototype_2.field_metrics as field_metrics
+import prototype_2.id_hashing as id_hashing
+import prototype_2.metadata as metadata
+import prototype_2.value_transformations as VT
+import prototype_2.vocabulary as vocabulary
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE_MB = 1024
+
+_cache_dir = None
+
+
+def enable_cache(cache_dir):
+    """ Turns the cache on, in cache_dir, or off if None. """
+    global _cache_dir
+    _cache_dir = cache_dir
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+def is_enabled():
+    return _cache_dir is not None
+
+
+@functools.lru_cache
+def _fingerprint(hash_function_names):
+    """ A hash of the ID hash functions, by name, the sources of the metadata and
+        of the code that makes and counts a document's DataFrames, and the concept map.
+    """
+    fingerprint = hashlib.sha256("-".join(hash_function_names).encode('utf-8'))
+    fingerprint.update(vocabulary.concept_map_hash().encode('utf-8'))
+    metadata_dir = os.path.dirname(metadata.__file__)
+    source_files = sorted(glob.glob(os.path.join(metadata_dir, "*.py")))
+    source_files += [DDP.__file__, VT.__file__, vocabulary.__file__, id_hashing.__file__,
+                     field_metrics.__file__, __file__]
+    # layer_datasets imports this module, so its source is found by path
+    source_files.append(os.path.join(os.path.dirname(__file__), "layer_datasets.py"))
+    for source_file in source_files:
+        with open(source_file, 'rb') as f:
+            fingerprint.update(f.read())
+    return fingerprint.hexdigest()
+
+
+def document_key(filepath):
+    """ The cache key for the document: its bytes and the current fingerprint. """
+    hash_function_names = tuple(f"{data_type}={hash_function.__name__}" for (data_type, hash_function)
+                                in sorted(id_hashing.data_type_hash_functions.items()))
+    key = hashlib.sha256(_fingerprint(hash_function_names).encode('utf-8'))
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            key.update(chunk)
+    return key.hexdigest()
+
+
+def _entry_path(key):
+    return os.path.join(_cache_dir, f"{key}.pkl")
+
+
+def get(key):
+    """ Returns the entry for the key, or None on a miss. A hit marks the entry as
+        recently used.
+    """
+    entry_path = _entry_path(key)
+    try:
+        with open(entry_path, 'rb') as f:
+            entry = pickle.load(f)
+        os.utime(entry_path)
+        return entry
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        logger.warning(f"CACHE unreadable entry {entry_path}, parsing again: {e}")
+        return None
+
+
+def put(key, dataframe_dict, field_counts):
+    fd, temp_path = tempfile.mkstemp(dir=_cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'dataframes': dataframe_dict, 'field_counts': field_counts}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, _entry_path(key))
+    except OSError as e:
+        logger.warning(f"CACHE couldn't write entry {key}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def evict(max_bytes=CACHE_SIZE_MB * 1024 * 1024):
+    """ Removes the least recently used entries until the cache is under max_bytes.
+        Returns (entries kept, entries removed).
+    """
+    if _cache_dir is None:
+        return (0, 0)
+    entries = []
+    for dir_entry in os.scandir(_cache_dir):
+        if dir_entry.name.endswith(".pkl"):
+            stat = dir_entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+    total_bytes = sum(size for (mtime, size, path) in entries)
+    removed = 0
+    for (mtime, size, path) in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total_bytes -= size
+            removed += 1
+        except FileNotFoundError:
+            pass
+    if removed > 0:
+        logger.info(f"CACHE evicted {removed} entries, {total_bytes} bytes left")
+    return (len(entries) - removed, removed)
@@ -0,0 +1,110 @@
+""" Extraction metrics per domain and field
+
+    data_driven_parse counts what happened to each field of each row it parses,
+    keyed by (domain, field, outcome), so the data quality of a run can be seen
+    without grepping the logs. Outcomes:
+    - found:              a value was extracted or derived
+    - missing_element:    the field's element isn't under the root element
+    - missing_attribute:  the element is there, but not the attribute
+    - missing_fk:         an FK with no PK parsed for it yet
+    - derived_failure:    a DERIVED or DOMAIN function failed, or lacked an input
+    - unmapped_concept:   a concept mapping function found no concept for the code
+    - no_value:           any other function returned None
+    - skipped:            a priority candidate, or its input, not parsed because a
+                          candidate before it had a value
+    - routed_away:        on the '(row)' field, root elements whose domain_id
+                          routed them to another domain
+    - rows:               on the '(row)' field, rows output for the domain
+
+    Counts are kept in the process until taken with take_counts(), so a worker
+    process can send them back to the parent, where add_counts() adds them to the
+    run. write_summary() writes the run's counts as CSV or JSON.
+"""
+
+import csv
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+ROW = '(row)'
+
+OUTCOMES = ['found', 'missing_element', 'missing_attribute', 'missing_fk',
+            'derived_failure', 'unmapped_concept', 'no_value', 'skipped', 'routed_away', 'rows']
+
+_counts = {}      # (domain, field, outcome) -> count, since the last take
+_run_counts = {}  # (domain, field, outcome) -> count, for the whole run
+
+
+def count(domain, field_tag, outcome):
+    key = (domain, field_tag, outcome)
+    _counts[key] = _counts.get(key, 0) + 1
+
+
+def take_counts():
+    """ Returns the counts since the last call and starts over. """
+    global _counts
+    counts = _counts
+    _counts = {}
+    return counts
+
+
+def merge_counts(counts):
+    """ Adds counts, like those from a document cache entry, to the counts not yet taken. """
+    for key, number in counts.items():
+        _counts[key] = _counts.get(key, 0) + number
+
+
+def add_counts(counts):
+    """ Adds counts from take_counts(), possibly from another process, to this run. """
+    for key, number in counts.items():
+        _run_counts[key] = _run_counts.get(key, 0) + number
+
+
+def get_counts():
+    """ Returns the counts for the run, including any not yet added with add_counts(). """
+    add_counts(take_counts())
+    return dict(_run_counts)
+
+
+def clear_counts():
+    global _counts
+    _counts = {}
+    _run_counts.clear()
+
+
+def summarize(counts):
+    """ Returns a list of dicts, one per (domain, field), with a count for each outcome. """
+    summary = {}
+    for (domain, field_tag, outcome), number in counts.items():
+        if (domain, field_tag) not in summary:
+            summary[(domain, field_tag)] = dict({'domain': domain, 'field': field_tag},
+                                                **{outcome_name: 0 for outcome_name in OUTCOMES})
+        summary[(domain, field_tag)][outcome] += number
+    return [summary[key] for key in sorted(summary)]
+
+
+def domain_totals(counts):
+    """ Returns {domain: {outcome: count}} summed over the domain's fields. """
+    totals = {}
+    for (domain, field_tag, outcome), number in counts.items():
+        domain_totals_dict = totals.setdefault(domain, {})
+        domain_totals_dict[outcome] = domain_totals_dict.get(outcome, 0) + number
+    return totals
+
+
+def write_summary(file_path, counts=None):
+    """ Writes summarize() of the counts, the run's by default, to file_path,
+        as JSON if it ends with .json and CSV otherwise.
+    """
+    if counts is None:
+        counts = get_counts()
+    summary = summarize(counts)
+    with open(file_path, 'w', newline='') as summary_file:
+        if file_path.endswith('.json'):
+            json.dump(summary, summary_file, indent=2)
+        else:
+            writer = csv.DictWriter(summary_file, fieldnames=['domain', 'field'] + OUTCOMES)
+            writer.writeheader()
+            writer.writerows(summary)
+    logger.info(f"METRICS wrote {len(summary)} fields to {file_path}")
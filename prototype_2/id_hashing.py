@@ -0,0 +1,134 @@
+""" Hashing identifiers into integer IDs
+
+    Used for fields with the INTEGERHASH or BIGINTHASH data_type, and for HASH fields.
+    Each data_type uses one of the functions in hash_functions, chosen in
+    data_type_hash_functions and changeable with set_hash_function().
+    All of them are stable across processes and runs, unlike Python's hash().
+
+    - INTEGERHASH defaults to sha256_31, the original scheme: the SHA-256 hex digest
+      as an int, modulo 2**31, to fit the 32-bit integer IDs in the OMOP 5.3 DDL.
+      Changing it changes every ID it produces.
+    - BIGINTHASH defaults to blake2b_63, an 8 byte BLAKE2b digest masked to a
+      non-negative signed 64-bit integer, for BIGINT ID columns. It's cheaper and,
+      at 63 bits, a birthday collision is not expected until billions of IDs rather
+      than ~65k. person_id and measurement_id use it, and are bigint in the DDL in
+      resources/.
+
+    Collision detection is off by default. When on, every hash input is recorded with
+    its ID, so two different inputs that land on the same ID within a run can be
+    reported by get_id_collisions(). Recorded IDs can be taken out of a worker
+    process with take_recorded_ids() and added to the parent with add_recorded_ids().
+"""
+
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+MASK_31 = 2**31 - 1
+MASK_63 = 2**63 - 1
+
+
+def sha256_31(input_string):
+    hash_value = hashlib.sha256(input_string.encode('utf-8')).hexdigest()
+    return int(hash_value, 16) % 2**31  # signed 4 byte int
+
+
+def blake2b_31(input_string):
+    digest = hashlib.blake2b(input_string.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') & MASK_31
+
+
+def blake2b_63(input_string):
+    digest = hashlib.blake2b(input_string.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') & MASK_63
+
+
+hash_functions = {
+    'sha256_31': sha256_31,
+    'blake2b_31': blake2b_31,
+    'blake2b_63': blake2b_63
+}
+
+try:
+    import xxhash
+
+    def xxh64_31(input_string):
+        return xxhash.xxh64_intdigest(input_string.encode('utf-8')) & MASK_31
+
+    def xxh64_63(input_string):
+        return xxhash.xxh64_intdigest(input_string.encode('utf-8')) & MASK_63
+
+    hash_functions['xxh64_31'] = xxh64_31
+    hash_functions['xxh64_63'] = xxh64_63
+except ImportError:
+    pass
+
+
+data_type_hash_functions = {
+    'INTEGERHASH': sha256_31,
+    'BIGINTHASH': blake2b_63
+}
+
+
+def set_hash_function(data_type, function_name):
+    """ Chooses, by name from hash_functions, the hash used for the data_type. """
+    if function_name not in hash_functions:
+        raise ValueError(f"unknown hash function {function_name}, "
+                         f"expected one of {sorted(hash_functions)}")
+    data_type_hash_functions[data_type] = hash_functions[function_name]
+
+
+_collision_detection = False
+_recorded_ids = {}  # (data_type, id) -> set of input strings, since the last take
+_run_ids = {}       # (data_type, id) -> set of input strings, for the whole run
+
+
+def hash_id(input_string, data_type='INTEGERHASH'):
+    """ Returns the integer ID for the input_string using the hash for the data_type. """
+    id_value = data_type_hash_functions[data_type](input_string)
+    if _collision_detection:
+        _recorded_ids.setdefault((data_type, id_value), set()).add(input_string)
+    return id_value
+
+
+def enable_collision_detection(enabled=True):
+    global _collision_detection
+    _collision_detection = enabled
+
+
+def take_recorded_ids():
+    """ Returns the IDs recorded since the last call, with their inputs, and starts over. """
+    global _recorded_ids
+    recorded_ids = _recorded_ids
+    _recorded_ids = {}
+    return recorded_ids
+
+
+def add_recorded_ids(recorded_ids):
+    """ Adds IDs from take_recorded_ids(), possibly from another process, to this run. """
+    for key, input_strings in recorded_ids.items():
+        if key in _run_ids:
+            _run_ids[key].update(input_strings)
+        else:
+            _run_ids[key] = set(input_strings)
+
+
+def get_id_collisions():
+    """ Returns {(data_type, id): sorted list of inputs} for the IDs of this run that
+        came from more than one distinct input. IDs recorded but not yet added
+        with add_recorded_ids() are included.
+    """
+    add_recorded_ids(take_recorded_ids())
+    return {key: sorted(input_strings) for (key, input_strings) in _run_ids.items()
+            if len(input_strings) > 1}
+
+
+def report_id_collisions():
+    """ Logs and returns the number of colliding IDs in this run. The inputs are
+        identifiers like SSNs, so only the IDs and counts are logged.
+    """
+    collisions = get_id_collisions()
+    for (data_type, id_value), input_strings in collisions.items():
+        logger.error(f"ID collision {data_type} {id_value} from {len(input_strings)} distinct inputs")
+    return len(collisions)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+""" Import-time budget for the entry points
+
+    Short runs, like one document per job, spend much of their time importing.
+    This imports each module in IMPORT_BUDGETS_MS in a fresh interpreter with
+    python -X importtime, takes the best of a few runs, and compares the
+    cumulative time to its budget. It also fails if a module in DEFERRED_MODULES,
+    like pandas, was imported, since those are meant to load only when first used.
+
+    From the directory above prototype_2:
+    - python -m prototype_2.import_budget
+    - python -m prototype_2.import_budget --runs 5 --show 10 -o logs/import_budget.json
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+# cumulative milliseconds for `import module`, measured with -X importtime
+IMPORT_BUDGETS_MS = {
+    'prototype_2': 10,
+    'prototype_2.metadata': 80,
+    'prototype_2.data_driven_parse': 150,
+    'prototype_2.layer_datasets': 200,
+}
+
+DEFERRED_MODULES = ['pandas', 'numpy', 'pyarrow', 'duckdb']
+
+
+def measure_import(module_name):
+    """ Returns [(imported module, depth, self us, cumulative us)] for importing
+        module_name in a new interpreter, in -X importtime order: each module after
+        the ones it imported, which are one level deeper.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module_name}"],
+                            capture_output=True, text=True, check=True)
+    import_times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        (self_us, cumulative_us, imported_name) = line[len('import time:'):].split('|')
+        depth = (len(imported_name) - len(imported_name.lstrip()) - 1) // 2
+        import_times.append((imported_name.strip(), depth, int(self_us), int(cumulative_us)))
+    return import_times
+
+
+def _module_imports(import_times, module_name):
+    """ Returns (cumulative us for module_name, [(name, cumulative us)] of what it imported),
+        leaving out what the interpreter imported at startup.
+    """
+    for position in range(len(import_times) - 1, -1, -1):
+        (name, depth, self_us, cumulative_us) = import_times[position]
+        if name == module_name and depth == 0:
+            subtree = []
+            for (child_name, child_depth, child_self_us, child_cumulative_us) in reversed(import_times[:position]):
+                if child_depth == 0:
+                    break
+                subtree.append((child_name, child_cumulative_us))
+            return (cumulative_us, subtree)
+    raise ValueError(f"no import time for {module_name}")
+
+
+def check_budgets(budgets, runs=3, n_show=5):
+    """ Measures each module, best of runs, and returns a list of dicts with its
+        time, budget, the deferred modules it imported and its slowest imports.
+    """
+    report = []
+    for module_name, budget_ms in budgets.items():
+        measurements = [_module_imports(measure_import(module_name), module_name) for run in range(runs)]
+        (cumulative_us, subtree) = min(measurements, key=lambda measurement: measurement[0])
+        imported_names = set(name for (name, child_cumulative_us) in subtree)
+        slowest = sorted(subtree, key=lambda item: -item[1])[:n_show]
+        report.append({
+            'module': module_name,
+            'ms': cumulative_us / 1000,
+            'budget_ms': budget_ms,
+            'deferred_imported': [name for name in DEFERRED_MODULES if name in imported_names],
+            'slowest': [{'module': name, 'ms': child_cumulative_us / 1000}
+                        for (name, child_cumulative_us) in slowest]
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='import_budget',
+        description="checks the import time of the entry points against a budget")
+    parser.add_argument('--runs', type=int, default=3, help="best of this many imports per module")
+    parser.add_argument('--show', type=int, default=5, help="slowest imports to show per module")
+    parser.add_argument('-o', '--output', help="write the report as JSON")
+    args = parser.parse_args()
+
+    report = check_budgets(IMPORT_BUDGETS_MS, args.runs, args.show)
+    over_budget = False
+    for entry in report:
+        status = "ok"
+        if entry['ms'] > entry['budget_ms']:
+            status = "OVER BUDGET"
+            over_budget = True
+        if len(entry['deferred_imported']) > 0:
+            status = f"IMPORTS {', '.join(entry['deferred_imported'])}"
+            over_budget = True
+        print(f"{entry['module']:32} {entry['ms']:8.1f} ms  budget {entry['budget_ms']:6} ms  {status}")
+        for slow in entry['slowest']:
+            print(f"    {slow['module']:40} {slow['ms']:8.1f} ms")
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import functools
 import os
-import pandas as pd
-
-
-
+import traceback
 import logging
 import prototype_2.data_driven_parse as DDP
+import prototype_2.value_transformations as VT
+import prototype_2.vocabulary as vocabulary
+import prototype_2.id_hashing as id_hashing
+import prototype_2.field_metrics as field_metrics
+import prototype_2.phase_timing as phase_timing
+import prototype_2.output_writers as output_writers
+import prototype_2.document_cache as document_cache
+from prototype_2.logging_config import configure_logging, log_context, start_queue_logging
 from prototype_2.metadata import get_meta_dict
 
-
-import lxml
-print(lxml.__file__)
-
 logger = logging.getLogger(__name__)
 
 
@@ -25,33 +28,36 @@ def create_omop_domain_dataframes(omop_data, filepath):
     """ transposes the rows into columns,
         creates a Pandas dataframe
     """
+    import pandas as pd
+
     df_dict = {}
     for domain_name, domain_list in omop_data.items():
-        # Transpose to a dictoinary of named columns.
+        with log_context(domain=domain_name):
+            # Transpose to a dictoinary of named columns.
 
-        # Initialize a dictionary of columns from the first row
-        column_dict = {}
-        if domain_list is None or len(domain_list) < 1:
-            logger.error(f"No data for {domain_name} from {filepath}")
-        else:
-            for field, parts in domain_list[0].items():
-                column_dict[field] = []
+            # Initialize a dictionary of columns from the first row
+            column_dict = {}
+            if domain_list is None or len(domain_list) < 1:
+                logger.error(f"No data for {domain_name} from {filepath}")
+            else:
+                for field, parts in domain_list[0].items():
+                    column_dict[field] = []
 
-        # Add the data from all the rows
-        if domain_list is None or len(domain_list) < 1:
-            logger.error(f"No data for {domain_name} from {filepath}")
-        else:
-            for domain_data_dict in domain_list:
-                for field, parts in domain_data_dict.items():
-                    column_dict[field].append(parts[0])
-
-        # create a Pandas dataframe from the data_dict
-        try:
-            domain_df = pd.DataFrame(column_dict)
-        except ValueError as ve:
-            logger.error(f"ERROR {ve}")
-            show_column_dict(column_dict)
-        df_dict[domain_name] = domain_df
+            # Add the data from all the rows
+            if domain_list is None or len(domain_list) < 1:
+                logger.error(f"No data for {domain_name} from {filepath}")
+            else:
+                for domain_data_dict in domain_list:
+                    for field, parts in domain_data_dict.items():
+                        column_dict[field].append(parts[0])
+
+            # create a Pandas dataframe from the data_dict
+            try:
+                domain_df = pd.DataFrame(column_dict)
+            except ValueError as ve:
+                logger.error(f"ERROR {ve}")
+                show_column_dict(column_dict)
+            df_dict[domain_name] = domain_df
 
     return df_dict
 
@@ -65,32 +71,172 @@ def write_csvs_from_dataframe_dict(df_dict, file_name, folder):
                                 sep=",", header=True, index=False)
 
 
-def process_file(filepath):
+def process_file(filepath, streaming=False, write_csv=True):
     """ processes file, creates dataset and writes csv
         returns dataset
+        streaming reads the file incrementally, see DDP.parse_doc_streaming()
+        write_csv False leaves the writing to the caller, as for a batch writer
     """
-    logger.info(f"PROCESSING {filepath} ")
     base_name = os.path.basename(filepath)
+    with log_context(document=base_name, domain='-'):
+        logger.info(f"PROCESSING {filepath} ")
+        cache_key = None
+        if document_cache.is_enabled():
+            lap = phase_timing.start_laps(phase_timing.DOCUMENT, base_name) if phase_timing.enabled else None
+            cache_key = document_cache.document_key(filepath)
+            cache_entry = document_cache.get(cache_key)
+            if lap: lap('cache_lookup')
+            if cache_entry is not None:
+                logger.info(f"CACHE hit for {filepath}")
+                field_metrics.merge_counts(cache_entry['field_counts'])
+                dataframe_dict = cache_entry['dataframes']
+                if write_csv:
+                    write_csvs_from_dataframe_dict(dataframe_dict, base_name, "output")
+                    if lap: lap('write_csv')
+                return dataframe_dict
+            pending_counts = field_metrics.take_counts()
+
+        omop_data = DDP.parse_doc(filepath, get_meta_dict(), streaming)
+        lap = phase_timing.start_laps(phase_timing.DOCUMENT, base_name) if phase_timing.enabled else None
+        # DDP.print_omop_structure(omop_data)
+        if omop_data is not None or len(omop_data) < 1:
+            dataframe_dict = create_omop_domain_dataframes(omop_data, filepath)
+        else:
+            logger.error(f"no data from {filepath}")
+        if lap: lap('dataframes')
+        if cache_key is not None:
+            document_counts = field_metrics.take_counts()
+            field_metrics.merge_counts(pending_counts)
+            field_metrics.merge_counts(document_counts)
+            document_cache.put(cache_key, dataframe_dict, document_counts)
+            if lap: lap('cache_store')
+        if write_csv:
+            write_csvs_from_dataframe_dict(dataframe_dict, base_name, "output")
+            if lap: lap('write_csv')
+
+        return dataframe_dict
+
+def accumulate_dataframes(accumulator_dict, new_data_dict):
+    """ Adds each domain's DataFrame from one file to the list kept for that domain
+        in accumulator_dict. Nothing is copied until materialize_dataframes(), so
+        collecting N files is linear in N rather than re-concatenating every time.
+    """
+    for domain_name, domain_df in new_data_dict.items():
+        if domain_name not in accumulator_dict:
+            accumulator_dict[domain_name] = []
+        if domain_df is not None:
+            accumulator_dict[domain_name].append(domain_df)
+
+
+def materialize_dataframes(accumulator_dict):
+    """ Concatenates the DataFrames collected by accumulate_dataframes() once per
+        domain. Returns a dict of DataFrames keyed by domain, or None for a domain
+        that never got one.
+    """
+    import pandas as pd
+
+    df_dict = {}
+    for domain_name, domain_df_list in accumulator_dict.items():
+        if len(domain_df_list) > 0:
+            df_dict[domain_name] = pd.concat(domain_df_list)
+        else:
+            df_dict[domain_name] = None
+    return df_dict
+
+
+def configure_run(run_options):
+    """ Applies the run-wide settings in the run_options dict to this process.
+        Called by main(), and by init_worker() in each process of a pool.
+    """
+    if 'log_level' in run_options:
+        configure_logging(run_options['log_level'], run_options.get('log_file'),
+                          run_options.get('log_queue'))
+    if run_options.get('integer_hash') is not None:
+        id_hashing.set_hash_function('INTEGERHASH', run_options['integer_hash'])
+    if run_options.get('bigint_hash') is not None:
+        id_hashing.set_hash_function('BIGINTHASH', run_options['bigint_hash'])
+    id_hashing.enable_collision_detection(run_options.get('check_id_collisions', False))
+    phase_timing.enable_timing(run_options.get('timing', False))
+    document_cache.enable_cache(run_options.get('document_cache'))
+    DDP.enable_concept_prefetch(run_options.get('prefetch_concepts', False))
+
+
+def init_worker(run_options):
+    """ Runs once in each worker process of a pool, so the metadata is compiled
+        and the concept index is loaded before the first file instead of per file.
+    """
+    configure_run(run_options)
+    for domain, domain_meta_dict in get_meta_dict().items():
+        DDP.get_domain_plan(domain, domain_meta_dict)
+    vocabulary.load_concept_map()
+
+
+def take_file_stats():
+    """ Collects what the process recorded about the file just processed, for
+        add_file_stats() in the parent, and resets it.
+    """
+    return {'recorded_ids': id_hashing.take_recorded_ids(),
+            'field_counts': field_metrics.take_counts(),
+            'times': phase_timing.take_times()}
+
+
+def add_file_stats(file_stats):
+    id_hashing.add_recorded_ids(file_stats['recorded_ids'])
+    field_metrics.add_counts(file_stats['field_counts'])
+    phase_timing.add_times(file_stats['times'])
+
+
+def process_file_safely(filepath, streaming=False, write_csv=True):
+    """ process_file() for use in a batch: returns (filepath, dataframe_dict, error, file_stats)
+        and catches any exception, so one bad file doesn't stop the others.
+        error is None on success, and dataframe_dict is None on failure.
+        file_stats is from take_file_stats().
+    """
+    try:
+        dataframe_dict = process_file(filepath, streaming, write_csv)
+        return (filepath, dataframe_dict, None, take_file_stats())
+    except Exception:
+        return (filepath, None, traceback.format_exc(), take_file_stats())
 
-    logging.basicConfig(
-        format='%(levelname)s: %(message)s',
-        filename=f"logs/log_file_{base_name}.log",
-        force=True,
-        # level=logging.ERROR
-        level=logging.WARNING
-        # level=logging.INFO
-        # level=logging.DEBUG
-    )
-
-    omop_data = DDP.parse_doc(filepath, get_meta_dict())
-    # DDP.print_omop_structure(omop_data)
-    if omop_data is not None or len(omop_data) < 1:
-        dataframe_dict = create_omop_domain_dataframes(omop_data, filepath)
+
+def process_files(filepath_list, workers=1, streaming=False, run_options=None, write_csv=True):
+    """ Generator over process_file_safely() results for each file, in the order
+        given. With more than one worker the files are parsed in a process pool,
+        set up with run_options, and the results are sent back to this process.
+    """
+    if workers <= 1:
+        for filepath in filepath_list:
+            yield process_file_safely(filepath, streaming, write_csv)
     else:
-        logger.error(f"no data from {filepath}")
-    write_csvs_from_dataframe_dict(dataframe_dict, base_name, "output")
-    
-    return dataframe_dict
+        # compile the concept map here if it's stale, so the workers all map the same arrays
+        vocabulary.load_concept_map()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    initializer=init_worker,
+                                                    initargs=(run_options or {},)) as executor:
+            yield from executor.map(functools.partial(process_file_safely, streaming=streaming,
+                                                      write_csv=write_csv),
+                                    filepath_list,
+                                    chunksize=max(1, len(filepath_list) // (workers * 8)))
+
+
+def open_batch_writer(args):
+    """ Returns the writer for --output-format, see output_writers, or None for
+        the default, a CSV per document and domain written as each file is processed.
+    """
+    if args.output_format == 'parquet':
+        return output_writers.open_parquet_writer(os.path.join("output", "parquet"),
+                                                  compression=args.compression,
+                                                  row_group_size=args.row_group_size,
+                                                  rows_per_file=args.rows_per_file)
+    if args.output_format == 'duckdb':
+        import omop.duckdb_sink as duckdb_sink
+        import omop.setup_omop as setup_omop
+        if args.overwrite and os.path.exists(args.duckdb_file):
+            os.remove(args.duckdb_file)
+        return duckdb_sink.open_duckdb_sink(setup_omop.connect(args.duckdb_file),
+                                            batch_rows=args.row_group_size)
+    return None
+
 
 def dict_summary(my_dict):
     for key in my_dict:
@@ -105,31 +251,130 @@ def main():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-d', '--directory', help="directory of files to parse")
     group.add_argument('-f', '--filename', help="filename to parse")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="number of processes parsing files in parallel with -d")
+    parser.add_argument('-s', '--streaming', action='store_true',
+                        help="read files incrementally with iterparse, for very large documents")
+    parser.add_argument('--integer-hash', choices=sorted(id_hashing.hash_functions),
+                        help="hash for INTEGERHASH IDs, default sha256_31. Changes the IDs.")
+    parser.add_argument('--bigint-hash', choices=sorted(id_hashing.hash_functions),
+                        help="hash for BIGINTHASH IDs, person_id and measurement_id, default blake2b_63. Changes the IDs.")
+    parser.add_argument('--check-id-collisions', action='store_true',
+                        help="report hashed IDs that different inputs produced during the run")
+    parser.add_argument('--log-level', default='WARNING',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-file', default="logs/layer_datasets.log",
+                        help="one log for the run, '-' for stdout")
+    parser.add_argument('--log-queue', action='store_true',
+                        help="hand log records to a listener thread, shared by all workers")
+    parser.add_argument('--metrics-file', default="logs/field_metrics.csv",
+                        help="per domain and field extraction counts, CSV or .json")
+    parser.add_argument('--timing', action='store_true',
+                        help="time each phase per domain and document, print and write to logs/phase_timing.json")
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'],
+                        help="profile the batch in this process, use with -w 1 to include the parse")
+    parser.add_argument('--output-format', choices=['csv', 'parquet', 'duckdb'], default='csv',
+                        help="csv per document and domain, parquet in large files per domain under output/parquet,"
+                             " or duckdb to load the OMOP tables of --duckdb-file directly")
+    parser.add_argument('--duckdb-file', default="omop.duckdb",
+                        help="DuckDB database for --output-format duckdb, created by the run")
+    parser.add_argument('--overwrite', action='store_true',
+                        help="replace the --duckdb-file if it already exists")
+    parser.add_argument('--compression', default='zstd',
+                        help="parquet compression: zstd, snappy, gzip, none")
+    parser.add_argument('--row-group-size', type=int, default=output_writers.ROW_GROUP_SIZE,
+                        help="rows per parquet row group, or per duckdb insert")
+    parser.add_argument('--rows-per-file', type=int, default=output_writers.ROWS_PER_FILE)
+    parser.add_argument('--document-cache',
+                        help="directory caching each document's DataFrames by content, so resent documents aren't parsed")
+    parser.add_argument('--document-cache-mb', type=int, default=document_cache.CACHE_SIZE_MB,
+                        help="size the document cache is trimmed to after the run, least recently used first")
+    parser.add_argument('--prefetch-concepts', action='store_true',
+                        help="look up the codes of each batch of root elements in the concept map at once, "
+                             "before parsing the rows")
     args = parser.parse_args()
+    if args.output_format == 'duckdb' and os.path.exists(args.duckdb_file) and not args.overwrite:
+        parser.error(f"{args.duckdb_file} already exists, use --overwrite to replace it")
+
+    log_file = None if args.log_file == '-' else args.log_file
+    run_options = {
+        'log_level': args.log_level,
+        'log_file': log_file,
+        'integer_hash': args.integer_hash,
+        'bigint_hash': args.bigint_hash,
+        'check_id_collisions': args.check_id_collisions,
+        'timing': args.timing,
+        'document_cache': args.document_cache,
+        'prefetch_concepts': args.prefetch_concepts
+    }
+    if args.log_queue:
+        run_options['log_queue'] = start_queue_logging(args.log_level, log_file)
+    configure_run(run_options)
 
     omop_data_dict = {}
-    if args.filename is not None:
-        process_file(args.filename)
-    elif args.directory is not None:
-        only_files = [f for f in os.listdir(args.directory) if os.path.isfile(os.path.join(args.directory, f))]
-        for file in (only_files):
-            if file.endswith(".xml"):
-                new_data_dict = process_file(os.path.join(args.directory, file))
-                for key in new_data_dict:
-                    if key in omop_data_dict and omop_data_dict[key] is not None:
-                        if new_data_dict[key] is  not None:
-                            omop_data_dict[key] = pd.concat([omop_data_dict[key], new_data_dict[key]])
+    accumulator_dict = {}
+    batch_writer = open_batch_writer(args)
+    profile_path = "logs/profile.pstats" if args.profile == 'cprofile' else "logs/profile_tracemalloc.txt"
+    with phase_timing.profiling(args.profile, profile_path):
+        if args.filename is not None:
+            new_data_dict = process_file(args.filename, args.streaming, batch_writer is None)
+            if batch_writer is not None:
+                batch_writer['write'](new_data_dict, os.path.basename(args.filename))
+        elif args.directory is not None:
+            only_files = [f for f in os.listdir(args.directory) if os.path.isfile(os.path.join(args.directory, f))]
+            xml_files = [os.path.join(args.directory, f) for f in only_files if f.endswith(".xml")]
+            failed_files = []
+            for (filepath, new_data_dict, error, file_stats) in process_files(xml_files, args.workers,
+                                                                              args.streaming, run_options,
+                                                                              batch_writer is None):
+                file = os.path.basename(filepath)
+                add_file_stats(file_stats)
+                with log_context(document=file, domain='-'):
+                    if error is not None:
+                        logger.error(f"FILE {filepath} failed: {error}")
+                        failed_files.append(filepath)
+                        continue
+                    for key in new_data_dict:
+                        logger.info(f"{file} {key} {new_data_dict[key].shape}")
+                    if batch_writer is not None:
+                        # the writer has what it needs, so the document's frames aren't kept
+                        batch_writer['write'](new_data_dict, file)
                     else:
-                        omop_data_dict[key]= new_data_dict[key]
-                    logger.info(f"{file} {key} {len(omop_data_dict)} {omop_data_dict[key].shape} {new_data_dict[key].shape}")
-    else:
-        logger.error("Did args parse let us  down? Have neither a file, nor a directory.")
+                        accumulate_dataframes(accumulator_dict, new_data_dict)
+            if len(failed_files) > 0:
+                print(f"{len(failed_files)} of {len(xml_files)} files failed: {failed_files}")
+            lap = phase_timing.start_laps(phase_timing.DOCUMENT) if phase_timing.enabled else None
+            omop_data_dict = materialize_dataframes(accumulator_dict)
+            if lap: lap('concatenate')
+        else:
+            logger.error("Did args parse let us  down? Have neither a file, nor a directory.")
+        if batch_writer is not None:
+            print(f"Wrote {args.output_format} rows: {batch_writer['close']()}")
 
         ## ccd_ambulatory_path = ccd_ambulatory_files['CCDA_CCD_b1_Ambulatory_v2.xml']  ## FIX oddity from a merge?
 
 
     for key in omop_data_dict:
-        logger.info(f"Summary {key} {omop_data_dict[key].shape}")
+        if omop_data_dict[key] is not None:
+            logger.info(f"Summary {key} {omop_data_dict[key].shape}")
+    if args.workers <= 1:
+        print(f"Concept cache: {VT.concept_cache_info()}")
+    if args.check_id_collisions:
+        print(f"ID collisions: {id_hashing.report_id_collisions()}")
+    if document_cache.is_enabled():
+        (kept, evicted) = document_cache.evict(args.document_cache_mb * 1024 * 1024)
+        print(f"Document cache: {kept} entries, {evicted} evicted")
+    if args.timing:
+        phase_timing.print_times()
+        phase_timing.write_times("logs/phase_timing.json")
+    field_counts = field_metrics.get_counts()
+    field_metrics.write_summary(args.metrics_file, field_counts)
+    for domain, totals in field_metrics.domain_totals(field_counts).items():
+        print(f"Fields {domain}: {totals}")
+
+    if batch_writer is not None:
+        # the rows went to the batch writer, there are no DataFrames to export
+        return
 
     # EXPORT VARS
     export_person = omop_data_dict['Person']
@@ -0,0 +1,99 @@
+""" Logging for a run
+
+    Logging is configured once per run, by the entry point, with configure_logging().
+    Every record carries the document and domain being parsed, set with
+    set_log_context() as the parse moves along, or with log_context() for a block,
+    instead of each document and domain getting its own log file. The context is
+    kept in contextvars, so it is per thread as well as per process.
+
+    With a log queue, records are put on a multiprocessing queue and a single
+    listener in the main process does the formatting and writing, see
+    start_queue_logging(). Worker processes call configure_logging() with the queue.
+"""
+
+import atexit
+import contextlib
+import contextvars
+import logging
+import logging.handlers
+import sys
+
+LOG_FORMAT = '%(levelname)s: [%(document)s %(domain)s] %(message)s'
+
+_document = contextvars.ContextVar('document', default='-')
+_domain = contextvars.ContextVar('domain', default='-')
+
+
+def set_log_context(document=None, domain=None):
+    """ Sets the document and/or domain shown on records logged from here on. """
+    if document is not None:
+        _document.set(document)
+    if domain is not None:
+        _domain.set(domain)
+
+
+@contextlib.contextmanager
+def log_context(document=None, domain=None):
+    """ set_log_context() for the records logged within a with block. The document
+        and domain from before the block are put back after it, whatever was set
+        within it.
+    """
+    document_token = _document.set(document) if document is not None else None
+    domain_token = _domain.set(domain) if domain is not None else None
+    try:
+        yield
+    finally:
+        if domain_token is not None:
+            _domain.reset(domain_token)
+        if document_token is not None:
+            _document.reset(document_token)
+
+
+def add_log_context(record):
+    """ logging filter that puts the document and domain on each record """
+    record.document = _document.get()
+    record.domain = _domain.get()
+    return True
+
+
+def _output_handler(filename):
+    if filename is None:
+        handler = logging.StreamHandler(sys.stdout)
+    else:
+        handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    return handler
+
+
+def configure_logging(level=logging.WARNING, filename=None, log_queue=None):
+    """ Replaces the root logger's handlers with one that writes to filename, or
+        stdout if None, or that puts records on log_queue for a listener in
+        another process. Call once per run, and once in each worker process.
+    """
+    if log_queue is not None:
+        handler = logging.handlers.QueueHandler(log_queue)
+    else:
+        handler = _output_handler(filename)
+    handler.addFilter(add_log_context)
+
+    root_logger = logging.getLogger()
+    for old_handler in root_logger.handlers[:]:
+        root_logger.removeHandler(old_handler)
+        old_handler.close()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(level)
+
+
+def start_queue_logging(level=logging.WARNING, filename=None):
+    """ Configures this process to log through a queue, with a listener thread that
+        writes to filename, or stdout. Returns the queue, for configure_logging()
+        in worker processes. The listener is stopped, and the queue drained, at exit.
+    """
+    import multiprocessing
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, _output_handler(filename),
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    configure_logging(level, log_queue=log_queue)
+    return log_queue
@@ -20,6 +20,7 @@ metadata = {
     	},
     	'measurement_id_hash': {
     	    'config_type': 'HASH',
+            'data_type': 'BIGINTHASH',
             'fields' : ['person_id', 'visit_occurrence_id', 'measurement_concept_id', 'measurement_time', 'value_as_string'],
             'priority': ('measurement_id', 100)
     	},
@@ -15,35 +15,35 @@ metadata = {
         # TODO (cont) root and extension...like if the extension is only unique within a system identified by the root.
     	'person_id_anna_flux': {
     	    'config_type': 'FIELD',
-            'data_type': 'INTEGERHASH',
+            'data_type': 'BIGINTHASH',
     	    'element': 'id[@root="2.16.840.1.113883.3.651.2.1"]',
     	    'attribute': "extension",
             'priority': ('person_id', 1)
     	},
     	'person_id_patient_170': {
     	    'config_type': 'FIELD',
-            'data_type': 'INTEGERHASH',
+            'data_type': 'BIGINTHASH',
     	    'element': 'id[@root="2.16.840.1.113883.3.6132"]',
     	    'attribute': "extension",
             'priority': ('person_id', 2)
     	},
     	'person_id_patient_502': {
     	    'config_type': 'FIELD',
-            'data_type': 'INTEGERHASH',
+            'data_type': 'BIGINTHASH',
     	    'element': 'id[@root="2.16.840.1.113883.19.5.99999.2"]',
     	    'attribute': "extension",
             'priority': ('person_id', 3)
     	},
     	'person_id_patient_healthconnectak': {
     	    'config_type': 'FIELD',
-            'data_type': 'INTEGERHASH',
+            'data_type': 'BIGINTHASH',
     	    'element': 'id[@root="2.16.840.1.113883.3.564.14977"]',
     	    'attribute': "extension",
             'priority': ('person_id', 4)
     	},
     	'person_id_patient_bennis_shauna': { # same OID as for eHx_Terry
     	    'config_type': 'FIELD',
-            'data_type': 'INTEGERHASH',
+            'data_type': 'BIGINTHASH',
     	    'element': 'id[@root="2.16.840.1.113883.3.7732.100"]',
     	    'attribute': "extension",
             'priority': ('person_id', 5)
@@ -51,14 +51,14 @@ metadata = {
         # more general types of person Ids
     	'person_id_ssn': {
     	    'config_type': 'FIELD',
-            'data_type': 'INTEGERHASH',
+            'data_type': 'BIGINTHASH',
     	    'element': 'id[@root="2.16.840.1.113883.4.1"]',
     	    'attribute': "extension",
             'priority': ('person_id', 103)
     	},
     	'person_id_npi': {
     	    'config_type': 'FIELD',
-            'data_type': 'INTEGERHASH',
+            'data_type': 'BIGINTHASH',
     	    'element': 'id[@root="2.16.840.1.113883.4.6"]',
     	    'attribute': "extension",
             'priority': ('person_id', 104) # (final field name, priority number)
@@ -66,7 +66,7 @@ metadata = {
     	'person_id_extension_catchall': {
             # if others fail b/c they specify roots not used, just grab an extension
     	    'config_type': 'FIELD',
-            'data_type': 'INTEGERHASH',
+            'data_type': 'BIGINTHASH',
     	    'element': 'id',
     	    'attribute': "extension",
             'priority': ('person_id', 105)
@@ -74,13 +74,14 @@ metadata = {
     	'person_id_root_catchall': {
             # if the  extension_catchall fails b/c there is no extension attribute, try just the root
     	    'config_type': 'FIELD',
-            'data_type': 'INTEGERHASH',
+            'data_type': 'BIGINTHASH',
     	    'element': 'id',
     	    'attribute': "root",
             'priority': ('person_id', 106)
     	},
     	'person_id_hash': {
     	    'config_type': 'HASH',
+            'data_type': 'BIGINTHASH',
             'fields' : [ 'family_name', 'given_name', 'street_address', 'city', 'country', 'postal_code', 'gender_concept_code', 'race_concept_code', 'ethnicity_concept_code', 'date_of_birth', 'person_id_ssn', 'person_id_other' ],
             'priority': ('person_id', 107) # (final field name, priority number)
     	},
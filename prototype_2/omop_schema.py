@@ -0,0 +1,69 @@
+""" OMOP table schemas, read from the OMOP CDM DDL
+
+    The column names and SQL types of each OMOP table come from the DuckDB DDL in
+    resources/, the same file omop/setup_omop.py loads, so output written with
+    types, like Parquet, matches the tables it's loaded into.
+
+    domain_table_names maps the domains of the metadata to their OMOP tables.
+"""
+
+import functools
+import io
+import re
+
+OMOP_DDL_FILE = "resources/OMOPCDM_duckdb_5.3_ddl.sql"
+OMOP_PRIMARY_KEYS_FILE = "resources/OMOPCDM_duckdb_5.3_primary_keys.sql"
+
+domain_table_names = {
+    'Person': 'person',
+    'Visit': 'visit_occurrence',
+    'Measurement': 'measurement',
+    'Observation': 'observation'
+}
+
+_create_table_re = re.compile(r'CREATE TABLE @cdmDatabaseSchema\.(\w+)\s*\((.*?)\);', re.DOTALL)
+_primary_key_re = re.compile(r'ALTER TABLE @cdmDatabaseSchema\.(\w+) ADD CONSTRAINT \w+ PRIMARY KEY \((\w+)\)')
+_column_re = re.compile(r'^\s*(\w+)\s+(\w+(?:\(\d+(?:,\d+)?\))?)\s+(NOT NULL|NULL)', re.IGNORECASE)
+
+
+@functools.lru_cache
+def load_omop_schema(ddl_file=OMOP_DDL_FILE):
+    """ Returns {table_name: [(column_name, sql_type, nullable), ...]} in DDL order.
+        The sql_type is lower case, ex. 'integer', 'varchar(50)', 'timestamp'.
+    """
+    with io.open(ddl_file, "r") as ddl:
+        ddl_text = ddl.read()
+
+    schema = {}
+    for table_match in _create_table_re.finditer(ddl_text):
+        columns = []
+        for column_line in table_match.group(2).split('\n'):
+            column_match = _column_re.match(column_line)
+            if column_match is not None:
+                columns.append((column_match.group(1), column_match.group(2).lower(),
+                                column_match.group(3).upper() == 'NULL'))
+        schema[table_match.group(1)] = columns
+    return schema
+
+
+@functools.lru_cache
+def load_primary_keys(primary_keys_file=OMOP_PRIMARY_KEYS_FILE):
+    """ Returns {table_name: primary key column} from the DDL's primary key constraints. """
+    with io.open(primary_keys_file, "r") as primary_keys:
+        return dict(_primary_key_re.findall(primary_keys.read()))
+
+
+def get_domain_columns(domain, ddl_file=OMOP_DDL_FILE):
+    """ Returns {column_name: sql_type} for the domain's OMOP table, or None if the
+        domain has no table.
+    """
+    table_name = domain_table_names.get(domain)
+    if table_name is None:
+        return None
+    return {column_name: sql_type
+            for (column_name, sql_type, nullable) in load_omop_schema(ddl_file)[table_name]}
+
+
+def sql_base_type(sql_type):
+    """ 'varchar(50)' -> 'varchar' """
+    return sql_type.split('(')[0]
@@ -0,0 +1,196 @@
+""" Batched output writers for layer_datasets
+
+    layer_datasets writes a CSV per document and domain as it goes, from each
+    process. The writers here instead take the DataFrames of each document in the
+    main process and write them into a few large files per domain, in batches
+    across documents.
+
+    A writer is a dict of functions, see open_parquet_writer(), and
+    omop/duckdb_sink.py for one that loads DuckDB:
+    - write(dataframe_dict, document): adds a document's DataFrames, keyed by domain
+    - close(): writes what's left and closes the files, returns {domain: rows}
+
+    parquet: one directory per OMOP table, folder/table_name/part-00000.parquet,
+    ..., each part holding up to rows_per_file rows, in row groups of
+    row_group_size rows, compressed. Rows are buffered until there is a whole row
+    group, so rows_per_file is best a multiple of row_group_size. Column types
+    come from the OMOP DDL, see omop_schema, and columns come in the metadata's
+    output order. Needs pyarrow.
+"""
+
+import glob
+import logging
+import os
+
+import prototype_2.data_driven_parse as DDP
+import prototype_2.omop_schema as omop_schema
+from prototype_2.metadata import get_meta_dict
+
+logger = logging.getLogger(__name__)
+
+# pyarrow, imported by _load_pyarrow() when a writer or schema is first needed
+pa = None
+pq = None
+
+ROW_GROUP_SIZE = 100000
+ROWS_PER_FILE = 5000000
+
+
+def _load_pyarrow():
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow, pip install pyarrow")
+        pa = pyarrow
+        pq = pyarrow.parquet
+
+
+def _arrow_type(sql_type):
+    base_type = omop_schema.sql_base_type(sql_type)
+    if base_type in ('integer', 'bigint'):
+        # 64 bits so IDs outside the DDL's 32 bits, ex. BIGINTHASH, get to the load intact
+        return pa.int64()
+    if base_type in ('numeric', 'float', 'double'):
+        return pa.float64()
+    if base_type == 'date':
+        return pa.date32()
+    if base_type in ('timestamp', 'datetime'):
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def domain_arrow_schema(domain):
+    """ The Arrow schema for the domain: its output columns, in order, typed from the
+        OMOP DDL. Columns the DDL doesn't have are strings.
+    """
+    _load_pyarrow()
+    output_order = DDP.get_domain_plan(domain, get_meta_dict()[domain])['output_order']
+    ddl_columns = omop_schema.get_domain_columns(domain) or {}
+    fields = []
+    for column_name in output_order:
+        if column_name in ddl_columns:
+            fields.append(pa.field(column_name, _arrow_type(ddl_columns[column_name])))
+        else:
+            logger.warning(f"PARQUET {domain} column {column_name} isn't in the OMOP DDL, written as string")
+            fields.append(pa.field(column_name, pa.string()))
+    return pa.schema(fields)
+
+
+def _to_arrow_column(series, arrow_type):
+    """ Converts a DataFrame column of parsed values, often strings, to the Arrow type.
+        Values that don't convert become null.
+    """
+    import pandas as pd
+
+    if pa.types.is_integer(arrow_type):
+        try:
+            return pa.array(series, type=arrow_type, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            numbers = pd.to_numeric(series, errors='coerce')
+            numbers = numbers.where(numbers % 1 == 0)
+            return pa.array(numbers.astype('Int64'), type=arrow_type, from_pandas=True)
+    if pa.types.is_floating(arrow_type):
+        return pa.array(pd.to_numeric(series, errors='coerce'), type=arrow_type, from_pandas=True)
+    if pa.types.is_date(arrow_type):
+        dates = pd.to_datetime(series, errors='coerce', format='mixed')
+        return pa.array(dates.dt.date, type=arrow_type, from_pandas=True)
+    if pa.types.is_timestamp(arrow_type):
+        timestamps = pd.to_datetime(series, errors='coerce', format='mixed')
+        return pa.array(timestamps, type=arrow_type, from_pandas=True)
+    return pa.array(series.astype('string'), type=arrow_type, from_pandas=True)
+
+
+def dataframe_to_arrow(domain_df, schema, domain):
+    """ Returns a pyarrow Table of the DataFrame with the schema. Columns missing from
+        the DataFrame are null, and values that don't convert to the column's
+        type are logged and written as null.
+    """
+    arrays = []
+    for field in schema:
+        if field.name not in domain_df.columns:
+            arrays.append(pa.nulls(len(domain_df), type=field.type))
+            continue
+        series = domain_df[field.name]
+        array = _to_arrow_column(series, field.type)
+        lost_values = array.null_count - int(series.isna().sum())
+        if lost_values > 0:
+            logger.warning(f"PARQUET {domain}.{field.name}: {lost_values} values aren't {field.type}, written as null")
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def open_parquet_writer(folder, compression='zstd', row_group_size=ROW_GROUP_SIZE,
+                        rows_per_file=ROWS_PER_FILE):
+    """ Returns a writer, see above, for partitioned Parquet files under folder.
+        Part files left from an earlier run in a table's directory are removed
+        when the first rows for the table are written.
+    """
+    _load_pyarrow()
+
+    # per domain: schema, buffered tables and their rows, open ParquetWriter,
+    # part number, rows in the part and rows in all
+    domain_states = {}
+
+    def start_domain(domain):
+        table_dir = os.path.join(folder, omop_schema.domain_table_names.get(domain, domain))
+        os.makedirs(table_dir, exist_ok=True)
+        for old_part in glob.glob(os.path.join(table_dir, "part-*.parquet")):
+            os.remove(old_part)
+        return {'schema': domain_arrow_schema(domain), 'dir': table_dir,
+                'tables': [], 'buffered_rows': 0, 'writer': None,
+                'part': 0, 'part_rows': 0, 'rows': 0}
+
+    def flush(state, final=False):
+        """ Writes the buffered rows in whole row groups, or all of them if final. """
+        if state['buffered_rows'] == 0:
+            return
+        table = pa.concat_tables(state['tables'])
+        if final:
+            write_rows = len(table)
+        else:
+            write_rows = len(table) - len(table) % row_group_size
+        state['tables'] = [table.slice(write_rows)] if write_rows < len(table) else []
+        state['buffered_rows'] = len(table) - write_rows
+        table = table.slice(0, write_rows)
+        offset = 0
+        while offset < len(table):
+            if state['writer'] is None:
+                part_path = os.path.join(state['dir'], f"part-{state['part']:05d}.parquet")
+                state['writer'] = pq.ParquetWriter(part_path, state['schema'], compression=compression)
+            rows = min(len(table) - offset, rows_per_file - state['part_rows'])
+            state['writer'].write_table(table.slice(offset, rows), row_group_size=row_group_size)
+            offset += rows
+            state['part_rows'] += rows
+            state['rows'] += rows
+            if state['part_rows'] >= rows_per_file:
+                state['writer'].close()
+                state['writer'] = None
+                state['part'] += 1
+                state['part_rows'] = 0
+
+    def write(dataframe_dict, document=None):
+        for domain, domain_df in dataframe_dict.items():
+            if domain_df is None or len(domain_df) == 0:
+                continue
+            if domain not in domain_states:
+                domain_states[domain] = start_domain(domain)
+            state = domain_states[domain]
+            state['tables'].append(dataframe_to_arrow(domain_df, state['schema'], domain))
+            state['buffered_rows'] += len(domain_df)
+            if state['buffered_rows'] >= row_group_size:
+                flush(state)
+
+    def close():
+        for domain, state in domain_states.items():
+            flush(state, final=True)
+            if state['writer'] is not None:
+                state['writer'].close()
+                state['writer'] = None
+            logger.info(f"PARQUET wrote {state['rows']} {domain} rows to {state['dir']}")
+        return {domain: state['rows'] for (domain, state) in domain_states.items()}
+
+    return {'write': write, 'close': close}
+
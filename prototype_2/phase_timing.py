@@ -0,0 +1,158 @@
+""" Timing of the phases of a run, and profiling a batch
+
+    When enabled with enable_timing(), the parse records the cumulative wall time
+    of each phase, per domain, like basic_fields or derived_fields in
+    parse_domain_for_single_root, and per document, like parse_xml or write_csv.
+    When it's not enabled, callers check the enabled flag and skip the timing
+    entirely, so it costs a flag test per row.
+
+    Callers time a sequence of phases with laps:
+
+        lap = phase_timing.start_laps(domain) if phase_timing.enabled else None
+        do_basic_fields(...)
+        if lap: lap('basic_fields')
+
+    Times are kept in the process until taken with take_times(), so a worker process
+    can send them back to the parent, where add_times() adds them to the run.
+
+    profiling() runs cProfile or tracemalloc around a block, like the loop over a
+    batch of files, and writes what it found to a file.
+"""
+
+import contextlib
+import io
+import json
+import time
+
+DOCUMENT = '(document)'
+
+enabled = False
+
+_phase_times = {}     # (domain, phase) -> [seconds, count], since the last take
+_document_times = {}  # document -> {phase: seconds}, since the last take
+_run_phase_times = {}
+_run_document_times = {}
+
+
+def enable_timing(timing_enabled=True):
+    global enabled
+    enabled = timing_enabled
+
+
+def start_laps(domain, document=None):
+    """ Returns a function, lap(phase), that records the time since the previous lap,
+        or since start_laps(), as the phase, for the domain and, if given, the document.
+    """
+    lap_start = [time.perf_counter()]
+
+    def lap(phase):
+        now = time.perf_counter()
+        seconds = now - lap_start[0]
+        lap_start[0] = now
+        phase_time = _phase_times.get((domain, phase))
+        if phase_time is None:
+            _phase_times[(domain, phase)] = [seconds, 1]
+        else:
+            phase_time[0] += seconds
+            phase_time[1] += 1
+        if document is not None:
+            document_phases = _document_times.setdefault(document, {})
+            document_phases[phase] = document_phases.get(phase, 0.0) + seconds
+
+    return lap
+
+
+def take_times():
+    """ Returns the times since the last call, as (phase_times, document_times), and starts over. """
+    global _phase_times, _document_times
+    times = (_phase_times, _document_times)
+    _phase_times = {}
+    _document_times = {}
+    return times
+
+
+def add_times(times):
+    """ Adds times from take_times(), possibly from another process, to this run. """
+    (phase_times, document_times) = times
+    for key, (seconds, count) in phase_times.items():
+        run_phase_time = _run_phase_times.setdefault(key, [0.0, 0])
+        run_phase_time[0] += seconds
+        run_phase_time[1] += count
+    for document, phases in document_times.items():
+        run_document_phases = _run_document_times.setdefault(document, {})
+        for phase, seconds in phases.items():
+            run_document_phases[phase] = run_document_phases.get(phase, 0.0) + seconds
+
+
+def get_times():
+    """ Returns the run's (phase_times, document_times), including any not yet added. """
+    add_times(take_times())
+    return (_run_phase_times, _run_document_times)
+
+
+def print_times(n_documents=10):
+    """ Prints the run's time per domain and phase, slowest first, and the
+        n_documents slowest documents.
+    """
+    (phase_times, document_times) = get_times()
+    print("Phase times (domain, phase, seconds, count):")
+    for (domain, phase), (seconds, count) in sorted(phase_times.items(), key=lambda item: -item[1][0]):
+        print(f"  {domain:12} {phase:16} {seconds:10.4f} {count:8}")
+    slowest = sorted(document_times.items(), key=lambda item: -sum(item[1].values()))[:n_documents]
+    if len(slowest) > 0:
+        print(f"Slowest {len(slowest)} documents (seconds):")
+        for document, phases in slowest:
+            phase_text = " ".join(f"{phase}:{seconds:.4f}" for (phase, seconds) in phases.items())
+            print(f"  {document} {sum(phases.values()):.4f}  {phase_text}")
+
+
+def write_times(file_path):
+    """ Writes the run's times as JSON. """
+    (phase_times, document_times) = get_times()
+    with open(file_path, 'w') as times_file:
+        json.dump({
+            'phases': [{'domain': domain, 'phase': phase, 'seconds': seconds, 'count': count}
+                       for ((domain, phase), (seconds, count)) in phase_times.items()],
+            'documents': document_times
+        }, times_file, indent=2)
+
+
+@contextlib.contextmanager
+def profiling(profiler, output_path):
+    """ Runs the block under the profiler, 'cprofile' or 'tracemalloc', or neither
+        if None. cProfile stats are dumped to output_path, for pstats or snakeviz,
+        and the top functions by cumulative time are printed. For tracemalloc the top
+        allocating lines are written to output_path as text.
+        Only this process is profiled, not worker processes.
+    """
+    if profiler is None:
+        yield
+    elif profiler == 'cprofile':
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(output_path)
+            stats_text = io.StringIO()
+            pstats.Stats(profile, stream=stats_text).sort_stats('cumulative').print_stats(30)
+            print(f"Profile written to {output_path}\n{stats_text.getvalue()}")
+    elif profiler == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            (current_bytes, peak_bytes) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(output_path, 'w') as output_file:
+                output_file.write(f"current {current_bytes} bytes, peak {peak_bytes} bytes\n")
+                for statistic in snapshot.statistics('lineno')[:50]:
+                    output_file.write(f"{statistic}\n")
+            print(f"Profile: tracemalloc peak {peak_bytes} bytes, top lines written to {output_path}")
+    else:
+        raise ValueError(f"unknown profiler {profiler}, expected cprofile or tracemalloc")
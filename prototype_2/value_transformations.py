@@ -1,8 +1,15 @@
+import functools
 import logging
-import pandas as pd
+import prototype_2.vocabulary as vocabulary
 logger = logging.getLogger(__name__)
 
-concept_df = pd.read_csv("map_to_standard.csv")
+# Bound on the number of distinct (oid, concept_code) pairs memoized by
+# _lookup_concept_row. Documents repeat a small set of codes, so this is mostly
+# about keeping a long batch from growing the cache without limit.
+CONCEPT_CACHE_SIZE = 4096
+
+# vocabulary.lookup() results from prefetch_concepts(), keyed by (oid, concept_code)
+_prefetched_concepts = {}
 
 
 def cast_as_string(args_dict):
@@ -32,43 +39,106 @@ def cast_as_concept_id(args_dict):  # TBD FIX CHRIS
     return ""
 
 
-def _map_to_omop_concept_row(vocabulary_oid, concept_code, default):
+def _resolve_concept_row(vocabulary_oid, concept_code):
+    """ Returns the (concept_id, domain_id) pair for the code from the concept map,
+        or None when the code is missing or maps to more than one concept.
+    """
+    code_pair = (vocabulary_oid, concept_code)
+    if code_pair in _prefetched_concepts:
+        concept = _prefetched_concepts[code_pair]
+    else:
+        concept = vocabulary.lookup(vocabulary_oid, concept_code)
+    if concept is None:
+        logger.error("no concept for \"%s\" \"%s\" ", vocabulary_oid, concept_code)
+        return None
+
+    (concept_id, domain_id, ambiguous) = concept
+    if ambiguous:
+        logger.warning("more than one  concept for \"%s\" \"%s\", chose the first", vocabulary_oid, concept_code)
+        return None
+    return (concept_id, domain_id)
+
+
+_lookup_concept_row = functools.lru_cache(maxsize=CONCEPT_CACHE_SIZE)(_resolve_concept_row)
+
+
+def set_concept_cache_size(maxsize):
+    """ Replaces the concept row memo with an empty one holding up to maxsize keys
+        (None for unbounded).
     """
+    global _lookup_concept_row
+    _lookup_concept_row = functools.lru_cache(maxsize=maxsize)(_resolve_concept_row)
+
+
+def concept_cache_info():
+    """ Returns the hits, misses, maxsize and currsize of the concept row memo,
+        for sizing it against a batch.
     """
-    try:
-        concept_id_df = concept_df[(concept_df['oid'] == vocabulary_oid) &
-                                (concept_df['concept_code'] == concept_code)]
+    return _lookup_concept_row.cache_info()
+
+
+def clear_concept_cache():
+    _lookup_concept_row.cache_clear()
+    _prefetched_concepts.clear()
 
-        if len(concept_id_df) < 1:
-           logger.error(f"no concept for \"{vocabulary_oid}\" \"{concept_code}\" ")
-           return default
 
-        if len(concept_id_df) > 1:
-           logger.warning(f"more than one  concept for \"{vocabulary_oid}\" \"{concept_code}\", chose the first")
-           return default
+def prefetch_concepts(code_pairs):
+    """ Looks up the (vocabulary_oid, concept_code) pairs that haven't been, all at
+        once with vocabulary.lookup_many(), ahead of the rows that map them. The rows
+        still go through the memo, so missing and ambiguous codes are reported when,
+        and if, a row maps them. Kept to the memo's size, starting over when full;
+        past that, only the first pairs are looked up and the rest are left to the memo.
+    """
+    new_pairs = list(dict.fromkeys(code_pair for code_pair in code_pairs
+                                   if code_pair not in _prefetched_concepts))
+    if len(new_pairs) == 0:
+        return
+    maxsize = _lookup_concept_row.cache_info().maxsize
+    if maxsize is not None and len(_prefetched_concepts) + len(new_pairs) > maxsize:
+        _prefetched_concepts.clear()
+        new_pairs = new_pairs[:maxsize]
+    _prefetched_concepts.update(vocabulary.lookup_many(new_pairs))
+
 
-        return concept_id_df
-    except IndexError as e:
-        logger.warning(f"no concept for \"{vocabulary_oid}\" \"{concept_code}\" type:{type(e)}")
+def _map_to_omop_concept_row(vocabulary_oid, concept_code, default):
+    """ Returns the (concept_id, domain_id) pair for the code, or the default when
+        the code is missing or ambiguous. Each distinct code is resolved once, and
+        reported once, then served from the memo.
+    """
+    concept_row = _lookup_concept_row(vocabulary_oid, concept_code)
+    if concept_row is None:
         return default
+    return concept_row
 
 
 def map_hl7_to_omop_concept_id(args_dict):
     """ expects: vocabulary_oid, concept_code
+        Returns None when the code is missing from, or ambiguous in, the concept map.
     """
-    return int(_map_to_omop_concept_row(args_dict['vocabulary_oid'], 
-                                        args_dict['concept_code'],
-                                        args_dict['default'])\
-                                        ['concept_id'].iloc[0])
+    concept_row = _map_to_omop_concept_row(args_dict['vocabulary_oid'],
+                                           args_dict['concept_code'],
+                                           None)
+    if concept_row is None:
+        return None
+    return concept_row[0]
 
 
 def map_hl7_to_omop_domain_id(args_dict):
     """ expects: vocabulary_oid, concept_code
+        Returns None when the code is missing from, or ambiguous in, the concept map.
     """
-    return _map_to_omop_concept_row(args_dict['vocabulary_oid'], 
-                                    args_dict['concept_code'],
-                                    args_dict['default'])\
-                                    ['domain_id'].iloc[0]
+    concept_row = _map_to_omop_concept_row(args_dict['vocabulary_oid'],
+                                           args_dict['concept_code'],
+                                           None)
+    if concept_row is None:
+        return None
+    return concept_row[1]
+
+
+# Functions that map codes to concepts, so a None from them is an unmapped concept
+# in field_metrics rather than just no value.
+concept_mapping_functions = {map_hl7_to_omop_concept_id, map_hl7_to_omop_domain_id}
+
 
 def extract_day_of_birth(args_dict):
     # assumes input is ISO-8601 "YYYY-MM-DD"
@@ -0,0 +1,219 @@
+""" The concept map, compiled to arrays and loaded on first use
+
+    map_to_standard.csv maps (oid, concept_code) to a concept_id and domain_id. A
+    full map derived from the Athena vocabularies takes a long time to read as
+    CSV, so it's read once and compiled into .npy arrays under
+    VOCABULARY_CACHE_DIR, next to the CSV unless it's an absolute path, which later
+    processes memory-map instead:
+    - keys:          'oid<US>concept_code', sorted, for searchsorted
+    - concept_ids:   int64, per key
+    - domain_index:  int16, per key, into the domain names kept in stamp.json,
+                     or -1 for a concept without a domain_id
+    - ambiguous:     bool, keys that are on more than one row of the CSV
+
+    stamp.json also records the CSV's file name, size, mtime and SHA-256, but no
+    directory, so the CSV can be moved with its cache. The arrays are compiled
+    again when the size or mtime changed and the content hash did too.
+
+    Nothing is read, nor numpy imported, until the first lookup(), lookup_many(),
+    or load_concept_map().
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+CONCEPT_MAP_FILE = "map_to_standard.csv"
+VOCABULARY_CACHE_DIR = ".vocabulary"
+ARTIFACT_VERSION = 2
+
+KEY_SEPARATOR = '\x1f'
+ARRAY_NAMES = ['keys', 'concept_ids', 'domain_index', 'ambiguous']
+
+_concept_map = None  # the loaded arrays, domain names and source hash
+
+
+def _file_sha256(file_path):
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def _artifact_dir(source_file):
+    source_dir = os.path.dirname(os.path.abspath(source_file))
+    return os.path.join(source_dir, VOCABULARY_CACHE_DIR, os.path.basename(source_file))
+
+
+def _read_stamp(artifact_dir):
+    try:
+        with open(os.path.join(artifact_dir, "stamp.json")) as stamp_file:
+            return json.load(stamp_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_atomically(artifact_dir, file_name, save_function):
+    fd, temp_path = tempfile.mkstemp(dir=artifact_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            save_function(f)
+        os.replace(temp_path, os.path.join(artifact_dir, file_name))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def compile_concept_map(source_file, artifact_dir, source_stamp):
+    """ Reads the CSV and writes its arrays and stamp.json to artifact_dir.
+        Returns the arrays and the domain names.
+    """
+    import numpy as np
+    import pandas as pd
+
+    logger.info(f"VOCABULARY compiling {source_file} into {artifact_dir}")
+    concept_df = pd.read_csv(source_file, dtype={'oid': str, 'concept_code': str})
+    keys = concept_df['oid'] + KEY_SEPARATOR + concept_df['concept_code']
+    ambiguous = keys.duplicated(keep=False)
+    first_rows = ~keys.duplicated(keep='first')
+    # a missing domain_id is -1, see _domain_name()
+    (domain_index, domain_names) = pd.factorize(concept_df['domain_id'], use_na_sentinel=True)
+
+    order = np.argsort(keys[first_rows].to_numpy(dtype=str), kind='stable')
+    arrays = {
+        'keys': keys[first_rows].to_numpy(dtype=str)[order],
+        'concept_ids': concept_df['concept_id'][first_rows].to_numpy(dtype=np.int64)[order],
+        'domain_index': domain_index[first_rows.to_numpy()].astype(np.int16)[order],
+        'ambiguous': ambiguous[first_rows].to_numpy(dtype=bool)[order]
+    }
+    domain_names = [str(name) for name in domain_names]
+
+    try:
+        os.makedirs(artifact_dir, exist_ok=True)
+        for name in ARRAY_NAMES:
+            _save_atomically(artifact_dir, f"{name}.npy",
+                             lambda f, name=name: np.save(f, arrays[name]))
+        stamp = dict(source_stamp, version=ARTIFACT_VERSION, domain_names=domain_names)
+        _save_atomically(artifact_dir, "stamp.json",
+                         lambda f: f.write(json.dumps(stamp).encode('utf-8')))
+    except OSError as e:
+        logger.warning(f"VOCABULARY couldn't write {artifact_dir}, using the map from memory: {e}")
+    return (arrays, domain_names)
+
+
+def _stamp_is_current(stamp, source_file, source_stamp):
+    """ True if the arrays were compiled from the CSV as it is now. A CSV that was
+        only touched is hashed, and the stamp updated with its new mtime.
+    """
+    if stamp.get('version') != ARTIFACT_VERSION or stamp.get('source') != source_stamp['source'] \
+            or stamp['size'] != source_stamp['size']:
+        return False
+    if stamp['mtime_ns'] == source_stamp['mtime_ns']:
+        return True
+    if _file_sha256(source_file) != stamp['sha256']:
+        return False
+    stamp['mtime_ns'] = source_stamp['mtime_ns']
+    try:
+        _save_atomically(_artifact_dir(source_file), "stamp.json",
+                         lambda f: f.write(json.dumps(stamp).encode('utf-8')))
+    except OSError:
+        pass
+    return True
+
+
+def load_concept_map(source_file=CONCEPT_MAP_FILE):
+    """ Loads the compiled concept map, compiling it first if it's missing or stale.
+        Returns (arrays, domain_names, source_sha256), kept for later calls.
+    """
+    global _concept_map
+    if _concept_map is not None:
+        return _concept_map
+    import numpy as np
+
+    artifact_dir = _artifact_dir(source_file)
+    source_stat = os.stat(source_file)
+    source_stamp = {'source': os.path.basename(source_file), 'size': source_stat.st_size,
+                    'mtime_ns': source_stat.st_mtime_ns}
+    stamp = _read_stamp(artifact_dir)
+    if stamp is not None and not _stamp_is_current(stamp, source_file, source_stamp):
+        stamp = None
+
+    if stamp is None:
+        source_stamp['sha256'] = _file_sha256(source_file)
+        (arrays, domain_names) = compile_concept_map(source_file, artifact_dir, source_stamp)
+        _concept_map = (arrays, domain_names, source_stamp['sha256'])
+    else:
+        arrays = {name: np.load(os.path.join(artifact_dir, f"{name}.npy"), mmap_mode='r')
+                  for name in ARRAY_NAMES}
+        _concept_map = (arrays, stamp['domain_names'], stamp['sha256'])
+    return _concept_map
+
+
+def concept_map_hash():
+    """ The SHA-256 of the concept map's CSV, for fingerprints of what the output depends on. """
+    return load_concept_map()[2]
+
+
+def _domain_name(domain_names, domain_index):
+    if domain_index < 0:
+        return None
+    return domain_names[domain_index]
+
+
+def lookup(vocabulary_oid, concept_code):
+    """ Returns (concept_id, domain_id, ambiguous) for the code, or None when it's not
+        in the map. For an ambiguous code, the concept is from its first row. The
+        domain_id is None for a concept without one.
+    """
+    import numpy as np
+
+    (arrays, domain_names, source_hash) = load_concept_map()
+    keys = arrays['keys']
+    key = f"{vocabulary_oid}{KEY_SEPARATOR}{concept_code}"
+    position = int(np.searchsorted(keys, key))
+    if position >= len(keys) or keys[position] != key:
+        return None
+    return (int(arrays['concept_ids'][position]),
+            _domain_name(domain_names, arrays['domain_index'][position]),
+            bool(arrays['ambiguous'][position]))
+
+
+def lookup_many(code_pairs):
+    """ lookup() for many codes with one searchsorted over the map. Takes an iterable
+        of (vocabulary_oid, concept_code) and returns a dict of the result for each
+        distinct pair.
+    """
+    import numpy as np
+
+    code_pairs = list(dict.fromkeys(code_pairs))
+    if len(code_pairs) == 0:
+        return {}
+    (arrays, domain_names, source_hash) = load_concept_map()
+    keys = arrays['keys']
+    query = np.array([f"{vocabulary_oid}{KEY_SEPARATOR}{concept_code}"
+                      for (vocabulary_oid, concept_code) in code_pairs])
+    positions = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    found = keys[positions] == query
+    concept_ids = arrays['concept_ids'][positions]
+    domain_index = arrays['domain_index'][positions]
+    ambiguous = arrays['ambiguous'][positions]
+
+    concepts = {}
+    for (i, code_pair) in enumerate(code_pairs):
+        if found[i]:
+            concepts[code_pair] = (int(concept_ids[i]), _domain_name(domain_names, domain_index[i]),
+                                   bool(ambiguous[i]))
+        else:
+            concepts[code_pair] = None
+    return concepts
+
+
+def clear_concept_map():
+    """ Drops the loaded map, so the next lookup checks the CSV again. """
+    global _concept_map
+    _concept_map = None
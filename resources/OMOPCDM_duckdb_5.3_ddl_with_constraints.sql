@@ -1,7 +1,7 @@
 --duckdb CDM DDL Specification for OMOP Common Data Model 5.3
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.person (
-			person_id integer PRIMARY KEY, --  NOT NULL,
+			person_id bigint PRIMARY KEY, --  NOT NULL,
 			gender_concept_id integer NOT NULL,
 			year_of_birth integer NOT NULL,
 			month_of_birth integer NULL,
@@ -32,14 +32,14 @@ CREATE TABLE @cdmDatabaseSchema.person (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.observation_period (
 			observation_period_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			observation_period_start_date date NOT NULL,
 			observation_period_end_date date NOT NULL,
 			period_type_concept_id integer NOT NULL );
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.visit_occurrence (
 			visit_occurrence_id integer PRIMARY KEY, -- NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			visit_concept_id integer NOT NULL,
 			visit_start_date date NOT NULL,
 			visit_start_datetime TIMESTAMP NULL,
@@ -68,7 +68,7 @@ CREATE TABLE @cdmDatabaseSchema.visit_occurrence (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.visit_detail (
 			visit_detail_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			visit_detail_concept_id integer NOT NULL,
 			visit_detail_start_date date NOT NULL,
 			visit_detail_start_datetime TIMESTAMP NULL,
@@ -89,7 +89,7 @@ CREATE TABLE @cdmDatabaseSchema.visit_detail (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.condition_occurrence (
 			condition_occurrence_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			condition_concept_id integer NOT NULL,
 			condition_start_date date NOT NULL,
 			condition_start_datetime TIMESTAMP NULL,
@@ -107,7 +107,7 @@ CREATE TABLE @cdmDatabaseSchema.condition_occurrence (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.drug_exposure (
 			drug_exposure_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			drug_concept_id integer NOT NULL,
 			drug_exposure_start_date date NOT NULL,
 			drug_exposure_start_datetime TIMESTAMP NULL,
@@ -132,7 +132,7 @@ CREATE TABLE @cdmDatabaseSchema.drug_exposure (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.procedure_occurrence (
 			procedure_occurrence_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			procedure_concept_id integer NOT NULL,
 			procedure_date date NOT NULL,
 			procedure_datetime TIMESTAMP NULL,
@@ -148,7 +148,7 @@ CREATE TABLE @cdmDatabaseSchema.procedure_occurrence (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.device_exposure (
 			device_exposure_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			device_concept_id integer NOT NULL,
 			device_exposure_start_date date NOT NULL,
 			device_exposure_start_datetime TIMESTAMP NULL,
@@ -164,8 +164,8 @@ CREATE TABLE @cdmDatabaseSchema.device_exposure (
 			device_source_concept_id integer NULL );
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.measurement (
-			measurement_id integer PRIMARY KEY,
-			person_id integer NOT NULL,
+			measurement_id bigint PRIMARY KEY,
+			person_id bigint NOT NULL,
 			measurement_concept_id integer NOT NULL,
 			measurement_date date NOT NULL,
 			measurement_datetime TIMESTAMP NULL,
@@ -198,7 +198,7 @@ CREATE TABLE @cdmDatabaseSchema.measurement (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.observation (
 			observation_id integer PRIMARY KEY,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			observation_concept_id integer NOT NULL,
 			observation_date date NOT NULL,
 			observation_datetime TIMESTAMP NULL,
@@ -228,7 +228,7 @@ CREATE TABLE @cdmDatabaseSchema.observation (
 );
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.death (
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			death_date date NOT NULL,
 			death_datetime TIMESTAMP NULL,
 			death_type_concept_id integer NULL,
@@ -238,7 +238,7 @@ CREATE TABLE @cdmDatabaseSchema.death (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.note (
 			note_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			note_date date NOT NULL,
 			note_datetime TIMESTAMP NULL,
 			note_type_concept_id integer NOT NULL,
@@ -270,7 +270,7 @@ CREATE TABLE @cdmDatabaseSchema.note_nlp (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.specimen (
 			specimen_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			specimen_concept_id integer NOT NULL,
 			specimen_type_concept_id integer NOT NULL,
 			specimen_date date NOT NULL,
@@ -327,7 +327,7 @@ CREATE TABLE @cdmDatabaseSchema.provider (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.payer_plan_period (
 			payer_plan_period_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			payer_plan_period_start_date date NOT NULL,
 			payer_plan_period_end_date date NOT NULL,
 			payer_concept_id integer NULL,
@@ -370,7 +370,7 @@ CREATE TABLE @cdmDatabaseSchema.cost (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.drug_era (
 			drug_era_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			drug_concept_id integer NOT NULL,
 			drug_era_start_date date NOT NULL,
 			drug_era_end_date date NOT NULL,
@@ -379,7 +379,7 @@ CREATE TABLE @cdmDatabaseSchema.drug_era (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.dose_era (
 			dose_era_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			drug_concept_id integer NOT NULL,
 			unit_concept_id integer NOT NULL,
 			dose_value NUMERIC NOT NULL,
@@ -388,7 +388,7 @@ CREATE TABLE @cdmDatabaseSchema.dose_era (
 --HINT DISTRIBUTE ON KEY (person_id)
 CREATE TABLE @cdmDatabaseSchema.condition_era (
 			condition_era_id integer NOT NULL,
-			person_id integer NOT NULL,
+			person_id bigint NOT NULL,
 			condition_concept_id integer NOT NULL,
 			condition_era_start_date date NOT NULL,
 			condition_era_end_date date NOT NULL,
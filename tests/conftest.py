@@ -0,0 +1,46 @@
+""" Shared setup for the tests
+
+    The modules read their inputs, the concept map, the OMOP DDL and the sample
+    documents, from paths relative to the top of the repository, so the tests
+    run from there.
+"""
+
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+SAMPLE_DOCUMENTS = ["resources/CCD-Sample.xml",
+                    "resources/170.314b2_AmbulatoryToC.xml",
+                    "resources/eHX_Terry.xml"]
+
+
+@pytest.fixture(autouse=True)
+def repo_dir(monkeypatch):
+    monkeypatch.chdir(REPO_DIR)
+    return REPO_DIR
+
+
+@pytest.fixture
+def concept_map(tmp_path):
+    """ Returns a function that writes the CSV text as a concept map and loads it in
+        place of map_to_standard.csv, for the rest of the test.
+    """
+    import prototype_2.value_transformations as VT
+    import prototype_2.vocabulary as vocabulary
+
+    def load_concepts(csv_text):
+        csv_path = tmp_path / "map_to_standard.csv"
+        csv_path.write_text(csv_text)
+        vocabulary.clear_concept_map()
+        VT.clear_concept_cache()
+        vocabulary.load_concept_map(str(csv_path))
+        return csv_path
+
+    yield load_concepts
+    vocabulary.clear_concept_map()
+    VT.clear_concept_cache()
@@ -0,0 +1,24 @@
+import prototype_2.benchmark as benchmark
+
+RESULTS = {'mode': 'parse_doc', 'commit': 'abc1234', 'documents': 10, 'failed_documents': 0,
+           'elapsed_sec': 2.0, 'docs_per_sec': 5.0, 'latency_p50_ms': 150.0, 'latency_p99_ms': 400.0,
+           'peak_rss_mb': 120.0, 'rows': {'Person': 10}, 'rows_per_sec': {'Person': 5.0}}
+
+NO_DOCUMENTS = dict(RESULTS, documents=0, failed_documents=10, docs_per_sec=None,
+                    latency_p50_ms=None, latency_p99_ms=None, rows={}, rows_per_sec={})
+
+
+def test_print_results_with_baseline(capsys):
+    benchmark.print_results(RESULTS, dict(RESULTS, docs_per_sec=2.5))
+    output = capsys.readouterr().out
+    assert "docs_per_sec           5.00   was       2.50  (2.00x)" in output
+    assert "rows/sec Person" in output
+
+
+def test_print_results_when_no_document_parsed(capsys):
+    benchmark.print_results(NO_DOCUMENTS)
+    benchmark.print_results(NO_DOCUMENTS, RESULTS)
+    benchmark.print_results(RESULTS, NO_DOCUMENTS)
+    output = capsys.readouterr().out
+    assert "latency_p50_ms          n/a   was     150.00\n" in output
+    assert "latency_p50_ms       150.00   was        n/a\n" in output
@@ -0,0 +1,389 @@
+import pytest
+
+import prototype_2.data_driven_parse as DDP
+import prototype_2.field_metrics as field_metrics
+import prototype_2.id_hashing as id_hashing
+import prototype_2.value_transformations as VT
+
+CONCEPT_CSV = """oid,concept_code,concept_id,domain_id
+2.16.840.1.113883.5.1,F,8532,Gender
+2.16.840.1.113883.6.1,8480-6,3004249,Measurement
+2.16.840.1.113883.6.96,111,4000111,Observation
+"""
+
+# A patient, and a results section with the same templateId twice: one
+# Measurement, one Observation, and one code in neither that goes to both.
+DOCUMENT = b"""<?xml version="1.0"?>
+<ClinicalDocument xmlns="urn:hl7-org:v3">
+  <recordTarget>
+    <patientRole>
+      <id root="2.16.840.1.113883.4.1" extension="111-22-3333"/>
+      <addr><city>Denver</city></addr>
+      <patient>
+        <administrativeGenderCode code="F" codeSystem="2.16.840.1.113883.5.1"/>
+        <birthTime value="19750501"/>
+      </patient>
+    </patientRole>
+  </recordTarget>
+  <component><structuredBody><component><section>
+    <templateId root="results"/>
+    <templateId root="results"/>
+    <entry><observation>
+      <id root="r1"/>
+      <code code="8480-6" codeSystem="2.16.840.1.113883.6.1"/>
+      <value value="120"/>
+    </observation></entry>
+    <entry><observation>
+      <id root="r2"/>
+      <code code="111" codeSystem="2.16.840.1.113883.6.96"/>
+      <value value="7"/>
+    </observation></entry>
+    <entry><observation>
+      <id root="r3"/>
+      <code code="999" codeSystem="2.16.840.1.113883.6.96"/>
+      <value value="1"/>
+    </observation></entry>
+  </section></component></structuredBody></component>
+</ClinicalDocument>
+"""
+
+RESULTS_ROOT = ("./component/structuredBody/component/section/"
+                "templateId[@root='results']/../entry/observation")
+
+
+def label_concept(args_dict):
+    return f"concept {args_dict['concept_id']}"
+
+
+def person_metadata():
+    return {
+        'root': {'config_type': 'ROOT', 'element': './recordTarget/patientRole'},
+        'person_id_npi': {
+            'config_type': 'FIELD', 'data_type': 'BIGINTHASH',
+            'element': "id[@root='2.16.840.1.113883.4.6']", 'attribute': 'extension',
+            'priority': ('person_id', 2)
+        },
+        'person_id_ssn': {
+            'config_type': 'FIELD', 'data_type': 'BIGINTHASH',
+            'element': "id[@root='2.16.840.1.113883.4.1']", 'attribute': 'extension',
+            'priority': ('person_id', 1)
+        },
+        'person_id_hash': {
+            'config_type': 'HASH', 'data_type': 'BIGINTHASH', 'fields': ['city'],
+            'priority': ('person_id', 3)
+        },
+        'city': {'config_type': 'FIELD', 'element': 'addr/city', 'attribute': '#text'},
+        'person_id': {'config_type': 'PRIORITY', 'order': 1},
+        # before the field it takes as input, to be put after it in the plan
+        'gender_concept_label': {
+            'config_type': 'DERIVED', 'FUNCTION': label_concept,
+            'argument_names': {'concept_id': 'gender_concept_id'},
+            'order': 3
+        },
+        'gender_concept_code': {
+            'config_type': 'FIELD', 'element': 'patient/administrativeGenderCode', 'attribute': 'code'
+        },
+        'gender_concept_codeSystem': {
+            'config_type': 'FIELD', 'element': 'patient/administrativeGenderCode', 'attribute': 'codeSystem'
+        },
+        'gender_concept_id': {
+            'config_type': 'DERIVED', 'FUNCTION': VT.map_hl7_to_omop_concept_id,
+            'argument_names': {'concept_code': 'gender_concept_code',
+                               'vocabulary_oid': 'gender_concept_codeSystem',
+                               'default': (0, 'default')},
+            'order': 2
+        },
+        # neither output nor input to anything that is
+        'birth_time': {'config_type': 'FIELD', 'element': 'patient/birthTime', 'attribute': 'value'},
+        'birth_label': {
+            'config_type': 'DERIVED', 'FUNCTION': label_concept,
+            'argument_names': {'concept_id': 'birth_time'}
+        },
+    }
+
+
+def results_metadata(prefix):
+    return {
+        'root': {'config_type': 'ROOT', 'element': RESULTS_ROOT},
+        f'{prefix}_id': {'config_type': 'FIELD', 'element': 'id', 'attribute': 'root', 'order': 1},
+        'person_id': {'config_type': 'FK', 'FK': 'person_id', 'order': 2},
+        f'{prefix}_concept_code': {'config_type': 'FIELD', 'element': 'code', 'attribute': 'code'},
+        f'{prefix}_concept_codeSystem': {'config_type': 'FIELD', 'element': 'code', 'attribute': 'codeSystem'},
+        f'{prefix}_concept_id': {
+            'config_type': 'DERIVED', 'FUNCTION': VT.map_hl7_to_omop_concept_id,
+            'argument_names': {'concept_code': f'{prefix}_concept_code',
+                               'vocabulary_oid': f'{prefix}_concept_codeSystem',
+                               'default': (0, 'default')},
+            'order': 3
+        },
+        f'{prefix}_concept_domain_id': {
+            'config_type': 'DOMAIN', 'FUNCTION': VT.map_hl7_to_omop_domain_id,
+            'argument_names': {'concept_code': f'{prefix}_concept_code',
+                               'vocabulary_oid': f'{prefix}_concept_codeSystem',
+                               'default': (0, 'default')}
+        },
+        'value_as_number': {
+            'config_type': 'FIELD', 'data_type': 'FLOAT', 'element': 'value', 'attribute': 'value',
+            'order': 4
+        },
+    }
+
+
+@pytest.fixture
+def metadata():
+    return {
+        'Person': person_metadata(),
+        'Measurement': results_metadata('measurement'),
+        'Observation': results_metadata('observation'),
+    }
+
+
+@pytest.fixture(autouse=True)
+def concepts(concept_map):
+    concept_map(CONCEPT_CSV)
+    field_metrics.take_counts()
+    yield
+    field_metrics.take_counts()
+
+
+def parse(tmp_path, metadata, document=DOCUMENT):
+    file_path = tmp_path / "document.xml"
+    file_path.write_bytes(document)
+    return DDP.parse_doc(str(file_path), metadata)
+
+
+def values(rows):
+    return [{field_tag: value for (field_tag, (value, path)) in row.items()} for row in rows]
+
+
+def field_tags(phase):
+    return [field_tag for (field_tag, field_details_dict) in phase]
+
+
+def test_plan_phases(metadata):
+    plan = DDP.compile_domain_plan('Person', metadata['Person'])
+    assert field_tags(plan['basic_fields']) == ['gender_concept_code', 'gender_concept_codeSystem']
+    assert field_tags(plan['derived_fields']) == ['gender_concept_id', 'gender_concept_label']
+    assert plan['priority_fields'] == {'person_id': [('person_id_ssn', 1), ('person_id_npi', 2),
+                                                     ('person_id_hash', 3)]}
+    assert plan['output_order'] == ['person_id', 'gender_concept_id', 'gender_concept_label']
+    assert plan['concept_fields'] == {'gender_concept_id'}
+    assert plan['routing_signature'] is None
+
+
+def test_plan_is_compiled_once_per_metadata(metadata):
+    plan = DDP.get_domain_plan('Person', metadata['Person'])
+    assert DDP.get_domain_plan('Person', metadata['Person']) is plan
+    assert DDP.get_domain_plan('Person', person_metadata()) is not plan
+
+
+def test_rows_follow_the_plan(tmp_path, metadata):
+    omop_dict = parse(tmp_path, metadata)
+    assert values(omop_dict['Person']) == [{
+        'person_id': id_hashing.hash_id('111-22-3333', 'BIGINTHASH'),
+        'gender_concept_id': 8532,
+        'gender_concept_label': 'concept 8532',
+    }]
+    assert list(omop_dict['Person'][0]) == DDP.get_domain_plan('Person', metadata['Person'])['output_order']
+    assert values(omop_dict['Measurement'])[0] == {
+        'measurement_id': 'r1',
+        'person_id': id_hashing.hash_id('111-22-3333', 'BIGINTHASH'),
+        'measurement_concept_id': 3004249,
+        'value_as_number': 120.0,
+    }
+
+
+@pytest.mark.parametrize("path, xpath", [
+    ("./recordTarget/patientRole", "./hl7:recordTarget/hl7:patientRole"),
+    ("id[@root='r1']", "hl7:id[@root='r1']"),
+    ('value[@{http://www.w3.org/2001/XMLSchema-instance}type="PQ"]', 'hl7:value[@xsi:type="PQ"]'),
+    ("templateId/../entry", "hl7:templateId/../hl7:entry"),
+])
+def test_elementpath_to_xpath(path, xpath):
+    assert DDP.elementpath_to_xpath(path) == xpath
+
+
+def test_compiled_paths_select_what_findall_does():
+    tree = DDP.ET.ElementTree(DDP.ET.fromstring(DOCUMENT))
+    for path in ["./recordTarget/patientRole/id", "./recordTarget/patientRole/addr/city",
+                 "./component/structuredBody/component/section/entry/observation/code"]:
+        assert DDP.compile_path(path)(tree) == tree.findall(path, DDP.ns)
+
+
+def test_compiled_parent_paths_select_each_element_once():
+    tree = DDP.ET.ElementTree(DDP.ET.fromstring(DOCUMENT))
+    ids = [observation.find('id', DDP.ns).get('root') for observation in DDP.compile_path(RESULTS_ROOT)(tree)]
+    assert ids == ['r1', 'r2', 'r3']
+    assert len(tree.findall(RESULTS_ROOT, DDP.ns)) == 6
+
+
+def test_domain_groups(metadata):
+    assert DDP.get_domain_groups(metadata) == [['Person'], ['Measurement', 'Observation']]
+    apart = {domain: metadata[domain] for domain in ['Measurement', 'Person', 'Observation']}
+    assert DDP.get_domain_groups(apart) == [['Measurement'], ['Person'], ['Observation']]
+
+
+def test_grouped_rows_go_to_their_domain(tmp_path, metadata):
+    omop_dict = parse(tmp_path, metadata)
+    assert [row['measurement_id'] for row in values(omop_dict['Measurement'])] == ['r1', 'r3']
+    assert [row['observation_id'] for row in values(omop_dict['Observation'])] == ['r2', 'r3']
+    counts = field_metrics.take_counts()
+    for domain in ['Measurement', 'Observation']:
+        assert counts[(domain, field_metrics.ROW, 'rows')] == 2
+        assert counts[(domain, field_metrics.ROW, 'routed_away')] == 1
+
+
+def test_grouped_rows_match_each_domain_alone(metadata):
+    tree = DDP.ET.ElementTree(DDP.ET.fromstring(DOCUMENT))
+    pk_dict = {'person_id': 1}
+    grouped = DDP.parse_domain_group_from_dict(tree, ['Measurement', 'Observation'], metadata,
+                                               "document.xml", pk_dict)
+    for domain in ['Measurement', 'Observation']:
+        alone = DDP.parse_domain_from_dict(tree, domain, metadata[domain], "document.xml", pk_dict)
+        assert grouped[domain] == alone
+
+
+def test_priority_candidates_are_deferred(metadata):
+    plan = DDP.compile_domain_plan('Person', metadata['Person'])
+    assert list(plan['deferred_fields']) == ['person_id_npi', 'person_id_ssn', 'person_id_hash', 'city']
+    assert plan['deferred_inputs']['person_id_hash'] == ['city']
+    assert plan['hash_fields'] == []
+
+
+def test_later_candidates_are_skipped(tmp_path, metadata):
+    omop_dict = parse(tmp_path, metadata)
+    assert omop_dict['Person'][0]['person_id'][0] == id_hashing.hash_id('111-22-3333', 'BIGINTHASH')
+    counts = field_metrics.take_counts()
+    assert counts[('Person', 'person_id_ssn', 'found')] == 1
+    for field_tag in ['person_id_npi', 'person_id_hash', 'city']:
+        assert counts[('Person', field_tag, 'skipped')] == 1
+        assert ('Person', field_tag, 'found') not in counts
+
+
+def test_hash_candidate_is_parsed_when_needed(tmp_path, metadata):
+    document = DOCUMENT.replace(b'root="2.16.840.1.113883.4.1"', b'root="elsewhere"')
+    omop_dict = parse(tmp_path, metadata, document)
+    assert omop_dict['Person'][0]['person_id'][0] == id_hashing.hash_id('Denver', 'BIGINTHASH')
+    assert [row['person_id'] for row in values(omop_dict['Measurement'])] == \
+        [id_hashing.hash_id('Denver', 'BIGINTHASH')] * 2
+    counts = field_metrics.take_counts()
+    for field_tag in ['person_id_ssn', 'person_id_npi']:
+        assert counts[('Person', field_tag, 'missing_element')] == 1
+    assert counts[('Person', 'city', 'found')] == 1
+    assert counts[('Person', 'person_id_hash', 'found')] == 1
+
+
+def test_dead_fields(metadata):
+    assert DDP.dead_fields(metadata) == {'Person': ['birth_time', 'birth_label'],
+                                         'Measurement': [], 'Observation': []}
+    plan = DDP.get_domain_plan('Person', metadata['Person'])
+    live_tags = field_tags(plan['basic_fields'] + plan['derived_fields']) + list(plan['deferred_fields'])
+    assert 'birth_time' not in live_tags and 'birth_label' not in live_tags
+
+
+def test_dead_fields_are_not_parsed(tmp_path, metadata):
+    parse(tmp_path, metadata)
+    counted_fields = set((domain, field_tag) for (domain, field_tag, outcome) in field_metrics.take_counts())
+    assert ('Person', 'gender_concept_code') in counted_fields
+    assert ('Person', 'birth_time') not in counted_fields
+    assert ('Person', 'birth_label') not in counted_fields
+
+
+def test_output_field_inputs_are_live(metadata):
+    metadata['Person']['birth_label']['order'] = 4
+    assert DDP.compile_domain_plan('Person', metadata['Person'])['dead_fields'] == []
+
+
+@pytest.fixture
+def find_first_calls(monkeypatch):
+    calls = []
+    find_first = DDP.find_first
+
+    def counting_find_first(path, element):
+        calls.append(path)
+        return find_first(path, element)
+    monkeypatch.setattr(DDP, 'find_first', counting_find_first)
+    return calls
+
+
+def test_each_path_is_found_once_per_root(metadata, find_first_calls):
+    tree = DDP.ET.ElementTree(DDP.ET.fromstring(DOCUMENT))
+    plan = DDP.get_domain_plan('Measurement', metadata['Measurement'])
+    root_element = plan['root_path'](tree)[0]
+    element_cache = {}
+    (output_dict, error_fields_set) = DDP.parse_domain_for_single_root(
+        root_element, RESULTS_ROOT, 'Measurement', plan, set(), {'person_id': 1}, element_cache)
+    assert output_dict['measurement_concept_id'][0] == 3004249
+    assert sorted(find_first_calls) == ['code', 'id', 'value']
+    assert element_cache['code'] is root_element.find('code', DDP.ns)
+
+
+def test_group_finds_each_path_once_per_root(tmp_path, metadata, find_first_calls):
+    parse(tmp_path, metadata)
+    assert find_first_calls.count('code') == 3
+    assert find_first_calls.count('patient/administrativeGenderCode') == 1
+
+
+def test_routing_fields(metadata):
+    plan = DDP.compile_domain_plan('Measurement', metadata['Measurement'])
+    assert field_tags(plan['routing_fields']) == ['measurement_concept_code', 'measurement_concept_codeSystem']
+    assert 'measurement_concept_code' not in field_tags(plan['basic_fields'])
+    assert plan['routing_signature'] == \
+        DDP.compile_domain_plan('Observation', metadata['Observation'])['routing_signature']
+
+
+def test_routed_away_rows_are_not_parsed(tmp_path, metadata):
+    parse(tmp_path, metadata)
+    counts = field_metrics.take_counts()
+    for domain in ['Measurement', 'Observation']:
+        assert counts[(domain, 'value_as_number', 'found')] == 2
+        assert counts[(domain, f'{domain.lower()}_concept_code', 'found')] == 2
+        assert counts[(domain, f'{domain.lower()}_concept_domain_id', 'found')] == 1
+        assert counts[(domain, f'{domain.lower()}_concept_domain_id', 'unmapped_concept')] == 1
+
+
+def test_group_routes_each_root_once(tmp_path, metadata, monkeypatch):
+    routed_roots = []
+    parse_routing_values = DDP.parse_routing_values
+
+    def counting_parse_routing_values(root_element, *args, **kwargs):
+        routed_roots.append(root_element)
+        return parse_routing_values(root_element, *args, **kwargs)
+    monkeypatch.setattr(DDP, 'parse_routing_values', counting_parse_routing_values)
+    parse(tmp_path, metadata)
+    assert len(routed_roots) == 3
+
+
+@pytest.fixture
+def concept_prefetch():
+    DDP.enable_concept_prefetch(True)
+    yield
+    DDP.enable_concept_prefetch(False)
+
+
+def test_prefetch_gives_the_same_rows(tmp_path, metadata, concept_prefetch):
+    DDP.enable_concept_prefetch(False)
+    rows = parse(tmp_path, metadata)
+    counts = field_metrics.take_counts()
+    VT.clear_concept_cache()
+    DDP.enable_concept_prefetch(True)
+    assert parse(tmp_path, metadata) == rows
+    assert field_metrics.take_counts() == counts
+
+
+def test_prefetch_looks_codes_up_together(tmp_path, metadata, concept_prefetch, monkeypatch):
+    batches = []
+    lookup_many = VT.vocabulary.lookup_many
+
+    def counting_lookup_many(code_pairs):
+        batches.append(sorted(code_pairs))
+        return lookup_many(code_pairs)
+
+    def no_lookup(vocabulary_oid, concept_code):
+        raise AssertionError(f"looked up {vocabulary_oid} {concept_code} alone")
+    monkeypatch.setattr(VT.vocabulary, 'lookup_many', counting_lookup_many)
+    monkeypatch.setattr(VT.vocabulary, 'lookup', no_lookup)
+    parse(tmp_path, metadata)
+    assert batches == [[('2.16.840.1.113883.5.1', 'F')],
+                       [('2.16.840.1.113883.6.1', '8480-6'), ('2.16.840.1.113883.6.96', '111'),
+                        ('2.16.840.1.113883.6.96', '999')]]
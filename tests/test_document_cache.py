@@ -0,0 +1,120 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+import prototype_2.document_cache as document_cache
+import prototype_2.field_metrics as field_metrics
+import prototype_2.id_hashing as id_hashing
+import prototype_2.layer_datasets as layer_datasets
+
+SAMPLE_DOCUMENT = "resources/eHX_Terry.xml"
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    cache_dir = tmp_path / "cache"
+    document_cache.enable_cache(str(cache_dir))
+    yield cache_dir
+    document_cache.enable_cache(None)
+
+
+@pytest.fixture
+def document(tmp_path):
+    document_path = tmp_path / os.path.basename(SAMPLE_DOCUMENT)
+    shutil.copy(SAMPLE_DOCUMENT, document_path)
+    return document_path
+
+
+def _entries(cache_dir):
+    return sorted(cache_dir.glob("*.pkl"))
+
+
+def test_off_until_enabled():
+    assert not document_cache.is_enabled()
+
+
+def test_hit_gives_the_parsed_dataframes(cache_dir, document, monkeypatch):
+    parsed = layer_datasets.process_file(str(document), write_csv=False)
+    parsed_counts = field_metrics.take_counts()
+    assert len(_entries(cache_dir)) == 1
+
+    monkeypatch.setattr(layer_datasets.DDP, 'parse_doc',
+                        lambda *args: pytest.fail("parsed a cached document"))
+    cached = layer_datasets.process_file(str(document), write_csv=False)
+    assert sorted(cached) == sorted(parsed)
+    for domain, domain_df in parsed.items():
+        pd.testing.assert_frame_equal(cached[domain], domain_df)
+    assert field_metrics.take_counts() == parsed_counts
+
+
+def test_key_changes_with_content(document):
+    key = document_cache.document_key(str(document))
+    assert document_cache.document_key(str(document)) == key
+    with open(document, 'ab') as f:
+        f.write(b"\n")
+    assert document_cache.document_key(str(document)) != key
+
+
+@pytest.mark.parametrize("data_type, function_name", [('INTEGERHASH', 'blake2b_31'),
+                                                      ('BIGINTHASH', 'sha256_31')])
+def test_key_changes_with_hash_function(document, data_type, function_name):
+    key = document_cache.document_key(str(document))
+    hash_function = id_hashing.data_type_hash_functions[data_type]
+    id_hashing.set_hash_function(data_type, function_name)
+    try:
+        assert document_cache.document_key(str(document)) != key
+    finally:
+        id_hashing.data_type_hash_functions[data_type] = hash_function
+    assert document_cache.document_key(str(document)) == key
+
+
+def test_key_changes_with_fingerprint(document, monkeypatch):
+    key = document_cache.document_key(str(document))
+    document_cache._fingerprint.cache_clear()
+    monkeypatch.setattr(document_cache.vocabulary, 'concept_map_hash', lambda: "another concept map")
+    try:
+        assert document_cache.document_key(str(document)) != key
+    finally:
+        document_cache._fingerprint.cache_clear()
+
+
+@pytest.mark.parametrize("module", [document_cache, field_metrics, layer_datasets])
+def test_key_changes_with_source(document, tmp_path, monkeypatch, module):
+    """ Changing the code that makes or counts the DataFrames changes every key. """
+    source_dir = tmp_path / "prototype_2"
+    source_dir.mkdir()
+    for source_module in [document_cache, field_metrics, layer_datasets]:
+        shutil.copy(source_module.__file__, source_dir)
+        monkeypatch.setattr(source_module, '__file__', str(source_dir / os.path.basename(source_module.__file__)))
+    document_cache._fingerprint.cache_clear()
+    try:
+        key = document_cache.document_key(str(document))
+        with open(module.__file__, 'a') as f:
+            f.write("\n# changed\n")
+        document_cache._fingerprint.cache_clear()
+        assert document_cache.document_key(str(document)) != key
+    finally:
+        document_cache._fingerprint.cache_clear()
+
+
+def test_miss_and_unreadable_entry(cache_dir):
+    assert document_cache.get("0" * 64) is None
+    (cache_dir / ("1" * 64 + ".pkl")).write_bytes(b"not a pickle")
+    assert document_cache.get("1" * 64) is None
+
+
+def test_evict_removes_least_recently_used(cache_dir):
+    frame = pd.DataFrame({'person_id': range(1000)})
+    for n, key in enumerate(["a", "b", "c"]):
+        document_cache.put(key, {'Person': frame}, {})
+        os.utime(cache_dir / f"{key}.pkl", (1000 + n, 1000 + n))
+    document_cache.get("a")  # now the most recently used
+    entry_size = (cache_dir / "a.pkl").stat().st_size
+
+    assert document_cache.evict(max_bytes=3 * entry_size) == (3, 0)
+    assert document_cache.evict(max_bytes=2 * entry_size) == (2, 1)
+    assert [path.stem for path in _entries(cache_dir)] == ["a", "c"]
+    assert document_cache.evict(max_bytes=0) == (0, 2)
+    assert _entries(cache_dir) == []
@@ -0,0 +1,82 @@
+import pytest
+
+import prototype_2.id_hashing as id_hashing
+
+INPUTS = [f"2.16.840.1.113883.19.5-{n}" for n in range(2000)] + ["", "ünïcode", "a-b-c"]
+
+
+@pytest.fixture(autouse=True)
+def default_hashing():
+    """ Leaves the hash functions and the collision detector as they were. """
+    data_type_hash_functions = dict(id_hashing.data_type_hash_functions)
+    id_hashing.take_recorded_ids()
+    id_hashing._run_ids.clear()
+    yield
+    id_hashing.data_type_hash_functions.update(data_type_hash_functions)
+    id_hashing.enable_collision_detection(False)
+    id_hashing.take_recorded_ids()
+    id_hashing._run_ids.clear()
+
+
+@pytest.mark.parametrize("function_name, bits", [(name, int(name.rsplit('_', 1)[1]))
+                                                 for name in sorted(id_hashing.hash_functions)])
+def test_widths(function_name, bits):
+    hash_function = id_hashing.hash_functions[function_name]
+    ids = [hash_function(input_string) for input_string in INPUTS]
+    assert all(0 <= id_value < 2**bits for id_value in ids)
+    # some IDs use the top bit, so the width isn't narrower than its name
+    assert max(ids) >= 2**(bits - 1)
+    assert ids == [hash_function(input_string) for input_string in INPUTS]
+
+
+def test_integerhash_is_the_original_scheme():
+    import hashlib
+    for input_string in INPUTS[:20]:
+        expected = int(hashlib.sha256(input_string.encode('utf-8')).hexdigest(), 16) % 2**31
+        assert id_hashing.hash_id(input_string) == expected
+        assert id_hashing.hash_id(input_string, 'INTEGERHASH') == expected
+
+
+def test_biginthash_defaults_to_63_bits():
+    assert id_hashing.hash_id("person-1", 'BIGINTHASH') == id_hashing.blake2b_63("person-1")
+
+
+def test_set_hash_function():
+    id_hashing.set_hash_function('INTEGERHASH', 'blake2b_31')
+    assert id_hashing.hash_id("person-1") == id_hashing.blake2b_31("person-1")
+    with pytest.raises(ValueError):
+        id_hashing.set_hash_function('INTEGERHASH', 'md5')
+
+
+def test_no_collisions_recorded_when_off():
+    id_hashing.hash_id("a")
+    assert id_hashing.take_recorded_ids() == {}
+
+
+def test_collisions_detected():
+    id_hashing.data_type_hash_functions['INTEGERHASH'] = lambda input_string: len(input_string)
+    id_hashing.enable_collision_detection()
+    for input_string in ["ab", "cd", "ab", "xyz"]:
+        id_hashing.hash_id(input_string)
+    assert id_hashing.get_id_collisions() == {('INTEGERHASH', 2): ["ab", "cd"]}
+    assert id_hashing.report_id_collisions() == 1
+
+
+def test_collisions_across_processes():
+    """ IDs taken from one process and added in another are checked together. """
+    id_hashing.data_type_hash_functions['BIGINTHASH'] = lambda input_string: 7
+    id_hashing.enable_collision_detection()
+    id_hashing.hash_id("first", 'BIGINTHASH')
+    worker_ids = id_hashing.take_recorded_ids()
+    assert id_hashing.get_id_collisions() == {}
+    id_hashing.hash_id("second", 'BIGINTHASH')
+    id_hashing.add_recorded_ids(worker_ids)
+    assert id_hashing.get_id_collisions() == {('BIGINTHASH', 7): ["first", "second"]}
+
+
+def test_same_input_isnt_a_collision():
+    id_hashing.enable_collision_detection()
+    for input_string in INPUTS:
+        id_hashing.hash_id(input_string)
+        id_hashing.hash_id(input_string)
+    assert id_hashing.get_id_collisions() == {}
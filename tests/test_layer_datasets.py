@@ -0,0 +1,49 @@
+import pandas as pd
+
+import prototype_2.field_metrics as field_metrics
+import prototype_2.layer_datasets as layer_datasets
+from conftest import SAMPLE_DOCUMENTS
+
+
+def _process(workers):
+    results = list(layer_datasets.process_files(SAMPLE_DOCUMENTS, workers=workers, write_csv=False))
+    field_metrics.take_counts()
+    return results
+
+
+def test_workers_give_the_same_dataframes():
+    serial_results = _process(workers=1)
+    pool_results = _process(workers=2)
+    assert [filepath for (filepath, *rest) in pool_results] == SAMPLE_DOCUMENTS
+    for (serial, pooled) in zip(serial_results, pool_results):
+        (filepath, serial_dict, serial_error, serial_stats) = serial
+        (filepath, pool_dict, pool_error, pool_stats) = pooled
+        assert serial_error is None and pool_error is None
+        assert sorted(pool_dict) == sorted(serial_dict)
+        for domain, domain_df in serial_dict.items():
+            if domain_df is None:
+                assert pool_dict[domain] is None
+            else:
+                pd.testing.assert_frame_equal(pool_dict[domain], domain_df)
+        assert pool_stats['field_counts'] == serial_stats['field_counts']
+
+
+def test_a_bad_file_doesnt_stop_the_others(tmp_path):
+    bad_file = tmp_path / "bad.xml"
+    bad_file.write_text("<ClinicalDocument>")
+    filepath_list = [SAMPLE_DOCUMENTS[0], str(bad_file), SAMPLE_DOCUMENTS[1]]
+    for workers in (1, 2):
+        results = list(layer_datasets.process_files(filepath_list, workers=workers, write_csv=False))
+        assert [filepath for (filepath, *rest) in results] == filepath_list
+        assert [error is None for (filepath, dataframe_dict, error, file_stats) in results] == [True, False, True]
+        assert results[1][1] is None
+
+
+def test_accumulate_and_materialize():
+    frames = [pd.DataFrame({'person_id': [1, 2]}), pd.DataFrame({'person_id': [3]})]
+    accumulator = {}
+    layer_datasets.accumulate_dataframes(accumulator, {'Person': frames[0], 'Visit': None})
+    layer_datasets.accumulate_dataframes(accumulator, {'Person': frames[1], 'Visit': None})
+    df_dict = layer_datasets.materialize_dataframes(accumulator)
+    assert df_dict['Visit'] is None
+    assert df_dict['Person']['person_id'].tolist() == [1, 2, 3]
@@ -0,0 +1,100 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import prototype_2.layer_datasets as layer_datasets
+import prototype_2.omop_schema as omop_schema
+import prototype_2.output_writers as output_writers
+from conftest import SAMPLE_DOCUMENTS
+
+# the Arrow type each OMOP DDL type is written as
+DDL_ARROW_TYPES = {
+    'integer': pa.int64(),
+    'bigint': pa.int64(),
+    'numeric': pa.float64(),
+    'float': pa.float64(),
+    'date': pa.date32(),
+    'timestamp': pa.timestamp('us'),
+    'datetime': pa.timestamp('us'),
+    'varchar': pa.string(),
+    'string': pa.string()
+}
+
+
+@pytest.fixture(scope='module')
+def parsed_documents():
+    return [layer_datasets.process_file(document, write_csv=False) for document in SAMPLE_DOCUMENTS]
+
+
+def _write_parquet(folder, parsed_documents, **writer_options):
+    writer = output_writers.open_parquet_writer(str(folder), **writer_options)
+    for document, dataframe_dict in zip(SAMPLE_DOCUMENTS, parsed_documents):
+        writer['write'](dataframe_dict, document)
+    return writer['close']()
+
+
+def _read_table(folder, domain):
+    table_dir = folder / omop_schema.domain_table_names[domain]
+    parts = sorted(table_dir.glob("part-*.parquet"))
+    return (parts, pa.concat_tables([pq.read_table(part) for part in parts]))
+
+
+def test_schema_matches_ddl(tmp_path, parsed_documents):
+    row_counts = _write_parquet(tmp_path, parsed_documents)
+    assert set(row_counts) <= set(omop_schema.domain_table_names)
+    assert len(row_counts) > 0
+    for domain, row_count in row_counts.items():
+        (parts, table) = _read_table(tmp_path, domain)
+        ddl_columns = omop_schema.get_domain_columns(domain)
+        assert len(table) == row_count
+        assert len(table.schema) > 0
+        for field in table.schema:
+            # columns the DDL doesn't have are strings
+            sql_type = ddl_columns.get(field.name, 'varchar')
+            assert field.type == DDL_ARROW_TYPES[omop_schema.sql_base_type(sql_type)], \
+                f"{domain}.{field.name} {sql_type} written as {field.type}"
+
+
+def test_rows_and_ids_match_the_parse(tmp_path, parsed_documents):
+    row_counts = _write_parquet(tmp_path, parsed_documents)
+    for domain in row_counts:
+        pk_column = omop_schema.load_primary_keys()[omop_schema.domain_table_names[domain]]
+        parsed_df = pd.concat([dataframe_dict[domain] for dataframe_dict in parsed_documents
+                               if dataframe_dict.get(domain) is not None])
+        (parts, table) = _read_table(tmp_path, domain)
+        assert len(table) == len(parsed_df)
+        assert table.column(pk_column).null_count == 0
+        assert [str(pk) for pk in table.column(pk_column).to_pylist()] == [str(pk) for pk in parsed_df[pk_column]]
+
+
+def test_row_groups_and_parts(tmp_path, parsed_documents):
+    row_counts = _write_parquet(tmp_path, parsed_documents, row_group_size=4, rows_per_file=8)
+    for domain, row_count in row_counts.items():
+        (parts, table) = _read_table(tmp_path, domain)
+        part_rows = [pq.ParquetFile(part).metadata.num_rows for part in parts]
+        assert sum(part_rows) == row_count
+        assert all(rows == 8 for rows in part_rows[:-1])
+        for part in parts:
+            metadata = pq.ParquetFile(part).metadata
+            assert all(metadata.row_group(i).num_rows <= 4 for i in range(metadata.num_row_groups))
+
+
+def test_old_parts_removed(tmp_path, parsed_documents):
+    _write_parquet(tmp_path, parsed_documents, row_group_size=1, rows_per_file=1)
+    row_counts = _write_parquet(tmp_path, parsed_documents)
+    for domain, row_count in row_counts.items():
+        (parts, table) = _read_table(tmp_path, domain)
+        assert len(parts) == 1
+        assert len(table) == row_count
+
+
+def test_values_that_dont_convert_are_null():
+    schema = output_writers.domain_arrow_schema('Person')
+    person_df = pd.DataFrame({'year_of_birth': ["1962", "x", None],
+                              'birth_datetime': ["2001-02-03", "not a date", None]})
+    table = output_writers.dataframe_to_arrow(person_df, schema, 'Person')
+    assert table.schema == schema
+    assert table.column('year_of_birth').to_pylist() == [1962, None, None]
+    assert table.column('birth_datetime').null_count == 2
+    assert table.column('gender_concept_id').null_count == 3
@@ -0,0 +1,100 @@
+import pytest
+
+import omop.setup_omop as setup_omop
+
+PERSON_COLUMNS = "person_id,gender_concept_id,year_of_birth,race_concept_id,ethnicity_concept_id\n"
+
+
+@pytest.fixture
+def csv_dir(tmp_path, monkeypatch):
+    csv_dir = tmp_path / "output"
+    csv_dir.mkdir()
+    monkeypatch.setattr(setup_omop, 'OMOP_CSV_DATA_DIR', str(csv_dir))
+    return csv_dir
+
+
+def _write_person_csv(csv_dir, document, rows):
+    (csv_dir / f"{document}__Person.csv").write_text(
+        PERSON_COLUMNS + "".join(f"{person_id},8532,{year},0,0\n" for (person_id, year) in rows))
+
+
+def _load(database_file):
+    """ A run of setup_omop: opens the database, sets it up and loads Person. """
+    conn = setup_omop.connect(str(database_file))
+    try:
+        setup_omop.setup_database(conn)
+        row_count = setup_omop.load_domain(conn, 'Person')
+        people = conn.execute("SELECT person_id, year_of_birth FROM person ORDER BY person_id").fetchall()
+        manifest_files = conn.execute("SELECT count(*) FROM omop_load_manifest").fetchone()[0]
+    finally:
+        conn.close()
+    return (row_count, people, manifest_files)
+
+
+def test_incremental_load(tmp_path, csv_dir, monkeypatch):
+    monkeypatch.setattr(setup_omop, 'processing_status', True)
+    database_file = tmp_path / "omop.duckdb"
+    _write_person_csv(csv_dir, "a.xml", [(1, 1970), (2, 1980)])
+    _write_person_csv(csv_dir, "b.xml", [(3, 1990)])
+    assert _load(database_file) == (3, [(1, 1970), (2, 1980), (3, 1990)], 2)
+
+    # unchanged files are skipped
+    assert _load(database_file) == (0, [(1, 1970), (2, 1980), (3, 1990)], 2)
+
+    # a changed file's rows are replaced, and a new file is added
+    _write_person_csv(csv_dir, "a.xml", [(1, 1971)])
+    _write_person_csv(csv_dir, "c.xml", [(4, 2000)])
+    assert _load(database_file) == (2, [(1, 1971), (3, 1990), (4, 2000)], 3)
+    assert setup_omop.processing_status is True
+
+
+def test_reload_keeps_other_files_rows_with_the_same_pk(tmp_path, csv_dir, monkeypatch):
+    """ Hashed IDs can repeat across documents. Without the PK constraints both
+        files' rows with the same ID load, and reloading one file leaves the other's.
+    """
+    monkeypatch.setattr(setup_omop, 'create_omop_tables',
+                        lambda conn: setup_omop._apply_ddl(conn, "OMOPCDM_duckdb_5.3_ddl.sql"))
+    database_file = tmp_path / "omop.duckdb"
+    _write_person_csv(csv_dir, "a.xml", [(1, 1970), (2, 1980)])
+    _write_person_csv(csv_dir, "b.xml", [(1, 1990)])
+    assert _load(database_file) == (3, [(1, 1970), (1, 1990), (2, 1980)], 2)
+
+    _write_person_csv(csv_dir, "a.xml", [(1, 1971), (2, 1980)])
+    (row_count, people, manifest_files) = _load(database_file)
+    assert (row_count, sorted(people), manifest_files) == (2, [(1, 1971), (1, 1990), (2, 1980)], 2)
+
+
+def test_failing_file_is_left_out(tmp_path, csv_dir, monkeypatch):
+    monkeypatch.setattr(setup_omop, 'processing_status', True)
+    database_file = tmp_path / "omop.duckdb"
+    _write_person_csv(csv_dir, "a.xml", [(1, 1970)])
+    (csv_dir / "b.xml__Person.csv").write_text(PERSON_COLUMNS + "2,8532,,0,0\n")
+    assert _load(database_file) == (1, [(1, 1970)], 1)
+    assert setup_omop.processing_status is False
+
+    # the failed file is tried again on the next run
+    _write_person_csv(csv_dir, "b.xml", [(2, 1980)])
+    assert _load(database_file) == (1, [(1, 1970), (2, 1980)], 2)
+
+
+def test_in_memory_database(csv_dir):
+    _write_person_csv(csv_dir, "a.xml", [(1, 1970)])
+    conn = setup_omop.connect()
+    setup_omop.setup_database(conn)
+    assert setup_omop.load_domains(conn, ['Person', 'Visit']) == {'Person': 1, 'Visit': 0}
+    conn.close()
+
+
+def test_check_pk_reports_duplicates(monkeypatch):
+    monkeypatch.setattr(setup_omop, 'processing_status', True)
+    conn = setup_omop.connect()
+    setup_omop._apply_ddl(conn, "OMOPCDM_duckdb_5.3_ddl.sql")
+    conn.execute("INSERT INTO person (person_id, gender_concept_id, year_of_birth, race_concept_id, "
+                 "ethnicity_concept_id) VALUES (1, 0, 1970, 0, 0), (2, 0, 1980, 0, 0)")
+    setup_omop.check_PK(conn, 'Person')
+    assert setup_omop.processing_status is True
+    conn.execute("INSERT INTO person (person_id, gender_concept_id, year_of_birth, race_concept_id, "
+                 "ethnicity_concept_id) VALUES (1, 0, 1990, 0, 0)")
+    setup_omop.check_PK(conn, 'Person')
+    assert setup_omop.processing_status is False
+    conn.close()
@@ -0,0 +1,18 @@
+import pytest
+
+import prototype_2.data_driven_parse as DDP
+from conftest import SAMPLE_DOCUMENTS
+from prototype_2.metadata import get_meta_dict
+
+
+def _rows(omop_dict):
+    return {domain: [list(row.items()) for row in (rows or [])]
+            for (domain, rows) in omop_dict.items()}
+
+
+@pytest.mark.parametrize("document", SAMPLE_DOCUMENTS)
+def test_streaming_gives_the_same_rows(document):
+    parsed = DDP.parse_doc(document, get_meta_dict())
+    streamed = DDP.parse_doc(document, get_meta_dict(), streaming=True)
+    assert sum(len(rows or []) for rows in parsed.values()) > 0
+    assert _rows(streamed) == _rows(parsed)
@@ -0,0 +1,68 @@
+import logging
+
+import pytest
+
+import prototype_2.value_transformations as VT
+
+CONCEPT_CSV = """oid,concept_code,concept_id,domain_id
+2.16.840.1.113883.5.1,F,8532,Gender
+2.16.840.1.113883.6.1,8480-6,3004249,Measurement
+2.16.840.1.113883.6.96,99,2222,Condition
+2.16.840.1.113883.6.96,99,3333,Observation
+"""
+
+
+@pytest.fixture(autouse=True)
+def concepts(concept_map):
+    concept_map(CONCEPT_CSV)
+
+
+def _args(vocabulary_oid, concept_code):
+    return {'vocabulary_oid': vocabulary_oid, 'concept_code': concept_code, 'default': (0, 'default')}
+
+
+def test_map_concept_id_and_domain_id():
+    assert VT.map_hl7_to_omop_concept_id(_args('2.16.840.1.113883.6.1', '8480-6')) == 3004249
+    assert VT.map_hl7_to_omop_domain_id(_args('2.16.840.1.113883.6.1', '8480-6')) == 'Measurement'
+    assert VT.map_hl7_to_omop_concept_id(_args('2.16.840.1.113883.5.1', 'F')) == 8532
+
+
+def test_missing_and_ambiguous_codes_map_to_none():
+    for args_dict in [_args('2.16.840.1.113883.6.1', 'nope'), _args(None, 'F'),
+                      _args('2.16.840.1.113883.6.96', '99')]:
+        assert VT.map_hl7_to_omop_concept_id(args_dict) is None
+        assert VT.map_hl7_to_omop_domain_id(args_dict) is None
+
+
+def test_each_code_is_looked_up_once(monkeypatch):
+    lookups = []
+    lookup = VT.vocabulary.lookup
+
+    def counting_lookup(vocabulary_oid, concept_code):
+        lookups.append((vocabulary_oid, concept_code))
+        return lookup(vocabulary_oid, concept_code)
+    monkeypatch.setattr(VT.vocabulary, 'lookup', counting_lookup)
+
+    for _ in range(3):
+        assert VT.map_hl7_to_omop_concept_id(_args('2.16.840.1.113883.6.1', '8480-6')) == 3004249
+        assert VT.map_hl7_to_omop_domain_id(_args('2.16.840.1.113883.6.1', '8480-6')) == 'Measurement'
+    assert lookups == [('2.16.840.1.113883.6.1', '8480-6')]
+    assert VT.concept_cache_info().misses == 1
+    assert VT.concept_cache_info().hits == 5
+
+
+def test_missing_code_is_reported_once(caplog):
+    with caplog.at_level(logging.ERROR, logger=VT.__name__):
+        for _ in range(3):
+            assert VT.map_hl7_to_omop_concept_id(_args('2.16.840.1.113883.6.1', 'nope')) is None
+    assert len(caplog.records) == 1
+
+
+def test_concept_cache_size_bounds_the_memo():
+    VT.set_concept_cache_size(1)
+    try:
+        VT.map_hl7_to_omop_concept_id(_args('2.16.840.1.113883.6.1', '8480-6'))
+        VT.map_hl7_to_omop_concept_id(_args('2.16.840.1.113883.5.1', 'F'))
+        assert VT.concept_cache_info().currsize == 1
+    finally:
+        VT.set_concept_cache_size(VT.CONCEPT_CACHE_SIZE)
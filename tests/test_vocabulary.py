@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+import prototype_2.value_transformations as VT
+import prototype_2.vocabulary as vocabulary
+
+CONCEPT_CSV = """oid,concept_code,concept_id,domain_id
+2.16.840.1.113883.5.1,F,8532,Gender
+2.16.840.1.113883.5.1,M,8507,Gender
+2.16.840.1.113883.6.1,8480-6,3004249,Measurement
+2.16.840.1.113883.6.1,1234-5,1111,
+2.16.840.1.113883.6.96,99,2222,Condition
+2.16.840.1.113883.6.96,99,3333,Observation
+"""
+
+
+@pytest.fixture
+def concept_csv(concept_map):
+    """ A small concept map in a temporary directory, loaded in place of the real one. """
+    return concept_map(CONCEPT_CSV)
+
+
+def test_lookup(concept_csv):
+    assert vocabulary.lookup('2.16.840.1.113883.5.1', 'F') == (8532, 'Gender', False)
+    assert vocabulary.lookup('2.16.840.1.113883.6.1', '8480-6') == (3004249, 'Measurement', False)
+    assert vocabulary.lookup('2.16.840.1.113883.5.1', 'X') is None
+    assert vocabulary.lookup('9.9.9', 'F') is None
+
+
+def test_lookup_ambiguous_takes_first_row(concept_csv):
+    assert vocabulary.lookup('2.16.840.1.113883.6.96', '99') == (2222, 'Condition', True)
+
+
+def test_lookup_missing_domain(concept_csv):
+    """ A concept without a domain_id has None, not the last domain's name. """
+    assert vocabulary.lookup('2.16.840.1.113883.6.1', '1234-5') == (1111, None, False)
+    assert vocabulary.lookup_many([('2.16.840.1.113883.6.1', '1234-5')]) == \
+        {('2.16.840.1.113883.6.1', '1234-5'): (1111, None, False)}
+
+
+def test_lookup_many_matches_lookup(concept_csv):
+    code_pairs = [('2.16.840.1.113883.5.1', 'F'), ('2.16.840.1.113883.5.1', 'M'),
+                  ('2.16.840.1.113883.6.1', '1234-5'), ('2.16.840.1.113883.6.96', '99'),
+                  ('2.16.840.1.113883.5.1', 'F'), ('zzz', 'zzz'), ('', '')]
+    concepts = vocabulary.lookup_many(code_pairs)
+    assert list(concepts) == list(dict.fromkeys(code_pairs))
+    for code_pair, concept in concepts.items():
+        assert concept == vocabulary.lookup(*code_pair)
+
+
+def test_compiled_next_to_csv(concept_csv):
+    artifact_dir = concept_csv.parent / vocabulary.VOCABULARY_CACHE_DIR / concept_csv.name
+    for name in vocabulary.ARRAY_NAMES:
+        assert (artifact_dir / f"{name}.npy").exists()
+    stamp = vocabulary._read_stamp(str(artifact_dir))
+    assert stamp['source'] == concept_csv.name
+    assert stamp['version'] == vocabulary.ARTIFACT_VERSION
+
+
+def test_loads_compiled_arrays(concept_csv, monkeypatch):
+    vocabulary.clear_concept_map()
+    monkeypatch.setattr(vocabulary, 'compile_concept_map',
+                        lambda *args: pytest.fail("compiled again without a change"))
+    vocabulary.load_concept_map(str(concept_csv))
+    assert vocabulary.lookup('2.16.840.1.113883.5.1', 'M') == (8507, 'Gender', False)
+    assert vocabulary.lookup('2.16.840.1.113883.6.1', '1234-5') == (1111, None, False)
+
+
+def test_touched_csv_isnt_compiled_again(concept_csv, monkeypatch):
+    stat = os.stat(concept_csv)
+    os.utime(concept_csv, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    vocabulary.clear_concept_map()
+    monkeypatch.setattr(vocabulary, 'compile_concept_map',
+                        lambda *args: pytest.fail("compiled again for the same content"))
+    vocabulary.load_concept_map(str(concept_csv))
+    assert vocabulary.lookup('2.16.840.1.113883.5.1', 'F') == (8532, 'Gender', False)
+
+
+def test_changed_csv_is_compiled_again(concept_csv):
+    old_hash = vocabulary.concept_map_hash()
+    concept_csv.write_text(CONCEPT_CSV.replace("8532", "45878463")
+                           + "2.16.840.1.113883.5.1,UN,8551,Gender\n")
+    vocabulary.clear_concept_map()
+    vocabulary.load_concept_map(str(concept_csv))
+    assert vocabulary.lookup('2.16.840.1.113883.5.1', 'F') == (45878463, 'Gender', False)
+    assert vocabulary.lookup('2.16.840.1.113883.5.1', 'UN') == (8551, 'Gender', False)
+    assert vocabulary.concept_map_hash() != old_hash
+
+
+def test_prefetch_is_capped_at_memo_size(concept_csv):
+    VT.set_concept_cache_size(2)
+    try:
+        VT.prefetch_concepts([('2.16.840.1.113883.5.1', 'F'), ('2.16.840.1.113883.5.1', 'M'),
+                              ('2.16.840.1.113883.6.1', '8480-6'), ('zzz', 'zzz')])
+        assert len(VT._prefetched_concepts) <= 2
+        assert VT._map_to_omop_concept_row('2.16.840.1.113883.6.1', '8480-6', None) == (3004249, 'Measurement')
+    finally:
+        VT.set_concept_cache_size(VT.CONCEPT_CACHE_SIZE)